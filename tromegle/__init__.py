@@ -3,4 +3,5 @@ import omegle
 import event
 import troll
 import listener
+import session
 from core import startTrolling, stopTrolling
@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+"""Compact append-only binary archive of conversations.
+
+An archive is a directory of segment files written in sequence.  Every
+conversation is buffered by an ArchiveRecorder until it ends, then appended
+to the current segment as a single contiguous record, so that it can be read
+back with a single seek.
+
+Segment layout (little-endian):
+
+    header          'TRGA' version:u16
+    symbol          'S' sym:u32 len:u16 utf-8
+    conversation    'C' cid:u32 start:f64 end:f64 nevents:u32 length:u32 events
+    footer          'F' nsymbols:u32 nconversations:u32 symbols index
+    trailer         footer offset:u64 'TRGE'
+
+Symbols intern stranger ids and event types; each symbol record precedes
+the first conversation using it.  An event is
+
+    time:f64 stranger:u32 type:u32 flags:u8 len:u32 payload
+
+followed, for messageModified events, by the stranger, type, flags and
+payload of the original message.  The footer holds the symbol table and an
+(cid, offset, length, start, end, nevents) entry per conversation.  Segments
+without a footer (e.g. after a crash) are indexed by scanning their
+conversation records.
+"""
+import os
+import re
+import json
+import mmap
+import struct
+from time import time
+
+from tromegle.event import OmegleEvent, _ReactorEvent, MessageModifiedEvent
+from tromegle.event import ID_SET, DISCONNECTED, IDLE_TIMEOUT, MESSAGE_MODIFIED
+
+MAGIC = 'TRGA'
+MAGIC_END = 'TRGE'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sH')
+_SYMBOL = struct.Struct('<IH')
+_CONVERSATION = struct.Struct('<IddII')
+_EVENT = struct.Struct('<dIIBI')
+_OLD = struct.Struct('<IIBI')
+_FOOTER = struct.Struct('<II')
+_ENTRY = struct.Struct('<IQIddI')
+_TRAILER = struct.Struct('<Q4s')
+
+_NO_ID = 0xffffffff
+
+# event flags
+_MODIFIED = 1
+_REACTOR = 2  # no stranger id
+_NONE = 4
+_JSON = 8
+_BYTES = 16
+
+_SEGMENT_NAME = 'segment-{0:08d}.tra'
+_SEGMENT_RE = re.compile(r'^segment-(\d{8})\.tra$')
+
+
+def _encodeData(data):
+    if data is None:
+        return _NONE, ''
+    if isinstance(data, unicode):
+        return 0, data.encode('utf-8')
+    if isinstance(data, str):
+        return _BYTES, data
+    return _JSON, json.dumps(data)
+
+
+def _decodeData(flags, payload):
+    if flags & _NONE:
+        return None
+    if flags & _BYTES:
+        return payload
+    if flags & _JSON:
+        return json.loads(payload)
+    return payload.decode('utf-8')
+
+
+def segmentFiles(path):
+    """Return the (number, filename) of every segment in an archive
+    directory, in order.
+    """
+    if not os.path.isdir(path):
+        return []
+    found = ((_SEGMENT_RE.match(f), f) for f in os.listdir(path))
+    return sorted((int(m.group(1)), os.path.join(path, f)) for m, f in found if m)
+
+
+class Archive(object):
+    """Writer appending conversations to the segments of an archive
+    directory.
+
+    A single Archive can be shared by every session of a process (see
+    ArchiveRecorder).
+    """
+    def __init__(self, path, maxSegmentSize=64 << 20):
+        """
+        path : str
+            Archive directory.  Created if needed.  Existing segments are kept
+            and a new segment is started.
+
+        maxSegmentSize : int
+            Size (bytes) above which the current segment is finalized and a
+            new one started.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.maxSegmentSize = maxSegmentSize
+
+        existing = segmentFiles(path)
+        self.segment = existing[-1][0] if existing else 0
+        self.nextCid = 0
+        if existing:
+            reader = ArchiveReader(path)
+            self.nextCid = max(reader.conversations() or [-1]) + 1
+            reader.close()
+
+        self.conversations = 0
+        self.events = 0
+        self.bytes = 0
+        self.observers = []  # called with (cid, events) after every append
+        self._file = None
+        self._open()
+
+    def _open(self):
+        self.segment += 1
+        self.filename = os.path.join(self.path, _SEGMENT_NAME.format(self.segment))
+        self._file = open(self.filename, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION))
+        self._offset = _HEADER.size
+        self._symbols = {}
+        self._index = []
+
+    def _finalize(self):
+        symbols = sorted(self._symbols, key=self._symbols.get)
+        parts = ['F', _FOOTER.pack(len(symbols), len(self._index))]
+        for s in symbols:
+            s = s.encode('utf-8')
+            parts.append(struct.pack('<H', len(s)) + s)
+        parts.extend(_ENTRY.pack(*entry) for entry in self._index)
+        parts.append(_TRAILER.pack(self._offset, MAGIC_END))
+
+        self._file.write(''.join(parts))
+        self._file.close()
+        self._file = None
+
+    def _symbol(self, s, parts):
+        if s is None:
+            return _NO_ID
+        sym = self._symbols.get(s)
+        if sym is None:
+            sym = self._symbols[s] = len(self._symbols)
+            b = s.encode('utf-8')
+            parts.append('S' + _SYMBOL.pack(sym, len(b)) + b)
+        return sym
+
+    def _encodeEvent(self, ts, ev, symbols):
+        sid = getattr(ev, 'id', None)
+        flags, payload = _encodeData(ev.data)
+        old = ''
+        if ev.type == MESSAGE_MODIFIED:
+            flags |= _MODIFIED
+            oflags, opayload = _encodeData(ev.old.data)
+            old = _OLD.pack(self._symbol(ev.old.id, symbols), self._symbol(ev.old.type, symbols),
+                            oflags, len(opayload)) + opayload
+        elif not hasattr(ev, 'id'):
+            flags |= _REACTOR
+
+        return _EVENT.pack(ts, self._symbol(sid, symbols), self._symbol(ev.type, symbols),
+                           flags, len(payload)) + payload + old
+
+    def append(self, events):
+        """Append a conversation.
+
+        events : sequence of (float, event)
+            Timestamped Tromegle events, oldest first.
+
+        return : int
+            Conversation id.
+        """
+        if self._file is None:
+            raise ValueError('archive is closed')
+
+        cid = self.nextCid
+        self.nextCid += 1
+
+        symbols = []
+        body = ''.join([self._encodeEvent(ts, ev, symbols) for ts, ev in events])
+        symbols = ''.join(symbols)
+        start, end = events[0][0], events[-1][0]
+        record = symbols + 'C' + _CONVERSATION.pack(cid, start, end, len(events), len(body)) + body
+
+        self._index.append((cid, self._offset + len(symbols), len(body), start, end, len(events)))
+        self._file.write(record)
+        self._offset += len(record)
+
+        self.conversations += 1
+        self.events += len(events)
+        self.bytes += len(record)
+        if self._offset >= self.maxSegmentSize:
+            self._finalize()
+            self._open()
+
+        for fn in self.observers:
+            fn(cid, events)
+        return cid
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        """Finalize the current segment.
+        """
+        if self._file is not None:
+            self._finalize()
+
+    def stats(self):
+        return {'segment': self.segment,
+                'conversations': self.conversations,
+                'events': self.events,
+                'bytes': self.bytes}
+
+
+class ArchiveRecorder(object):
+    """Listener buffering the conversations of a single session and
+    appending them to an Archive once they end.
+
+    Conversations start with the idSet of their strangers and end with a
+    strangerDisconnected or idle timeout event.  Events from strangers that
+    are not part of the current conversation are ignored.
+    """
+    def __init__(self, archive):
+        """
+        archive : Archive
+        """
+        self.archive = archive
+        self._events = []
+        self._ids = set()
+
+    def notify(self, ev):
+        if ev.type is None:  # NULL_EVENT
+            return
+
+        sid = ev.old.id if ev.type == MESSAGE_MODIFIED else getattr(ev, 'id', None)
+        if ev.type == ID_SET:
+            self._ids.add(sid)
+        elif sid is not None and sid not in self._ids:
+            return
+
+        self._events.append((time(), ev))
+        if ev.type in (DISCONNECTED, IDLE_TIMEOUT):
+            self.flush()
+
+    def flush(self):
+        """Append the current conversation to the archive, even if it has not
+        ended.
+
+        return : int or None
+            Conversation id, or None if there was nothing to append.
+        """
+        events, self._events = self._events, []
+        self._ids.clear()
+        if events:
+            return self.archive.append(events)
+
+
+class Segment(object):
+    """Memory-mapped, read-only view of a single segment file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.symbols = []
+        self.index = {}  # {cid: (offset, length, start, end, nevents)}
+        self.finalized = False
+
+        self._file = open(filename, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ) if size else ''
+        if size < _HEADER.size or _HEADER.unpack_from(self._map, 0)[0] != MAGIC:
+            return
+
+        if not self._readFooter():
+            self._scan()
+
+    @staticmethod
+    def isFinalized(filename):
+        """Return True if a segment file ends with a valid trailer, without
+        mapping it.
+        """
+        with open(filename, 'rb') as f:
+            f.seek(0, 2)
+            if f.tell() < _HEADER.size + _TRAILER.size:
+                return False
+            f.seek(-_TRAILER.size, 2)
+            return _TRAILER.unpack(f.read())[1] == MAGIC_END
+
+    def _readFooter(self):
+        m = self._map
+        if len(m) < _HEADER.size + _TRAILER.size:
+            return False
+        footer, magic = _TRAILER.unpack_from(m, len(m) - _TRAILER.size)
+        if magic != MAGIC_END or footer >= len(m) or m[footer] != 'F':
+            return False
+
+        nsymbols, nconversations = _FOOTER.unpack_from(m, footer + 1)
+        pos = footer + 1 + _FOOTER.size
+        for _ in xrange(nsymbols):
+            n, = struct.unpack_from('<H', m, pos)
+            self.symbols.append(m[pos + 2:pos + 2 + n].decode('utf-8'))
+            pos += 2 + n
+        for _ in xrange(nconversations):
+            entry = _ENTRY.unpack_from(m, pos)
+            self.index[entry[0]] = entry[1:]
+            pos += _ENTRY.size
+
+        self.finalized = True
+        return True
+
+    def _scan(self):
+        """Index an unfinalized segment from its symbol and conversation
+        records, skipping over conversation bodies.
+        """
+        m = self._map
+        pos = _HEADER.size
+        while pos < len(m):
+            kind = m[pos]
+            if kind == 'S' and pos + 1 + _SYMBOL.size <= len(m):
+                sym, n = _SYMBOL.unpack_from(m, pos + 1)
+                start = pos + 1 + _SYMBOL.size
+                if start + n > len(m):
+                    break
+                self.symbols.append(m[start:start + n].decode('utf-8'))
+                pos = start + n
+            elif kind == 'C' and pos + 1 + _CONVERSATION.size <= len(m):
+                cid, start, end, nevents, length = _CONVERSATION.unpack_from(m, pos + 1)
+                if pos + 1 + _CONVERSATION.size + length > len(m):
+                    break  # truncated
+                self.index[cid] = (pos, length, start, end, nevents)
+                pos += 1 + _CONVERSATION.size + length
+            else:
+                break
+
+    def _symbol(self, sym):
+        return None if sym == _NO_ID else self.symbols[sym]
+
+    def conversation(self, cid):
+        """Return the timestamped events of a conversation.
+
+        return : list of (float, event)
+        """
+        offset, length, _, _, nevents = self.index[cid]
+        m = self._map
+        pos = offset + 1 + _CONVERSATION.size
+        events = []
+        for _ in xrange(nevents):
+            ts, sid, type_, flags, n = _EVENT.unpack_from(m, pos)
+            pos += _EVENT.size
+            data = _decodeData(flags, m[pos:pos + n])
+            pos += n
+
+            if flags & _MODIFIED:
+                osid, otype, oflags, n = _OLD.unpack_from(m, pos)
+                pos += _OLD.size
+                old = OmegleEvent(self._symbol(osid), self._symbol(otype), _decodeData(oflags, m[pos:pos + n]))
+                pos += n
+                ev = MessageModifiedEvent(data, old)
+            elif flags & _REACTOR:
+                ev = _ReactorEvent(self._symbol(type_), data)
+            else:
+                ev = OmegleEvent(self._symbol(sid), self._symbol(type_), data)
+            events.append((ts, ev))
+        return events
+
+    def iterConversations(self):
+        """Iterate over (cid, events) in file order.
+        """
+        for cid in sorted(self.index, key=lambda c: self.index[c][0]):
+            yield cid, self.conversation(cid)
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._file.close()
+
+
+class ArchiveReader(object):
+    """Random access to the conversations of an archive directory.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.segments = [Segment(f) for _, f in segmentFiles(path)]
+        self._where = {}  # {cid: segment}
+        for seg in self.segments:
+            for cid in seg.index:
+                self._where[cid] = seg
+
+    def __len__(self):
+        return len(self._where)
+
+    def conversations(self):
+        """Return the ids of all archived conversations, in order.
+        """
+        return sorted(self._where)
+
+    def info(self, cid):
+        """Return the start time, end time and number of events of a
+        conversation.
+
+        return : (float, float, int)
+        """
+        return self._where[cid].index[cid][2:]
+
+    def conversation(self, cid):
+        """Return the timestamped events of a conversation.
+
+        return : list of (float, event)
+        """
+        return self._where[cid].conversation(cid)
+
+    def timeRange(self, start=None, end=None):
+        """Iterate over events that occurred in [start, end), ordered by
+        conversation.
+
+        Only conversations overlapping the time range are decoded.
+
+        return : iterator of (cid, float, event)
+        """
+        start = float('-inf') if start is None else start
+        end = float('inf') if end is None else end
+        for cid in self.conversations():
+            first, last, _ = self.info(cid)
+            if last < start or first >= end:
+                continue
+            for ts, ev in self.conversation(cid):
+                if start <= ts < end:
+                    yield cid, ts, ev
+
+    def close(self):
+        for seg in self.segments:
+            seg.close()
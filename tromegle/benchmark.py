@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""End-to-end load benchmark against the local fake Omegle server.
+
+Usage:
+    python -m tromegle.benchmark [--mode middleman|client|sessions] [--sessions N] [--duration S]
+    python -m tromegle.benchmark --mode substitution [--keys 10,100,1000]
+"""
+import random
+import resource
+from argparse import ArgumentParser
+from string import ascii_lowercase
+from time import time
+
+from twisted.internet import reactor
+
+from tromegle import fakeserver
+from tromegle.language import SubstitutionMap
+from tromegle.omegle import Outbox, Stranger, getSharedPool
+from tromegle.prefetch import StrangerPool
+from tromegle.replay import Recorder
+from tromegle.session import SessionManager, currentRSS, peakRSS
+from tromegle.troll import MiddleMan, Client
+
+
+def percentile(values, p):
+    """Return the p-th percentile (0 <= p <= 100) of a sequence of numbers.
+    """
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100. * (len(values) - 1)))))
+    return values[k]
+
+
+def cpuTime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class RelayTimer(object):
+    """Collect relay latencies, from receipt of a gotMessage event by
+    TrollReactor.feed to the corresponding send request.
+    """
+    def __init__(self):
+        self.latencies = []
+
+    def timed(self, cls):
+        """Return a subclass of the TrollReactor class `cls` recording relay
+        latencies into this timer.
+        """
+        timer = self
+
+        class Timed(cls):
+            def feed(self, events):
+                self._received = time()
+                super(Timed, self).feed(events)
+
+            def on_gotMessage(self, ev):
+                super(Timed, self).on_gotMessage(ev)
+                timer.latencies.append(time() - self._received)
+
+        Timed.__name__ = 'Timed' + cls.__name__
+        return Timed
+
+
+class ReconnectTimer(object):
+    """Collect reconnect times, from a stranger disconnecting to both
+    strangers of the next conversation being identified.
+    """
+    def __init__(self):
+        self.latencies = []
+
+    def timed(self, cls):
+        timer = self
+
+        class Timed(cls):
+            _disconnected = None
+
+            def on_strangerDisconnected(self, ev):
+                self._disconnected = time()
+                super(Timed, self).on_strangerDisconnected(ev)
+
+            def on_idSet(self, ev):
+                super(Timed, self).on_idSet(ev)
+                if self._allConnected and self._disconnected is not None:
+                    timer.latencies.append(time() - self._disconnected)
+                    self._disconnected = None
+
+        Timed.__name__ = 'Reconnect' + cls.__name__
+        return Timed
+
+
+class EchoClient(Client):
+    """Client replying to every message with the same message.
+    """
+    def on_gotMessage(self, ev):
+        self.sendMessage(ev.data)
+
+
+def run(mode='middleman', sessions=1, duration=10., interval=.5, latency=0., errorRate=0.,
+        messages=None, prefetch=0, batch=0, record=None, stopTimeout=5.):
+    """Run the benchmark and return a report.
+
+    mode : str
+        'middleman' (one MiddleMan), 'client' (one echoing Client) or
+        'sessions' (`sessions` MiddleMen in a SessionManager).
+
+    messages : int or None
+        Number of messages after which bot strangers disconnect, forcing
+        sessions to reconnect.  None = never.
+
+    prefetch : int
+        Size of the StrangerPool shared by all sessions.  0 = no pool.
+
+    batch : int
+        Outbox.batchLength.  0 = no batching.
+
+    record : str or None
+        File to which the traffic is recorded (see replay.Recorder).
+
+    stopTimeout : float
+        Seconds to wait for the disconnect requests sent on shutdown.
+
+    return : dict
+    """
+    server, url = fakeserver.listen(latency=latency, errorRate=errorRate,
+                                    behaviour=lambda: fakeserver.ChattyStranger(interval, messages))
+    Stranger.setAPIBase(url)
+    Outbox.batchLength = batch
+    recorder = None
+    if record:
+        recorder = Recorder(record)
+        recorder.install()
+
+    kwargs = {}
+    pool = None
+    if prefetch:
+        pool = kwargs['prefetch'] = StrangerPool(reactor, size=prefetch)
+        pool.start()
+
+    timer = RelayTimer()
+    reconnects = ReconnectTimer()
+    if mode == 'client':
+        manager = SessionManager(timer.timed(EchoClient), n=1, **kwargs)
+    else:
+        manager = SessionManager(reconnects.timed(timer.timed(MiddleMan)),
+                                 n=sessions if mode == 'sessions' else 1, **kwargs)
+
+    rss0, cpu0 = currentRSS(), cpuTime()
+    manager.start()
+
+    report = {}
+
+    def finish():
+        elapsed = time() - t0
+        n = len(manager.sessions) or 1
+        e2e = [l for _, l in server.received if l is not None]
+        outbox = {}
+        for session in manager.sessions:
+            for k, v in session.outboxStats().iteritems():
+                outbox[k] = max(outbox.get(k, 0), v) if k.startswith('max') else outbox.get(k, 0) + v
+        report.update({
+            'mode': mode,
+            'sessions': len(manager.sessions),
+            'duration': elapsed,
+            'messages': len(timer.latencies),
+            'messagesPerSecond': len(timer.latencies) / elapsed,
+            'relayP50': percentile(timer.latencies, 50),
+            'relayP99': percentile(timer.latencies, 99),
+            'endToEndP50': percentile(e2e, 50),
+            'endToEndP99': percentile(e2e, 99),
+            'connections': dict(getSharedPool(reactor).stats),
+            'reconnects': len(reconnects.latencies),
+            'reconnectP50': percentile(reconnects.latencies, 50),
+            'reconnectP99': percentile(reconnects.latencies, 99),
+            'prefetch': dict(pool.stats) if pool is not None else None,
+            'outbox': outbox,
+            'cpuPerSession': (cpuTime() - cpu0) / n,
+            'rssPerSession': (currentRSS() - rss0) / n,
+            'peakRSS': peakRSS(),
+        })
+        # let the disconnect requests complete before stopping the reactor
+        stopped = manager.stop()
+        timeout = reactor.callLater(stopTimeout, stop, None)
+        stopped.addCallback(stop, timeout)
+
+    def stop(_, timeout):
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+        if not reactor.running or 'requests' in report:
+            return
+        report['requests'] = dict(server.requests)
+        report['serverErrors'] = server.errors
+        Stranger.setAPIBase()
+        Outbox.batchLength = 0
+        if recorder is not None:
+            recorder.close()
+        reactor.stop()
+
+    t0 = time()
+    reactor.callLater(duration, finish)
+    reactor.run()
+    return report
+
+
+def randomWord(rng, lo=2, hi=10):
+    return u''.join(rng.choice(ascii_lowercase) for _ in xrange(rng.randint(lo, hi)))
+
+
+def timeTranslate(smap, tokens):
+    t0 = time()
+    out = smap.translate(tokens)
+    return (time() - t0) / len(tokens), out
+
+
+def benchSubstitution(sizes=(10, 100, 1000, 10000, 100000), ntokens=2000, dist=1, linearMax=10000, seed=0):
+    """Compare indexed and linear SubstitutionMap lookups.
+
+    sizes : sequence of int
+        Numbers of keys to benchmark.
+
+    ntokens : int
+        Number of tokens translated per map.  Half of them are near-misses
+        of existing keys.
+
+    linearMax : int
+        Largest map for which the linear scan is also timed.
+
+    return : list of dict
+        One row per map size.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for n in sizes:
+        words = dict((randomWord(rng), randomWord(rng)) for _ in xrange(n))
+        keys = list(words)
+        tokens = []
+        for i in xrange(ntokens):
+            if i % 2:
+                tokens.append(randomWord(rng))
+            else:
+                k = rng.choice(keys)
+                j = rng.randrange(len(k))
+                tokens.append(k[:j] + rng.choice(ascii_lowercase) + k[j + 1:])
+
+        t0 = time()
+        indexed = SubstitutionMap(words, dist=dist)
+        row = {'keys': len(indexed), 'build': time() - t0}
+        row['indexed'], out = timeTranslate(indexed, tokens)
+
+        if n <= linearMax:
+            linear = SubstitutionMap(words, dist=dist, edit_fn=lambda a, b: indexed.edit_fn(a, b))
+            row['linear'], expected = timeTranslate(linear, tokens)
+            row['identical'] = out == expected
+        rows.append(row)
+    return rows
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Load-test Tromegle against a local fake Omegle server.')
+    parser.add_argument('--mode', choices=('middleman', 'client', 'sessions', 'substitution'), default='middleman')
+    parser.add_argument('--sessions', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10.)
+    parser.add_argument('--interval', type=float, default=.5, help='seconds between bot messages')
+    parser.add_argument('--latency', type=float, default=0., help='injected server latency (seconds)')
+    parser.add_argument('--error-rate', type=float, default=0., help='probability of a server error')
+    parser.add_argument('--messages', type=int, default=None, help='messages before bots disconnect')
+    parser.add_argument('--prefetch', type=int, default=0, help='size of the prefetched stranger pool')
+    parser.add_argument('--batch', type=int, default=0, help='maximum length of batched messages (0 = off)')
+    parser.add_argument('--record', default=None, help='record the traffic to this file (see tromegle.replay)')
+    parser.add_argument('--keys', default='10,100,1000,10000,100000',
+                        help='comma-separated SubstitutionMap sizes (substitution mode)')
+    args = parser.parse_args(argv)
+
+    if args.mode == 'substitution':
+        print '{0:>8} {1:>10} {2:>14} {3:>14} {4:>10}'.format('keys', 'build (s)', 'indexed (us)', 'linear (us)', 'identical')
+        for row in benchSubstitution([int(k) for k in args.keys.split(',')]):
+            print '{0:>8} {1:>10.3f} {2:>14.1f} {3:>14} {4:>10}'.format(
+                row['keys'], row['build'], row['indexed'] * 1e6,
+                '{0:.1f}'.format(row['linear'] * 1e6) if 'linear' in row else '-',
+                row.get('identical', '-'))
+        return
+
+    report = run(args.mode, args.sessions, args.duration, args.interval, args.latency, args.error_rate,
+                 args.messages, args.prefetch, args.batch, args.record)
+    for key in sorted(report):
+        print '{0:>20}: {1}'.format(key, report[key])
+
+
+if __name__ == '__main__':
+    main()
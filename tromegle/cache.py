@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+from collections import OrderedDict
+from functools import wraps
+
+
+class LRUCache(object):
+    """Size-bounded least-recently-used cache.
+
+    Hits, misses and evictions are counted.
+    """
+    def __init__(self, maxsize=1024):
+        """
+        maxsize : int
+            Maximum number of entries.
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Return the value cached for key (marking it as recently used), or
+        default.
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        data = self._data
+        data.pop(key, None)
+        data[key] = value
+        if len(data) > self.maxsize:
+            data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Drop all entries.  Counters are left untouched.
+        """
+        self._data.clear()
+
+    def stats(self):
+        """Return cache counters.
+
+        return : dict
+        """
+        return {'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+def memoize_(cache, version=None):
+    """Decorator caching the results of a single-argument function in an
+    LRUCache.
+
+    cache : LRUCache
+
+    version : callable or None
+        Called before every lookup.  The cache is cleared whenever its return
+        value changes, e.g. when an underlying SubstitutionMap is modified.
+    """
+    def decorator(fn):
+        missing = object()
+        state = {'version': version() if version is not None else None}
+
+        @wraps(fn)
+        def wrapper(arg):
+            if version is not None:
+                v = version()
+                if v != state['version']:
+                    cache.clear()
+                    state['version'] = v
+
+            result = cache.get(arg, missing)
+            if result is missing:
+                result = fn(arg)
+                cache.put(arg, result)
+            return result
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
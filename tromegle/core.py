@@ -55,3 +55,37 @@ class CBDictInterface(object):
 
     def notify(self, ev):
         self.callbacks.get(ev.type, _doNothing)(ev)
+
+    def subscriptions(self):
+        """Return the event types this object responds to.
+
+        Types whose callback is one of the empty on_* methods of
+        CBDictInterface are left out, so that a TrollReactor does not notify
+        listeners of events they ignore.  Set the `eventTypes` attribute to
+        override.
+
+        return : frozenset or None
+            None if every event type is of interest, e.g. because notify
+            is overridden.
+        """
+        types = getattr(self, 'eventTypes', None)
+        if types is not None:
+            return frozenset(types)
+        if getattr(self.notify, '__func__', None) is not CBDictInterface.notify.__func__:
+            return None
+
+        return frozenset(t for t, cb in self.callbacks.iteritems()
+                         if getattr(cb, '__func__', cb) not in _NOOP_CALLBACKS and cb is not _doNothing)
+
+
+_NOOP_CALLBACKS = frozenset(getattr(CBDictInterface, name).__func__
+                            for name in dir(CBDictInterface) if name.startswith('on_'))
+
+
+def subscriptions(listener):
+    """Return the event types a listener responds to, or None for all types.
+    """
+    if hasattr(listener, 'subscriptions'):
+        return listener.subscriptions()
+    types = getattr(listener, 'eventTypes', None)
+    return frozenset(types) if types is not None else None
@@ -1,5 +1,14 @@
 #!/usr/bin/env python
+from bisect import bisect_right
 from collections import namedtuple, deque
+from functools import wraps
+from time import time
+
+from twisted.internet.defer import Deferred, DeferredSemaphore, maybeDeferred
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from tromegle import metrics
 
 # Omegle events
 OmegleEvent = namedtuple('OmegleEvent', ['id', 'type', 'data'])
@@ -21,12 +30,26 @@ IDLE_TIMEOUT = 'timeout'
 # Transmogrifier Events
 _MessageModifiedEvent = namedtuple('TransmogrifierEvent', ['type', 'data', 'old'])
 MESSAGE_MODIFIED = 'messageModified'
+SPELL_FIRED = 'spellFired'
+
+EVENT_TYPES = (ID_SET, WAITING, CONNECTED, TYPING, STOPPED_TYPING, GOT_MESSAGE, DISCONNECTED,
+               ERROR, TIMEOUT_EVENT, IDLE_TIMEOUT, MESSAGE_MODIFIED, SPELL_FIRED)
+MESSAGE_TYPES = frozenset((GOT_MESSAGE, MESSAGE_MODIFIED))
 
 
 def IdleTimeoutEvent(delta_t):
     return _ReactorEvent(IDLE_TIMEOUT, delta_t)
 
 
+def SpellFiredEvent(name):
+    """Create the event announcing that a spell altered or dropped an event.
+
+    name : str
+        Spell name (see spellName).
+    """
+    return _ReactorEvent(SPELL_FIRED, name)
+
+
 def MessageModifiedEvent(data, old):
     """Create MessageModifiedEvent.
 
@@ -69,10 +92,47 @@ def spell_(fn):
         return throwNone
 
 
+def handles_(*types):
+    """Decorator declaring the event types a spell acts upon.
+
+    The Transmogrifier does not call the spell for events of other types;
+    they pass through unaltered.  Spells without a declaration are cast on
+    every event.
+    """
+    def decorator(spell_fn):
+        spell_fn.eventTypes = frozenset(types)
+        return spell_fn
+    return decorator
+
+
+def deferred_(spell_fn):
+    """Decorator marking a spell which returns a Deferred.
+
+    Marked spells count towards the Transmogrifier's limit of spells in
+    flight.  (Unmarked spells may also return a Deferred, but are started
+    regardless of that limit.)
+    """
+    spell_fn.spellMode = 'deferred'
+    return spell_fn
+
+
+def threaded_(spell_fn):
+    """Decorator marking a blocking spell to be run in the reactor's thread
+    pool.
+
+    The spell must not touch the reactor nor any state shared with other
+    spells or listeners.
+    """
+    spell_fn.spellMode = 'thread'
+    return spell_fn
+
+
 def onlyMessages_(spell_fn):
     """Decorator which returns non-message events unaltered and passes
     message events to the spell it wraps.
     """
+    @handles_(*MESSAGE_TYPES)
+    @wraps(spell_fn)
     def wrapper(t, ev):
         if t.isMessage(ev):
             return spell_fn(t, ev)
@@ -81,32 +141,384 @@ def onlyMessages_(spell_fn):
     return wrapper
 
 
+class SpellStats(object):
+    """Profiling counters for a single spell (see Transmogrifier.profile).
+    """
+    __slots__ = ('name', 'calls', 'timed', 'time', 'maxTime', 'modified', 'blackholed', 'passed')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.timed = 0  # calls whose duration was sampled
+        self.time = 0.  # total duration of sampled calls
+        self.maxTime = 0.
+        self.modified = 0
+        self.blackholed = 0
+        self.passed = 0
+
+    def cumTime(self):
+        """Return the estimated cumulative wall time of all calls.
+        """
+        return self.time * self.calls / self.timed if self.timed else 0.
+
+    def asdict(self):
+        d = dict((k, getattr(self, k)) for k in self.__slots__)
+        d['cumTime'] = self.cumTime()
+        d['meanTime'] = self.time / self.timed if self.timed else 0.
+        return d
+
+
+def spellName(spell):
+    return getattr(spell, '__name__', None) or type(spell).__name__
+
+
 class Transmogrifier(object):
-    def __init__(self, spells=()):
+    """Cast spells on events before they reach the TrollReactor's listeners.
+
+    Spells are cast in FIFO order.  For every event type, the Transmogrifier
+    keeps the chain of spells handling it (see handles_), so that an event
+    only goes through the relevant spells.  If a spell changes the type of
+    an event, casting resumes with the next spell handling the new type.
+
+    Spells may return a Deferred (see deferred_) or be run in a thread (see
+    threaded_).  Events from a given stranger are output in the order in
+    which they were received, at most `maxInFlight` marked spells run at
+    once, and a spell which does not complete within `timeout` seconds (or
+    fails) lets the event through unaltered.
+
+    With `announceSpells`, whenever a spell fires, i.e. alters or blackholes
+    an event, a spellFired event carrying the spell name (see spellName) is
+    output just before the event it produced, e.g. for mining.Stats to count
+    spell hits in archived conversations.
+    """
+    def __init__(self, spells=(), maxInFlight=8, timeout=2., clock=None, announceSpells=False):
+        """
+        spells : tuple or list
+            Spells to add (in FIFO order).
+
+        maxInFlight : int
+            Maximum number of deferred_ or threaded_ spells running at once.
+
+        timeout : float
+            Seconds after which an asynchronous spell is skipped.
+
+        clock : IReactorTime provider or None
+            Defaults to the global reactor.
+
+        announceSpells : bool
+            If True, output a spellFired event whenever a spell fires.
+        """
         self._spells = ()
+        self._chains = {}
 
         self._evQueue = None
+        self._onOutput = None
         self.purge(spells)
 
+        self.timeout = timeout
+        self.clock = clock
+        self.announceSpells = announceSpells
+        self._semaphore = DeferredSemaphore(maxInFlight)
+        self._pending = {}  # {stranger id: deque of [done, event] slots}
+        self.timeouts = 0
+        self.errors = 0
+
+        self._profile = None  # {spell: SpellStats} while profiling
+        self.sampleEvery = 1
+        self._report = None
+
     def __call__(self, events):
         """Cast all spells for each event in an iterable of events.
         """
+        if metrics.enabled:
+            t0 = time()
+            self._transmogrify(events)
+            metrics.histogram('tromegle_transmogrify_seconds', 'Time spent casting spells').since(t0)
+        else:
+            self._transmogrify(events)
+
+    def _transmogrify(self, events):
         if isEvent(events):
             events = (events,)
         for ev in events:
-            for spell in self._spells:
-                ev = spell(self, ev)
-            if ev:  # Functions may return None in order to "blackhole" an event
+            key = self._streamKey(ev)
+            ev = self._cast(ev)
+            if isinstance(ev, Deferred) or key in self._pending:
+                self._enqueue(key, ev)
+            elif ev:  # Functions may return None in order to "blackhole" an event
+                self._emit(ev)
+
+    @staticmethod
+    def _streamKey(ev):
+        if ev.type == MESSAGE_MODIFIED:
+            ev = ev.old
+        return getattr(ev, 'id', None)
+
+    def _enqueue(self, key, ev):
+        """Hold an event until all earlier events from the same stranger
+        have been output.
+        """
+        slot = [False, None]
+        self._pending.setdefault(key, deque()).append(slot)
+        if isinstance(ev, Deferred):
+            ev.addBoth(self._settle, key, slot)
+        else:
+            self._settle(ev, key, slot)
+
+    def _settle(self, ev, key, slot):
+        if isinstance(ev, Failure):
+            log.err(ev, 'Error casting spells; dropping event')
+            ev = None
+
+        slot[:] = True, ev
+        queue = self._pending[key]
+        output = False
+        while queue and queue[0][0]:
+            ev = queue.popleft()[1]
+            if ev:
+                self._emit(ev)
+                output = True
+        if not queue:
+            del self._pending[key]
+
+        if output and self._onOutput is not None:
+            self._onOutput()
+
+    def pending(self):
+        """Return the number of events waiting on asynchronous spells.
+        """
+        return sum(len(q) for q in self._pending.itervalues())
+
+    def _cast(self, ev, after=-1, fired=()):
+        """Cast the spells handling ev, starting after position `after`.
+
+        fired : tuple
+            SpellFiredEvents of the spells which already fired on ev.
+
+        return : event, None, list of events (see _fired) or Deferred
+        """
+        castOne = self._castOne if self._profile is None else self._castProfiled
+        positions, spells = self._chain(ev.type)
+        i = bisect_right(positions, after)
+        while i < len(spells):
+            type_ = ev.type
+            result = castOne(spells[i], ev)
+            if isinstance(result, Deferred):
+                return result.addCallback(self._resume, positions[i], ev, spells[i], fired)
+
+            if self.announceSpells and result != ev:
+                fired += (SpellFiredEvent(spellName(spells[i])),)
+            ev = result
+            if not ev:
+                return self._fired(fired, ev)
+
+            if ev.type == type_:
+                i += 1
+            else:
+                pos = positions[i]
+                positions, spells = self._chain(ev.type)
+                i = bisect_right(positions, pos)
+        return self._fired(fired, ev)
+
+    def _resume(self, result, after, ev, spell, fired):
+        if self.announceSpells and result != ev:
+            fired += (SpellFiredEvent(spellName(spell)),)
+        if not result:
+            return self._fired(fired, result)
+        return self._cast(result, after, fired)
+
+    @staticmethod
+    def _fired(fired, ev):
+        """Return ev preceded by the announcements of the spells which fired
+        on it, as a list.  Return ev unchanged if none did.
+        """
+        if not fired:
+            return ev
+        return list(fired) + ([ev] if ev else [])
+
+    def _emit(self, result):
+        if isinstance(result, list):
+            for ev in result:
                 self.output(ev)
+        else:
+            self.output(result)
+
+    def _castOne(self, spell, ev):
+        mode = getattr(spell, 'spellMode', None)
+        if mode is None:
+            result = spell(self, ev)
+            if isinstance(result, Deferred):
+                result = self._guard(result, ev)
+            return result
+
+        if mode == 'thread':
+            from twisted.internet.threads import deferToThread
+            d = self._semaphore.run(deferToThread, spell, self, ev)
+        else:
+            d = self._semaphore.run(maybeDeferred, spell, self, ev)
+        return self._guard(d, ev)
+
+    def _castProfiled(self, spell, ev):
+        stats = self._profile.get(spell)
+        if stats is None:
+            stats = self._profile[spell] = SpellStats(spellName(spell))
+        stats.calls += 1
+
+        if stats.calls % self.sampleEvery:
+            result = self._castOne(spell, ev)
+            t0 = None
+        else:
+            t0 = time()
+            result = self._castOne(spell, ev)
 
-    def connect(self, eventQueue):
+        if isinstance(result, Deferred):
+            return result.addCallback(self._tally, stats, ev, t0)
+        return self._tally(result, stats, ev, t0)
+
+    @staticmethod
+    def _tally(result, stats, ev, t0):
+        if t0 is not None:
+            dt = time() - t0
+            stats.timed += 1
+            stats.time += dt
+            if dt > stats.maxTime:
+                stats.maxTime = dt
+
+        if not result:
+            stats.blackholed += 1
+        elif result == ev:
+            stats.passed += 1
+        else:
+            stats.modified += 1
+        return result
+
+    def profile(self, enabled=True, sampleEvery=1):
+        """Turn per-spell profiling on or off.
+
+        Calls and outcomes (modified, blackholed or passed through) are
+        always counted; the wall time of only one call in `sampleEvery` is
+        measured.  Asynchronous spells are timed until their result is
+        available.  Turning profiling off discards the counters.
+
+        sampleEvery : int
+        """
+        self.sampleEvery = max(1, int(sampleEvery))
+        if not enabled:
+            self._profile = None
+        elif self._profile is None:
+            self._profile = {}
+
+    def getSpellStats(self):
+        """Get profiling counters, in the order in which spells are cast.
+
+        return : tuple
+            Tuple of dicts (see SpellStats.asdict).  Empty if profiling is
+            off.
+        """
+        if self._profile is None:
+            return ()
+        return tuple((self._profile.get(s) or SpellStats(spellName(s))).asdict() for s in self._spells)
+
+    def formatSpellStats(self):
+        """Return a text table of profiling counters.
+        """
+        lines = ['{0:<24} {1:>8} {2:>10} {3:>10} {4:>9} {5:>10} {6:>8}'.format(
+            'spell', 'calls', 'cum (ms)', 'max (ms)', 'modified', 'blackholed', 'passed')]
+        for s in self.getSpellStats():
+            lines.append('{0:<24} {1:>8} {2:>10.2f} {3:>10.2f} {4:>9} {5:>10} {6:>8}'.format(
+                s['name'][:24], s['calls'], s['cumTime'] * 1e3, s['maxTime'] * 1e3,
+                s['modified'], s['blackholed'], s['passed']))
+        return '\n'.join(lines)
+
+    def startReport(self, interval=60., report=None):
+        """Periodically report profiling counters, enabling profiling if
+        needed.
+
+        interval : float
+            Seconds between reports.
+
+        report : callable or None
+            Called with the text of every report.  Defaults to log.msg.
+        """
+        from twisted.internet.task import LoopingCall
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+
+        if self._profile is None:
+            self.profile()
+        self.stopReport()
+        report = report or log.msg
+        self._report = LoopingCall(lambda: report(self.formatSpellStats()))
+        self._report.clock = self.clock
+        self._report.start(interval, now=False)
+
+    def stopReport(self):
+        if self._report is not None and self._report.running:
+            self._report.stop()
+        self._report = None
+
+    def _guard(self, d, ev):
+        """Return a Deferred firing with the result of d, or with ev if d
+        fails or does not fire within self.timeout seconds.
+        """
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+
+        result = Deferred()
+
+        def timedOut():
+            self.timeouts += 1
+            result.callback(ev)
+
+        def done(value):
+            if timer.active():
+                timer.cancel()
+                result.callback(value)
+
+        def failed(failure):
+            self.errors += 1
+            log.err(failure, 'Spell failed; passing event through')
+            done(ev)
+
+        timer = self.clock.callLater(self.timeout, timedOut)
+        d.addCallbacks(done, failed)
+        return result
+
+    @staticmethod
+    def handles(spell, type_):
+        """Return True if spell is to be cast on events of type type_.
+        """
+        types = getattr(spell, 'eventTypes', None)
+        return types is None or type_ in types
+
+    def _chain(self, type_):
+        chain = self._chains.get(type_)
+        if chain is None:
+            indexed = [(i, s) for i, s in enumerate(self._spells) if self.handles(s, type_)]
+            chain = self._chains[type_] = (tuple(i for i, _ in indexed), tuple(s for _, s in indexed))
+        return chain
+
+    def _rebuildChains(self):
+        self._chains = {}
+        for type_ in EVENT_TYPES:
+            self._chain(type_)
+
+    def connect(self, eventQueue, onOutput=None):
         """Connect Transmogrifier to an eventQueue.
+
+        onOutput : callable or None
+            Called without arguments after asynchronous spells have output
+            events to the queue.
         """
         assert isinstance(eventQueue, deque), 'Event queue must be a deque.'
         self._evQueue = eventQueue
+        self._onOutput = onOutput
 
     def push(self, spell):
         self._spells.append(spell)
+        self._rebuildChains()
 
     def purge(self, spells=()):
         """Remove all spells from the Transmogrifier and optionally assigns
@@ -116,6 +528,7 @@ class Transmogrifier(object):
             Spells to add (in FIFO order).
         """
         self._spells = list(mkIterableSequence(spells))
+        self._rebuildChains()
 
     def getSpells(self):
         """Get spell queue.
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""Local stand-in for the Omegle API, for load testing.
+
+Every client calling `start` is paired with a bot stranger whose behaviour is
+scripted (see ChattyStranger and EchoStranger).  Response latency and errors
+can be injected for every API call.
+
+Usage:
+    python -m tromegle.fakeserver [--port 8080] [--latency 0] [--error-rate 0]
+"""
+import json
+import random
+from argparse import ArgumentParser
+from itertools import count
+from time import time
+
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+from tromegle.event import WAITING, CONNECTED, TYPING, STOPPED_TYPING, GOT_MESSAGE, DISCONNECTED
+
+
+class ChattyStranger(object):
+    """Bot stranger sending numbered messages at a fixed interval.
+
+    Subclass and override the on_* methods to script other behaviour.
+    """
+    def __init__(self, interval=1., messages=None, typing=True):
+        """
+        interval : float
+            Seconds between messages.
+
+        messages : int or None
+            Disconnect after sending this many messages.  None = never.
+
+        typing : bool
+            If True, emit a typing event before every message.
+        """
+        self.interval = interval
+        self.messages = messages
+        self.typing = typing
+
+    def on_start(self, conv):
+        conv.emit(WAITING)
+        conv.emit(CONNECTED)
+        conv.later(self.interval, self.talk, conv, 0)
+
+    def talk(self, conv, n):
+        if not conv.open:
+            return
+        if self.messages is not None and n >= self.messages:
+            conv.emit(DISCONNECTED)
+            return
+
+        if self.typing:
+            conv.emit(TYPING)
+        conv.say('{0} {1}'.format(conv.id, n))
+        conv.later(self.interval, self.talk, conv, n + 1)
+
+    def on_message(self, conv, msg):
+        pass
+
+    def on_typing(self, conv, typing):
+        pass
+
+    def on_disconnect(self, conv):
+        pass
+
+
+class EchoStranger(ChattyStranger):
+    """Bot stranger echoing every message it receives after `delay` seconds.
+    """
+    def __init__(self, delay=0.):
+        super(EchoStranger, self).__init__()
+        self.delay = delay
+
+    def on_start(self, conv):
+        conv.emit(WAITING)
+        conv.emit(CONNECTED)
+
+    def on_message(self, conv, msg):
+        conv.later(self.delay, conv.say, msg)
+
+
+class Conversation(object):
+    """Server-side state for a single client id.
+    """
+    def __init__(self, server, id_, behaviour):
+        self.server = server
+        self.id = id_
+        self.behaviour = behaviour
+        self.open = True
+
+        self.events = []
+        self.poll = None  # held `events` request
+
+    def later(self, delay, fn, *args):
+        reactor.callLater(delay, fn, *args)
+
+    def emit(self, type_, data=None):
+        if not self.open:
+            return
+        self.events.append([type_] if data is None else [type_, data])
+        if type_ == DISCONNECTED:
+            self.open = False
+        self.server.flush(self)
+
+    def say(self, msg):
+        if self.open:
+            self.server.messageEmitted(self, msg)
+            self.emit(GOT_MESSAGE, msg)
+            self.emit(STOPPED_TYPING)
+
+
+class _Action(Resource):
+    isLeaf = True
+
+    def __init__(self, omegle, action):
+        Resource.__init__(self)
+        self.omegle = omegle  # Resource.server is reserved by twisted.web
+        self.action = action
+
+    def render_POST(self, request):
+        self.omegle.requests[self.action] += 1
+        args = dict((k, v[0]) for k, v in request.args.iteritems())
+        self.omegle.delay(self.action, request, args)
+        return NOT_DONE_YET
+
+
+class FakeOmegle(Resource):
+    """Twisted web resource serving the `start`, `events`, `send`, `typing`,
+    `stoppedtyping` and `disconnect` API calls.
+    """
+    def __init__(self, behaviour=ChattyStranger, latency=0., errorRate=0., hold=5.):
+        """
+        behaviour : callable
+            Called with no arguments for every `start`; returns the bot
+            stranger behaviour (e.g. ChattyStranger).
+
+        latency : float or callable
+            Delay (seconds) before answering each request, or a callable
+            taking the action name and returning the delay.
+
+        errorRate : float
+            Probability of answering a request with HTTP 500.
+
+        hold : float
+            Maximum time (seconds) for which an empty `events` poll is held.
+        """
+        Resource.__init__(self)
+        self.behaviour = behaviour
+        self.latency = latency
+        self.errorRate = errorRate
+        self.hold = hold
+
+        self.conversations = {}
+        self.requests = dict((a, 0) for a in ('start', 'events', 'send', 'typing', 'stoppedtyping', 'disconnect'))
+        self.errors = 0
+        self.received = []  # [(message, end-to-end latency)] from `send`
+        self._emitted = {}
+        self._ids = count()
+
+        for action in self.requests:
+            self.putChild(action, _Action(self, action))
+
+    def delay(self, action, request, args):
+        latency = self.latency(action) if callable(self.latency) else self.latency
+        reactor.callLater(latency, self.answer, action, request, args)
+
+    def answer(self, action, request, args):
+        if self.errorRate and random.random() < self.errorRate:
+            self.errors += 1
+            request.setResponseCode(500)
+            request.write('fail')
+            request.finish()
+            return
+
+        conv = self.conversations.get(args.get('id'))
+        if action == 'start':
+            conv = self.start()
+            self.respond(request, json.dumps(conv.id))
+        elif conv is None:
+            self.respond(request, 'fail')
+        elif action == 'events':
+            self.holdPoll(conv, request)
+        elif action == 'send':
+            self.gotMessage(conv, args.get('msg', '').decode('utf-8'))
+            self.respond(request, 'win')
+        elif action in ('typing', 'stoppedtyping'):
+            conv.behaviour.on_typing(conv, action == 'typing')
+            self.respond(request, 'win')
+        elif action == 'disconnect':
+            conv.open = False
+            conv.behaviour.on_disconnect(conv)
+            self.conversations.pop(conv.id, None)
+            self.respond(request, 'win')
+
+    def respond(self, request, body):
+        if not request.finished and not request._disconnected:
+            request.write(body)
+            request.finish()
+
+    def start(self):
+        id_ = 'fake:{0:x}'.format(next(self._ids))
+        conv = self.conversations[id_] = Conversation(self, id_, self.behaviour())
+        conv.behaviour.on_start(conv)
+        return conv
+
+    def holdPoll(self, conv, request):
+        if conv.poll is not None:
+            self.respond(conv.poll, 'null')  # only one poll per client
+        conv.poll = request
+        if conv.events:
+            self.flush(conv)
+        else:
+            reactor.callLater(self.hold, self.release, conv, request)
+
+    def release(self, conv, request):
+        if conv.poll is request:
+            conv.poll = None
+            self.respond(request, 'null')
+
+    def flush(self, conv):
+        if conv.poll is None or not conv.events:
+            return
+        request, conv.poll = conv.poll, None
+        events, conv.events = conv.events, []
+        self.respond(request, json.dumps(events))
+
+    def messageEmitted(self, conv, msg):
+        self._emitted[msg] = time()
+
+    def gotMessage(self, conv, msg):
+        emitted = self._emitted.pop(msg, None)
+        self.received.append((msg, None if emitted is None else time() - emitted))
+        conv.behaviour.on_message(conv, msg)
+
+
+def listen(port=0, interface='127.0.0.1', **kwargs):
+    """Start a FakeOmegle server.
+
+    Additional kwargs are passed to FakeOmegle.
+
+    return : (FakeOmegle, str)
+        Server resource and API base URL to pass to Stranger.setAPIBase.
+    """
+    server = FakeOmegle(**kwargs)
+    site = Site(server)
+    site.noisy = False
+    port = reactor.listenTCP(port, site, interface=interface)
+    return server, 'http://{0}:{1}/'.format(interface, port.getHost().port)
+
+
+def main(argv=None):
+    import sys
+    parser = ArgumentParser(description='Local stand-in for the Omegle API.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--interface', default='127.0.0.1')
+    parser.add_argument('--latency', type=float, default=0.)
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--interval', type=float, default=1., help='seconds between bot messages')
+    args = parser.parse_args(argv)
+
+    log.startLogging(sys.stdout)
+    _, url = listen(args.port, args.interface, latency=args.latency, errorRate=args.error_rate,
+                    behaviour=lambda: ChattyStranger(args.interval))
+    log.msg('Fake Omegle API listening on ' + url)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,10 @@ from functools import wraps
 import Levenshtein as strndist
 import unicodedata
 
+from tromegle.cache import LRUCache
+
+_MISSING = object()
+
 
 def normalize_unicode_(func):
     @wraps(func)
@@ -68,22 +72,111 @@ def fuzzyCaps(n_token, o_token):
     return n_token.lower()
 
 
+_ASCII_LOWER = dict((c, c.lower()) for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+_ASCII_WORD = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+
+
+class StopWordTrie(object):
+    """Character trie of stop phrases, matched with the same semantics as the
+    regex alternation `stop_1\\b|stop_2\\b|...`.
+
+    As with the `re` module (without the UNICODE flag), case folding and word
+    boundaries only consider ASCII characters.
+    """
+    _END = None
+
+    def __init__(self, stop_words, case_sensitive=False):
+        self.case_sensitive = case_sensitive
+        self.root = {}
+        for rank, word in enumerate(stop_words):
+            if not word:
+                continue
+            node = self.root
+            for c in word:
+                node = node.setdefault(self._fold(c), {})
+            node.setdefault(self._END, rank)  # earlier alternatives win
+
+    def _fold(self, c):
+        return c if self.case_sensitive else _ASCII_LOWER.get(c, c)
+
+    def match(self, phrase, pos):
+        """Return the end of the stop phrase starting at phrase[pos], or None.
+
+        When several stop phrases match, the one that came first in
+        `stop_words` wins, like in a regex alternation.
+        """
+        node = self.root
+        best_rank, best_end = None, None
+        end = pos
+        n = len(phrase)
+        while end < n:
+            node = node.get(self._fold(phrase[end]))
+            if node is None:
+                break
+            end += 1
+
+            rank = node.get(self._END)
+            if rank is not None and (best_rank is None or rank < best_rank):
+                # the stop phrase must be followed by a word boundary
+                if end == n:
+                    at_boundary = phrase[end - 1] in _ASCII_WORD
+                else:
+                    at_boundary = (phrase[end - 1] in _ASCII_WORD) != (phrase[end] in _ASCII_WORD)
+                if at_boundary:
+                    best_rank, best_end = rank, end
+
+        return best_end
+
+
 class Tokenizer(object):
+    """Split phrases into whitespace, word and symbol tokens.
+
+    stop_words : iterable
+        Phrases to be kept as a single token (e.g. "I'm").  Stop phrases are
+        matched with a StopWordTrie in a single left-to-right pass unless
+        `trie` is False, in which case a regex alternation is used.
+
+    case_sensitive : bool
+        If True, stop phrases are matched case-sensitively.
+    """
     _other = '\s+|\w+|[^\s\w]+'
+    _other_regex = re.compile(_other)
 
-    def __init__(self, stop_words=set(), case_sensitive=False):
+    def __init__(self, stop_words=set(), case_sensitive=False, trie=True):
         self.case_sensitive = case_sensitive
 
         self.stop_words = stop_words
-        stop_words = '|'.join(re.escape(x) + r'\b' for x in stop_words)
+        ordered = list(stop_words)
+        stop_words = '|'.join(re.escape(x) + r'\b' for x in ordered)
         self.token_regex = stop_words + '|' + self._other if stop_words else self._other
 
+        self.trie = trie and any(ordered)
+        self._tries = {}
+        if self.trie:
+            for cs in (True, False):
+                self._tries[cs] = StopWordTrie(ordered, cs)
+
     def __call__(self, phrase, case_sensitive_override=None):
         case_sensitive = case_sensitive_override if (case_sensitive_override is not None) else self.case_sensitive
-        flag = 0 if case_sensitive else re.IGNORECASE
+        if self.trie:
+            return self._tokenize(phrase, self._tries[bool(case_sensitive)])
 
+        flag = 0 if case_sensitive else re.IGNORECASE
         return re.findall(self.token_regex, phrase, flag)
 
+    def _tokenize(self, phrase, trie):
+        tokens = []
+        pos = 0
+        n = len(phrase)
+        match_other = self._other_regex.match
+        while pos < n:
+            end = trie.match(phrase, pos)
+            if end is None:
+                end = match_other(phrase, pos).end()
+            tokens.append(phrase[pos:end])
+            pos = end
+        return tokens
+
 
 # def tokenize(phrase, stop_words=set()):
 #     """Parse a string into words (strings separated by whitespace.
@@ -157,6 +250,143 @@ def isSymbol(char):
     return not char.isalpha and not char.isdigit and not char.isspace
 
 
+class FuzzyIndex(object):
+    """Symmetric-deletion index for approximate string lookup.
+
+    Two strings within Levenshtein distance `dist` of each other always share
+    a variant obtained by deleting at most `dist` characters from each.  Every
+    key is stored under all of its deletion variants, so that candidate keys
+    for a word are found by hashing instead of by comparing against every key.
+    """
+    def __init__(self, dist=0, keys=()):
+        self.dist = int(dist)
+        self._variants = {}  # {deletion variant: set of keys}
+        for key in keys:
+            self.add(key)
+
+    def __len__(self):
+        return len(self._variants)
+
+    def deletions(self, word):
+        """Return all strings obtained by deleting up to self.dist characters
+        from word (including word itself).
+        """
+        variants = set([word])
+        frontier = variants
+        for _ in xrange(self.dist):
+            frontier = set(w[:i] + w[i + 1:] for w in frontier for i in xrange(len(w)))
+            variants |= frontier
+        return variants
+
+    def add(self, key):
+        for v in self.deletions(key):
+            self._variants.setdefault(v, set()).add(key)
+
+    def remove(self, key):
+        for v in self.deletions(key):
+            keys = self._variants.get(v)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._variants[v]
+
+    def candidates(self, word):
+        """Return the set of keys which may be within self.dist of word.
+
+        The result is a superset of the matching keys; candidates must still
+        be checked with the edit distance function.
+        """
+        found = set()
+        for v in self.deletions(word):
+            keys = self._variants.get(v)
+            if keys:
+                found |= keys
+        return found
+
+
+class RegexSet(object):
+    """Compiled regular expressions matched as few combined patterns.
+
+    Patterns sharing the same flags are joined into a single alternation of
+    named groups, tried in the order in which the patterns were given, so that
+    `match` returns the same pattern as calling re.match on each pattern in
+    turn.  Patterns using backreferences, or which cannot be combined, are
+    matched on their own.
+    """
+    _MAX_GROUPS = 99  # sre supports at most 100 groups per pattern
+    _backref = re.compile(r'\\\d|\(\?P=')
+
+    def __init__(self, patterns=(), positions=None):
+        """
+        patterns : iterable
+            Compiled regular expressions, in matching order.
+
+        positions : iterable of int or None
+            Increasing position of each pattern, reported by `match`.
+            Defaults to 0, 1, 2...
+        """
+        self.patterns = list(patterns)
+        if positions is None:
+            positions = xrange(len(self.patterns))
+
+        chunks = []  # [[n groups, [(position, pattern)]]]
+        open_chunks = {}
+        for pos, p in zip(positions, self.patterns):
+            if not hasattr(p, 'pattern'):
+                raise TypeError('Key must be str, unicode or compiled regex.')
+
+            if p.groups and self._backref.search(p.pattern):
+                chunks.append([p.groups + 1, [(pos, p)]])
+                continue
+
+            key = (p.flags, type(p.pattern))
+            chunk = open_chunks.get(key)
+            if chunk is None or chunk[0] + p.groups + 1 > self._MAX_GROUPS:
+                chunk = open_chunks[key] = [0, []]
+                chunks.append(chunk)
+            chunk[0] += p.groups + 1
+            chunk[1].append((pos, p))
+
+        self._compiled = []  # [(regex, {group name: (position, pattern)})]
+        for _, members in chunks:
+            self._compiled.extend(self._compile(members))
+
+    def _compile(self, members):
+        if len(members) == 1:
+            pos, p = members[0]
+            return [(p, {None: (pos, p)})]
+
+        groups = dict(('_k%d' % pos, (pos, p)) for pos, p in members)
+        try:
+            combined = '|'.join('(?P<_k%d>' % pos + p.pattern + ')' for pos, p in members)
+            return [(re.compile(combined, members[0][1].flags), groups)]
+        except (re.error, UnicodeError):
+            # e.g. conflicting group names; fall back to matching one by one
+            return [(p, {None: (pos, p)}) for pos, p in members]
+
+    def match(self, token, before=None):
+        """Find the first pattern matching token.
+
+        token : str
+            String to match (anchored at the start, like re.match).
+
+        before : int or None
+            Only consider patterns whose position is lower than `before`.
+
+        return : (int, pattern) or None
+            Position and pattern of the first match.
+        """
+        best = None
+        for regex, groups in self._compiled:
+            m = regex.match(token)
+            if m is None:
+                continue
+            pos, p = groups[None] if None in groups else groups[m.lastgroup]
+            if (before is None or pos < before) and (best is None or pos < best[0]):
+                best = pos, p
+        return best
+
+
 class SubstitutionMap(dict):
     """String replacement with fuzzy matching and formatting inference.
 
@@ -183,25 +413,45 @@ class SubstitutionMap(dict):
     case_sensitive : bool
         If True, string comparisons are case-sensitive.
         Defaults to False.
+
+    cache : int
+        Size of the LRU caches holding lookup results (keyed on the
+        normalized token) and fuzzyCaps results.  0 disables caching.
+        Caches are cleared whenever the map is modified.
+        Defaults to 0.
+
+    With the default edit_fn, string keys are held in a FuzzyIndex so that
+    only a handful of edit distances are computed per token.  The index is
+    kept up to date when the map is modified.
     """
     def __init__(self, *args, **kwargs):
         # edit distance function
-        self.edit_fn = kwargs.get('edit_fn') or strndist.distance
+        self.edit_fn = kwargs.pop('edit_fn', None) or strndist.distance
 
         # max levenshtein distance
-        self.dist = kwargs.get('dist') or 0
+        self.dist = kwargs.pop('dist', None) or 0
 
         # case sensitivity
-        self.case_sensitive = kwargs.get('case_sensitive') or False
+        self.case_sensitive = kwargs.pop('case_sensitive', None) or False
+
+        # translation caches
+        cache = kwargs.pop('cache', None) or 0
+        self._lookup_cache = LRUCache(cache) if cache else None
+        self._caps_cache = LRUCache(cache) if cache else None
+
+        self.version = 0
+        self._index = None
+        self._invalidate()
 
-        self.update(*args, **kwargs)
+        super(SubstitutionMap, self).__init__(*args, **kwargs)
         self._convert_to_unicode()
+        self._buildIndex()
 
     def __call__(self, tokens):
         return self.translate(tokens)
 
     def _convert_to_unicode(self):
-        for key in self:
+        for key in list(self):
             value = self.pop(key)
 
             if isinstance(key, str):
@@ -211,26 +461,186 @@ class SubstitutionMap(dict):
 
             self[key] = value
 
+    # Mutators keep the index current
+
+    def __setitem__(self, key, value):
+        new = key not in self
+        dict.__setitem__(self, key, value)
+        if new:
+            self._keyAdded(key)
+        self._invalidate()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._keyRemoved(key)
+        self._invalidate()
+
+    def pop(self, key, *default):
+        present = key in self
+        value = dict.pop(self, key, *default)
+        if present:
+            self._keyRemoved(key)
+            self._invalidate()
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._keyRemoved(key)
+        self._invalidate()
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._buildIndex()
+
+    def clear(self):
+        dict.clear(self)
+        self._buildIndex()
+
+    def _fold(self, s):
+        return s if self.case_sensitive else s.lower()
+
+    def _indexable(self):
+        return self.edit_fn is strndist.distance
+
+    def _buildIndex(self):
+        self._invalidate()
+        if not self._indexable():
+            self._index = None
+            return
+
+        self._index = FuzzyIndex(self.dist)
+        self._folded = {}  # {folded key: [keys]}
+        for key in self:
+            self._keyAdded(key)
+
+    def _keyAdded(self, key):
+        if self._index is None or not isinstance(key, basestring):
+            return
+        folded = self._fold(key)
+        keys = self._folded.setdefault(folded, [])
+        if not keys:
+            self._index.add(folded)
+        keys.append(key)
+
+    def _keyRemoved(self, key):
+        if self._index is None or not isinstance(key, basestring):
+            return
+        folded = self._fold(key)
+        keys = self._folded.get(folded, [])
+        if key in keys:
+            keys.remove(key)
+        if not keys:
+            self._folded.pop(folded, None)
+            self._index.remove(folded)
+
+    def _invalidate(self):
+        """Drop state derived from the contents or iteration order of the map.
+        """
+        self._position = None
+        self._regex = None
+        self.version += 1
+        if self._lookup_cache is not None:
+            self._lookup_cache.clear()
+            self._caps_cache.clear()
+
+    def cacheStats(self):
+        """Return counters of the lookup and fuzzyCaps caches.
+
+        return : dict or None
+            None if caching is disabled.
+        """
+        if self._lookup_cache is None:
+            return None
+        return {'lookup': self._lookup_cache.stats(), 'caps': self._caps_cache.stats()}
+
+    def _prepare(self):
+        if self._position is None:
+            self._position = dict((k, i) for i, k in enumerate(self))
+            regex_keys = [k for k in self if not isinstance(k, basestring)]
+            self._regex = RegexSet(regex_keys, [self._position[k] for k in regex_keys])
+
+    def lookup(self, token):
+        """Find the key matching a token.
+
+        When several keys match, the first one in iteration order wins.
+
+        token : str
+            Token to match.
+
+        return : key or None
+            Matching key (str, unicode or compiled regex), or None.
+        """
+        if self._index is None:
+            return self._lookupLinear(token)
+
+        self._prepare()
+        best, best_pos = None, len(self)
+        for folded in self._index.candidates(self._fold(token)):
+            for key in self._folded[folded]:
+                pos = self._position[key]
+                if pos < best_pos and self.match(key, token):
+                    best, best_pos = key, pos
+
+        regex = self._regex.match(token, best_pos)
+        return regex[1] if regex is not None else best
+
+    def _lookupLinear(self, token):
+        self._prepare()
+        regex = self._regex.match(token)
+        before = regex[0] if regex is not None else len(self)
+        for orig in self:
+            if self._position[orig] >= before:
+                break
+            if isinstance(orig, basestring) and self.match(orig, token):
+                return orig
+        return regex[1] if regex is not None else None
+
     def translate(self, tokens):
         """Translate tokens based on contents of the SubstitutionMap.
 
         tokens : sequence
             Sequence of tokens to be matched and translated.
         """
+        if self._lookup_cache is not None:
+            return self._translateCached(tokens)
+
         out_tokens = []
         for token in tokens:
-            for orig, replace in self.iteritems():
-                if isinstance(orig, str) or isinstance(orig, unicode):
-                    if self.match(orig, token):
-                        token = fuzzyCaps(replace, token)
-                        break  # avoid re-translating the modified token
-                else:
-                    try:
-                        if re.match(orig, token):
-                            token = fuzzyCaps(replace, token)
-                            break
-                    except TypeError:
-                        raise TypeError('Key must be str, unicode or compiled regex.')                        
+            key = self.lookup(token)
+            if key is not None:
+                token = fuzzyCaps(self[key], token)  # never re-translate the modified token
+
+            out_tokens.append(token)
+
+        return ''.join(out_tokens)
+
+    def _translateCached(self, tokens):
+        self._prepare()
+        # regex keys see the raw token, string keys only its folded form
+        normalize = self._fold if not self._regex.patterns else None
+        lookups, caps = self._lookup_cache, self._caps_cache
+
+        out_tokens = []
+        for token in tokens:
+            norm = normalize(token) if normalize is not None else token
+            key = lookups.get(norm, _MISSING)
+            if key is _MISSING:
+                key = self.lookup(token)
+                lookups.put(norm, key)
+
+            if key is not None:
+                replace = self[key]
+                new = caps.get((replace, token))
+                if new is None:
+                    new = fuzzyCaps(replace, token)
+                    caps.put((replace, token), new)
+                token = new
 
             out_tokens.append(token)
 
@@ -1,4 +1,7 @@
 #!/usr/bin/env python
+import sys
+from collections import deque
+from weakref import ref
 
 from blessings import Terminal
 from tromegle.core import CBDictInterface
@@ -49,17 +52,61 @@ class Viewport(CBDictInterface):
 
 class InteractiveViewport(CBDictInterface):
     """Interface for printing conversations, with intelligent formatting.
+
+    By default every line is written as soon as it is formatted.  If `fps`
+    is set, lines are buffered and written in a single call at most `fps`
+    times per second, so that busy conversations do not throttle the
+    reactor with terminal I/O.
     """
-    def __init__(self, callbackdict=None):
+    def __init__(self, callbackdict=None, fps=None, stream=None, clock=None):
+        """
+        fps : float or None
+            Maximum number of writes per second.  None = write immediately.
+
+        stream : file-like object or None
+            Output stream.  Defaults to sys.stdout.
+
+        clock : IReactorTime provider or None
+            Used to schedule buffered writes.  Defaults to the reactor.
+        """
         super(InteractiveViewport, self).__init__(callbackdict)
         self.strangers = {}
         self.ready = 0  # no strangers connected
 
-        self.term = Terminal()
+        self.stream = stream
+        self.term = Terminal(stream=stream)
         sc = [self.term.color(i) for i in xrange(1, 7)]
         self.strangerColLabels = tuple(sc)  # tweak order of colors
         self.strangerColors = {}
 
+        # escape sequences, looked up once
+        t = self.term
+        self._notification = (t.red, t.normal)
+        self._correction = (t.cyan, t.normal)
+        self._error = (u"{t.bold}{t.red_on_white}".format(t=t), u"{t.normal}{t.red_on_white}".format(t=t), t.normal)
+        self._prefixes = {}  # {stranger id: formatted "Stranger n: "}
+
+        self.fps = fps
+        self._frame = []
+        self._flushCall = None
+        self._lastFlush = 0.
+        self._clock = clock
+        if fps and hasattr(self.clock, 'addSystemEventTrigger'):
+            self.clock.addSystemEventTrigger('before', 'shutdown', self.flush)
+
+    @property
+    def clock(self):
+        if self._clock is None:
+            from twisted.internet import reactor
+            self._clock = reactor
+        return self._clock
+
+    def forget(self):
+        """Forget the strangers of the current conversation.
+        """
+        self.strangers.clear()
+        self._prefixes.clear()
+
     def on_idSet(self, ev):
         tag = 'Stranger {0}'.format(len(self.strangers.keys()) + 1)
         self.strangers[ev.id] = tag
@@ -75,6 +122,7 @@ class InteractiveViewport(CBDictInterface):
 
         self.ready += 1
         self.strangerColors[ev.id] = self.strangerColLabels[self.ready % len(self.strangerColLabels)]
+        self._prefixes.pop(ev.id, None)
         if self.ready == len(self.strangers.keys()):
             self.write('')
             self.ready = 0
@@ -82,7 +130,7 @@ class InteractiveViewport(CBDictInterface):
     def on_strangerDisconnected(self, ev):
         output = self.strangers[ev.id] + " has disconnected"
         self.write(self.formatNotification(output), '')  # print empty string to skip a line
-        self.strangers.clear()
+        self.forget()
 
     def on_error(self, ev):
         self.write(self.formatError(ev.id, ev.data))
@@ -92,14 +140,25 @@ class InteractiveViewport(CBDictInterface):
 
     def on_timeout(self, ev):
         self.write(self.formatNotification("Idle timeout."))
-        self.strangers.clear()
+        self.forget()
 
     def on_messageModified(self, ev):
         mod_string, orig_string = self.formatCorrection(ev.old.id, ev.data, ev.old.data)
         self.write(mod_string, orig_string)
 
     def formatNotification(self, string):
-        return u"{t.red}{msg}{t.normal}".format(t=self.term, msg=string)
+        start, end = self._notification
+        return u"{0}{1}{2}".format(start, string, end)
+
+    def prefix(self, sid):
+        """Return the formatted "Stranger n: " prefix of a stranger's
+        messages.
+        """
+        prefix = self._prefixes.get(sid)
+        if prefix is None:
+            prefix = self._prefixes[sid] = u"{t.bold}{color}{strngr}: {t.normal}".format(
+                t=self.term, color=self.strangerColors.get(sid, u''), strngr=self.strangers[sid])
+        return prefix
 
     def formatMessage(self, sid, msg):
         """Return a string with standard Omegle message formatting.
@@ -110,34 +169,198 @@ class InteractiveViewport(CBDictInterface):
         msg : str
             Message body.
         """
-        strngrName = self.strangers[sid]
-        return u"{t.bold}{color}{strngr}: {t.normal}{msg}".format(t=self.term, color=self.strangerColors[sid], strngr=strngrName, msg=msg)
+        return self.prefix(sid) + msg
 
     def formatCorrection(self, stranger_id, mod_string, orig_string):
         mod_string = self.formatMessage(stranger_id, mod_string)
 
         indent = ' ' * len(self.strangers[stranger_id])
-        orig_string = u"{t.cyan}{0}  {msg}{t.normal}".format(indent, t=self.term, msg=orig_string)
+        start, end = self._correction
+        orig_string = u"{0}{1}  {msg}{2}".format(start, indent, end, msg=orig_string)
         return mod_string, orig_string
 
     def formatError(self, sid, err_msg):
-        return u"{t.bold}{t.red_on_white}ERROR <{s}>: {t.normal}{t.red_on_white}{msg}{t.normal}".format(t=self.term, s=self.strangers[sid], msg=err_msg)
+        bold, plain, end = self._error
+        return u"{0}ERROR <{s}>: {1}{msg}{2}".format(bold, plain, end, s=self.strangers[sid], msg=err_msg)
 
     def write(self, *args):
         """Print message to output.
         """
-        for msg in args:
-            print msg
+        if not self.fps:
+            self.output(args)
+            return
+
+        self._frame.extend(args)
+        if self._flushCall is None:
+            delay = max(0., self._lastFlush + 1. / self.fps - self.clock.seconds())
+            self._flushCall = self.clock.callLater(delay, self.flush)
+
+    def flush(self):
+        """Write buffered lines.
+        """
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        self._lastFlush = self.clock.seconds()
+
+        frame, self._frame = self._frame, []
+        if frame:
+            self.output(frame)
+
+    def output(self, lines):
+        """Write lines to the output stream in a single call.
+        """
+        stream = self.stream or sys.stdout
+        data = u'\n'.join(l if isinstance(l, unicode) else l.decode('utf-8', 'replace') for l in lines) + u'\n'
+        stream.write(data.encode(getattr(stream, 'encoding', None) or 'utf-8', 'replace'))
+        stream.flush()
+
+
+class _Panel(InteractiveViewport):
+    """Per-session InteractiveViewport drawing into a Dashboard region.
+    """
+    def __init__(self, dashboard, title):
+        super(_Panel, self).__init__(stream=dashboard.stream)
+        self.dashboard = dashboard
+        self.title = title
+        self.lines = deque(maxlen=dashboard.rows)
+        self.messages = 0
+
+    def on_gotMessage(self, ev):
+        self.messages += 1
+        super(_Panel, self).on_gotMessage(ev)
+
+    def on_messageModified(self, ev):
+        self.messages += 1
+        super(_Panel, self).on_messageModified(ev)
+
+    def write(self, *args):
+        self.lines.extend(l for l in args if l)
+        self.dashboard.invalidate(self)
+
+
+class DashboardViewport(object):
+    """Terminal dashboard showing many sessions at once.
+
+    Every session gets a fixed region showing its latest lines.  Regions are
+    redrawn at most `fps` times per second, and only if they changed.  Use
+    `panel` as the `perSession` factory of a SessionManager:
+
+        dashboard = DashboardViewport()
+        manager = SessionManager(n=8, perSession=dashboard.panel)
+    """
+    def __init__(self, rows=5, fps=10., stream=None, clock=None):
+        """
+        rows : int
+            Number of conversation lines per session.
+
+        fps : float
+            Maximum number of redraws per second.
+
+        stream : file-like object or None
+            Output stream.  Defaults to sys.stdout.
+
+        clock : IReactorTime provider or None
+            Defaults to the reactor.
+        """
+        self.rows = rows
+        self.fps = fps
+        self.stream = stream
+        self.term = Terminal(stream=stream, force_styling=True)  # cursor movement is required
+        self._clock = clock
+
+        self._panels = []  # weak references, in region order
+        self._dirty = set()
+        self._layout = None
+        self._drawCall = None
+        self._lastDraw = 0.
+
+    clock = InteractiveViewport.clock
+
+    def panel(self):
+        """Return a listener drawing a new session into its own region.
+        """
+        p = _Panel(self, 'Session {0}'.format(len(self._panels) + 1))
+        self._panels.append(ref(p))
+        self.invalidate(p)
+        return p
+
+    def invalidate(self, panel):
+        self._dirty.add(id(panel))
+        if self._drawCall is None:
+            delay = max(0., self._lastDraw + 1. / self.fps - self.clock.seconds())
+            self._drawCall = self.clock.callLater(delay, self.draw)
+
+    def draw(self):
+        """Redraw the regions that changed since the last draw, or the whole
+        screen if sessions were added or removed.
+        """
+        self._drawCall = None
+        self._lastDraw = self.clock.seconds()
+
+        live = [r for r in self._panels if r() is not None]
+        layout = tuple(id(r) for r in live)
+        full = layout != self._layout
+        self._panels, self._layout = live, layout
+
+        t = self.term
+        out = [t.clear] if full else []
+        height = self.rows + 2
+        for i, r in enumerate(live):
+            p = r()
+            if not full and id(p) not in self._dirty:
+                continue
+            top = i * height
+            out.append(u'{0}{1}{t.bold}{2}{t.normal} ({3} messages){1}'.format(
+                t.move(top, 0), t.clear_eol, p.title, p.messages, t=t))
+            lines = list(p.lines)
+            for row in xrange(self.rows):
+                line = lines[row] if row < len(lines) else u''
+                out.append(u'{0}{1}{2}'.format(t.move(top + 1 + row, 0), line, t.clear_eol))
+        out.append(t.move(len(live) * height, 0))
+        self._dirty.clear()
+
+        stream = self.stream or sys.stdout
+        data = u''.join(l if isinstance(l, unicode) else l.decode('utf-8', 'replace') for l in out)
+        stream.write(data.encode(getattr(stream, 'encoding', None) or 'utf-8', 'replace'))
+        stream.flush()
 
 
 class ClientViewport(CBDictInterface):
     pass
 
 
+def mkLogWriter(handler, background=False, queueSize=10000, overflow='drop_new'):
+    """Return the handler to attach to a logger: `handler` itself, or a
+    BackgroundHandler writing to it from a separate thread.
+
+    handler : logging.Handler
+
+    background : bool
+        If True, records are queued and written by a background thread, so
+        that slow disks do not stall the reactor.
+
+    queueSize : int
+        Maximum number of queued records (background mode only).
+
+    overflow : str
+        Policy when the queue is full: 'drop_new', 'drop_old' or 'block'
+        (see BackgroundHandler).
+    """
+    if not background:
+        return handler
+
+    from tromegle.logwriter import BackgroundHandler
+    return BackgroundHandler(handler, queueSize=queueSize, overflow=overflow)
+
+
 class EventLogger(object):
     """Class to log Tromegle events for debugging purposes.
+
+    Set `background` to write from a separate thread (see mkLogWriter).
     """
-    def __init__(self, logfile='tromegleEvents.log', backupCount=2, maxbytes=200):
+    def __init__(self, logfile='tromegleEvents.log', backupCount=2, maxbytes=200,
+                 background=False, queueSize=10000, overflow='drop_new'):
         import logging
         import logging.handlers
         self.file = logfile
@@ -146,16 +369,20 @@ class EventLogger(object):
         self.handler = logging.handlers.RotatingFileHandler(self.file,
                                                             maxBytes=maxbytes,
                                                             backupCount=backupCount)
-        self.logger.addHandler(self.handler)
+        self.writer = mkLogWriter(self.handler, background, queueSize, overflow)
+        self.logger.addHandler(self.writer)
 
     def notify(self, ev):
         self.logger.debug('{0}'.format(ev))
 
 
 class MessageLogger(CBDictInterface):
+    """Class to log conversations, one file per conversation.
+
+    Set `background` to write from a separate thread (see mkLogWriter).
     """
-    """
-    def __init__(self, logfile='chat.log', backupCount=10, maxbytes=0, callbackdict=None):
+    def __init__(self, logfile='chat.log', backupCount=10, maxbytes=0, callbackdict=None,
+                 background=False, queueSize=10000, overflow='drop_new'):
         super(MessageLogger, self).__init__(callbackdict)
         self.strangers = {}
 
@@ -168,7 +395,8 @@ class MessageLogger(CBDictInterface):
         self.handler = logging.handlers.RotatingFileHandler(self.file,
                                                             maxBytes=maxbytes,
                                                             backupCount=backupCount)
-        self.logger.addHandler(self.handler)
+        self.writer = mkLogWriter(self.handler, background, queueSize, overflow)
+        self.logger.addHandler(self.writer)
 
     def on_idSet(self, ev):
         tag = 'Stranger {0}'.format(len(self.strangers.keys()) + 1)
@@ -176,7 +404,7 @@ class MessageLogger(CBDictInterface):
 
     def on_connected(self, ev):
         if self.lognum:
-            self.handler.doRollover()
+            self.rollover()
         self.lognum += 1
 
     def on_strangerDisconnected(self, ev):
@@ -191,6 +419,12 @@ class MessageLogger(CBDictInterface):
         orig_string = "{0}  {1}".format('' * len(stranger), ev.old.data)
         self.log(mod_string, orig_string)
 
+    def rollover(self):
+        if self.writer is self.handler:
+            self.handler.doRollover()
+        else:
+            self.writer.rollover()  # after the queued records
+
     def log(self, *args):
         for msg in args:
             self.logger.debug(msg)
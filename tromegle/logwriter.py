@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+import sys
+import logging
+import traceback
+from collections import deque
+from threading import Condition, Thread
+from time import time
+
+from logging.handlers import BaseRotatingHandler, RotatingFileHandler
+
+OVERFLOW_POLICIES = ('drop_new', 'drop_old', 'block')
+
+_ROLLOVER = object()  # control message
+
+
+class BackgroundHandler(logging.Handler):
+    """Logging handler writing records to a target handler from a background
+    thread.
+
+    Records are put on a bounded queue, so that the calling (reactor) thread
+    never waits on the disk.  The writer thread drains the queue in batches,
+    writing each batch with a single call and flushing at most once every
+    `flushInterval` seconds.  File rotation also happens in the writer
+    thread.
+
+    Records are formatted by the writer thread, so their arguments must not
+    be mutated after logging.
+    """
+    def __init__(self, target, queueSize=10000, overflow='drop_new', batchSize=256, flushInterval=1.):
+        """
+        target : logging.Handler
+            Handler doing the actual writing, e.g. a RotatingFileHandler.
+            Only the background thread may use it once wrapped.
+
+        queueSize : int
+            Maximum number of queued records.
+
+        overflow : str
+            What to do with a record when the queue is full.
+            'drop_new' = drop the record, 'drop_old' = drop the oldest queued
+            record, 'block' = wait for room in the queue.
+
+        batchSize : int
+            Maximum number of records written at once.
+
+        flushInterval : float
+            Maximum time (seconds) for which written records stay buffered.
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of {0}'.format(', '.join(OVERFLOW_POLICIES)))
+
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queueSize = queueSize
+        self.overflow = overflow
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.rollovers = 0
+        self.errors = 0
+        self.maxDepth = 0
+
+        self._queue = deque()
+        self._records = 0  # queued records, excluding control messages
+        self._cond = Condition()
+        self._closed = False
+
+        self._thread = Thread(target=self._run, name='tromegle-logwriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        self._put(record)
+
+    def rollover(self):
+        """Rotate the target file once every record queued so far has been
+        written.  Never dropped, whatever the overflow policy.
+        """
+        self._put(_ROLLOVER)
+
+    def depth(self):
+        """Return the number of queued records.
+        """
+        return self._records
+
+    def stats(self):
+        """Return writer counters.
+
+        return : dict
+        """
+        return {'depth': self._records,
+                'maxDepth': self.maxDepth,
+                'enqueued': self.enqueued,
+                'written': self.written,
+                'dropped': self.dropped,
+                'batches': self.batches,
+                'rollovers': self.rollovers,
+                'errors': self.errors}
+
+    def close(self):
+        """Write every queued record, stop the writer thread and close the
+        target handler.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+        self.target.close()
+        logging.Handler.close(self)
+
+    def _put(self, item):
+        control = item is _ROLLOVER
+        with self._cond:
+            if self._closed:
+                self.dropped += not control
+                return
+
+            if not control and self._records >= self.queueSize:
+                if self.overflow == 'drop_new':
+                    self.dropped += 1
+                    return
+                elif self.overflow == 'drop_old':
+                    self._dropOldest()
+                else:
+                    while self._records >= self.queueSize and not self._closed:
+                        self._cond.wait()
+
+            self._queue.append(item)
+            if not control:
+                self._records += 1
+                self.enqueued += 1
+                self.maxDepth = max(self.maxDepth, self._records)
+            self._cond.notify_all()
+
+    def _dropOldest(self):
+        for i, item in enumerate(self._queue):
+            if item is not _ROLLOVER:
+                del self._queue[i]
+                self._records -= 1
+                self.dropped += 1
+                return
+
+    def _take(self):
+        with self._cond:
+            if not self._queue and not self._closed:
+                self._cond.wait(self.flushInterval)
+
+            batch = []
+            while self._queue and len(batch) < self.batchSize:
+                item = self._queue.popleft()
+                batch.append(item)
+                self._records -= item is not _ROLLOVER
+            self._cond.notify_all()  # wake producers blocked on a full queue
+            return batch, self._closed and not self._queue
+
+    def _run(self):
+        lastFlush = time()
+        dirty = False
+        while True:
+            batch, done = self._take()
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception:
+                    self.errors += 1
+                    if logging.raiseExceptions:
+                        traceback.print_exc(file=sys.stderr)
+                dirty = True
+
+            if dirty and (done or time() - lastFlush >= self.flushInterval):
+                self.target.flush()
+                lastFlush = time()
+                dirty = False
+
+            if done:
+                return
+
+    def _write(self, batch):
+        target = self.target
+        if not isinstance(target, logging.StreamHandler):
+            for item in batch:
+                if item is _ROLLOVER:
+                    self._rollover()
+                else:
+                    target.handle(item)
+                    self.written += 1
+            self.batches += 1
+            return
+
+        maxBytes = target.maxBytes if isinstance(target, RotatingFileHandler) else 0
+        encoding = getattr(target, 'encoding', None) or 'utf-8'
+
+        target.acquire()
+        try:
+            if target.stream is None:  # delayed open
+                target.stream = target._open()
+            if maxBytes:
+                target.stream.seek(0, 2)
+                size = target.stream.tell()
+
+            chunks = []
+            for item in batch:
+                if item is _ROLLOVER:
+                    target.stream.write(''.join(chunks))
+                    chunks = []
+                    self._rollover()
+                    size = 0
+                    continue
+
+                msg = target.format(item)
+                if isinstance(msg, unicode):
+                    msg = msg.encode(encoding)
+                msg += '\n'
+
+                if maxBytes:
+                    if size + len(msg) >= maxBytes:
+                        target.stream.write(''.join(chunks))
+                        chunks = []
+                        self._rollover()
+                        size = 0
+                    size += len(msg)
+                chunks.append(msg)
+                self.written += 1
+
+            target.stream.write(''.join(chunks))
+            self.batches += 1
+        finally:
+            target.release()
+
+    def _rollover(self):
+        if isinstance(self.target, BaseRotatingHandler):
+            self.target.doRollover()
+            if self.target.stream is None:
+                self.target.stream = self.target._open()
+            self.rollovers += 1
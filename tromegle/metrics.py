@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""Counters and timing histograms for Tromegle internals.
+
+Instrumentation is disabled by default; call sites check the module-level
+`enabled` flag before doing any work, so that disabled metrics cost a single
+attribute lookup.  Metrics can be read in-process (`snapshot`) or pulled over
+HTTP or a Unix socket in the Prometheus text exposition format (`listen`,
+`listenUNIX`).
+
+Instrumented stages:
+    tromegle_request_seconds{action}        HTTP round trip (Stranger.request)
+    tromegle_request_errors_total{action}   failed HTTP requests
+    tromegle_decode_seconds                 event JSON decoding
+    tromegle_transmogrify_seconds           Transmogrifier.__call__
+    tromegle_listener_seconds{listener}     listener.notify
+    tromegle_relay_seconds                  gotMessage receipt to sendMessage
+    tromegle_send_seconds{action}           Outbox queueing to acknowledgement
+    tromegle_outbox_depth                   Outbox requests queued or in flight
+"""
+from bisect import bisect_left
+from time import time
+
+enabled = False
+
+DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+def enable(flag=True):
+    """Turn instrumentation on or off.
+    """
+    global enabled
+    enabled = flag
+
+
+class Counter(object):
+    __slots__ = ('value',)
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def asdict(self):
+        return self.value
+
+
+class Histogram(object):
+    """Cumulative histogram with fixed bucket upper bounds.
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+    kind = 'histogram'
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last bucket is +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def since(self, t0):
+        """Observe the time elapsed since t0 (as returned by time.time).
+        """
+        self.observe(time() - t0)
+
+    def cumulative(self):
+        total = 0
+        for bound, n in zip(self.bounds + (float('inf'),), self.counts):
+            total += n
+            yield bound, total
+
+    def asdict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'buckets': list(self.cumulative())}
+
+
+class Registry(object):
+    """Named metrics, each with any number of label sets.
+    """
+    def __init__(self):
+        self._metrics = {}  # {(name, labels): metric}
+        self._help = {}
+
+    def _get(self, cls, name, doc, labels, *args):
+        key = (name, tuple(sorted(labels.iteritems())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = cls(*args)
+            if doc:
+                self._help[name] = doc
+        return metric
+
+    def counter(self, name, doc='', **labels):
+        """Return the counter for a name and label set, creating it if
+        needed.
+        """
+        return self._get(Counter, name, doc, labels)
+
+    def histogram(self, name, doc='', bounds=DEFAULT_BUCKETS, **labels):
+        """Return the histogram for a name and label set, creating it if
+        needed.
+        """
+        return self._get(Histogram, name, doc, labels, bounds)
+
+    def clear(self):
+        self._metrics.clear()
+
+    def snapshot(self):
+        """Return the current value of every metric.
+
+        return : dict
+            {name: {labels: value}}, where labels is a tuple of (key, value)
+            pairs and value is an int (counters) or a dict (histograms).
+        """
+        snap = {}
+        for (name, labels), metric in self._metrics.items():
+            snap.setdefault(name, {})[labels] = metric.asdict()
+        return snap
+
+    def expose(self):
+        """Return every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        byName = {}
+        for (name, labels), metric in self._metrics.items():
+            byName.setdefault(name, []).append((labels, metric))
+
+        for name in sorted(byName):
+            series = sorted(byName[name])
+            if name in self._help:
+                lines.append('# HELP {0} {1}'.format(name, self._help[name]))
+            lines.append('# TYPE {0} {1}'.format(name, series[0][1].kind))
+            for labels, metric in series:
+                if metric.kind == 'counter':
+                    lines.append('{0}{1} {2}'.format(name, _labels(labels), metric.value))
+                    continue
+                for bound, n in metric.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels + (('le', le),)), n))
+                lines.append('{0}_sum{1} {2!r}'.format(name, _labels(labels), metric.sum))
+                lines.append('{0}_count{1} {2}'.format(name, _labels(labels), metric.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = ((k, unicode(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')) for k, v in labels)
+    return u'{' + u','.join(u'{0}="{1}"'.format(k, v) for k, v in escaped).encode('utf-8') + '}'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+snapshot = REGISTRY.snapshot
+expose = REGISTRY.expose
+
+
+def _site(registry):
+    from twisted.web.resource import Resource
+    from twisted.web.server import Site
+
+    class Metrics(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader('content-type', 'text/plain; version=0.0.4')
+            return registry.expose()
+
+    site = Site(Metrics())
+    site.noisy = False
+    return site
+
+
+def listen(port=9464, interface='127.0.0.1', registry=REGISTRY):
+    """Serve metrics over HTTP.  Also enables instrumentation.
+
+    return : IListeningPort
+    """
+    from twisted.internet import reactor
+    enable()
+    return reactor.listenTCP(port, _site(registry), interface=interface)
+
+
+def listenUNIX(path, registry=REGISTRY):
+    """Serve metrics over HTTP on a Unix socket.  Also enables
+    instrumentation.
+
+    return : IListeningPort
+    """
+    from twisted.internet import reactor
+    enable()
+    return reactor.listenUNIX(path, _site(registry))
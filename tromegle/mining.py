@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""Aggregates over recorded conversations, used by troll.OMiner.
+
+Every unit of work (an archive segment or a MessageLogger file) is mined
+independently into a Stats instance; Stats from different units are merged.
+"""
+import re
+import math
+import hashlib
+import os
+from collections import Counter
+
+from tromegle.archive import Segment
+from tromegle.event import ID_SET, CONNECTED, GOT_MESSAGE, DISCONNECTED, IDLE_TIMEOUT, MESSAGE_MODIFIED, SPELL_FIRED
+
+ARCHIVE = 'archive'
+CHATLOG = 'chatlog'
+
+_LOG_MESSAGE = re.compile(r'^Stranger (\d+): ')
+_LOG_DISCONNECT = re.compile(r'^Stranger (\d+) disconnected$')
+
+
+def bucket(x):
+    """Return the smallest power of two (seconds) not below x, used to bin
+    durations.
+    """
+    if x <= 0:
+        return 0.
+    return 2. ** math.ceil(math.log(x, 2))
+
+
+class Stats(object):
+    """Mergeable aggregates over a set of conversations.
+
+    counts : Counter
+        conversations, events, messages, modified (messages altered by
+        spells), and events per type ('type:<event type>').
+
+    lengths : Counter
+        {messages per conversation: conversations}
+
+    durations : Counter
+        {duration bucket (seconds): conversations}
+
+    firstMessage : Counter
+        {time from connection to first message, bucketed: conversations}
+
+    disconnects : Counter
+        {reason: conversations}.  Reasons are 'stranger 1' or 'stranger 2'
+        (who left), 'idle timeout' and 'unfinished'.
+
+    spells : Counter
+        {spell name: times fired}, from the spellFired events announced by
+        the Transmogrifier.  Only available for archived conversations
+        recorded with Transmogrifier(announceSpells=True).
+    """
+    _FIELDS = ('counts', 'lengths', 'durations', 'firstMessage', 'disconnects', 'spells')
+
+    def __init__(self):
+        for f in self._FIELDS:
+            setattr(self, f, Counter())
+
+    def merge(self, other):
+        """Add the aggregates of another Stats instance into this one.
+
+        return : Stats
+            self
+        """
+        for f in self._FIELDS:
+            getattr(self, f).update(getattr(other, f))
+        return self
+
+    def asdict(self):
+        """Return a JSON-serializable representation.
+        """
+        return dict((f, getattr(self, f).items()) for f in self._FIELDS)
+
+    @classmethod
+    def fromdict(cls, d):
+        stats = cls()
+        for f in cls._FIELDS:
+            getattr(stats, f).update(dict((k, v) for k, v in d.get(f, ())))
+        return stats
+
+    def meanFirstMessage(self):
+        n = self.counts['firstMessageCount']
+        return self.counts['firstMessageTotal'] / n if n else float('nan')
+
+    def addConversation(self, events):
+        """Aggregate a single archived conversation.
+
+        events : iterable of (float, event)
+        """
+        c = self.counts
+        c['conversations'] += 1
+
+        order = []  # stranger ids, in idSet order
+        messages = 0
+        first = last = connected = firstMessage = None
+        lastEvent = None
+        for ts, ev in events:
+            if ev.type == SPELL_FIRED:
+                self.spells[ev.data] += 1
+                continue
+
+            c['events'] += 1
+            c['type:' + ev.type] += 1
+            if first is None:
+                first = ts
+            last = ts
+            lastEvent = ev
+
+            if ev.type == ID_SET:
+                order.append(ev.id)
+            elif ev.type == CONNECTED and connected is None:
+                connected = ts
+            elif ev.type in (GOT_MESSAGE, MESSAGE_MODIFIED):
+                messages += 1
+                c['messages'] += 1
+                c['modified'] += ev.type == MESSAGE_MODIFIED
+                if firstMessage is None:
+                    firstMessage = ts
+
+        self.lengths[messages] += 1
+        if first is not None:
+            self.durations[bucket(last - first)] += 1
+        if firstMessage is not None:
+            dt = firstMessage - (first if connected is None else connected)
+            self.firstMessage[bucket(dt)] += 1
+            c['firstMessageTotal'] += dt
+            c['firstMessageCount'] += 1
+
+        if lastEvent is None:
+            reason = 'unfinished'
+        elif lastEvent.type == DISCONNECTED:
+            pos = order.index(lastEvent.id) + 1 if lastEvent.id in order else 0
+            reason = 'stranger {0}'.format(pos) if pos else 'stranger ?'
+        elif lastEvent.type == IDLE_TIMEOUT:
+            reason = 'idle timeout'
+        else:
+            reason = 'unfinished'
+        self.disconnects[reason] += 1
+
+    def addChatLog(self, lines):
+        """Aggregate a single conversation logged by MessageLogger.
+
+        MessageLogger records neither timestamps nor connection events, so
+        only message counts, lengths and disconnect reasons are available.
+
+        lines : iterable of str
+        """
+        c = self.counts
+        c['conversations'] += 1
+
+        messages = 0
+        reason = 'unfinished'
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            c['events'] += 1
+            if line.startswith('  '):  # original text of the previous message
+                c['modified'] += 1
+                continue
+
+            m = _LOG_DISCONNECT.match(line)
+            if m:
+                reason = 'stranger {0}'.format(m.group(1))
+            elif _LOG_MESSAGE.match(line):
+                messages += 1
+                c['messages'] += 1
+
+        self.lengths[messages] += 1
+        self.disconnects[reason] += 1
+
+
+def unitKey(kind, filename):
+    """Return the key under which a unit of work is recorded as processed.
+
+    Archive segments are immutable once finalized, so they are identified
+    by name.  MessageLogger files are renamed on every rollover, so they are
+    identified by content and inode, which survives renaming: two files
+    holding identical conversations are still mined separately.
+    """
+    if kind == ARCHIVE:
+        return os.path.abspath(filename)
+    with open(filename, 'rb') as f:
+        st = os.fstat(f.fileno())
+        return 'sha1:{0}:{1}:{2}'.format(hashlib.sha1(f.read()).hexdigest(), st.st_dev, st.st_ino)
+
+
+def mineUnit(unit):
+    """Mine a single (kind, filename) unit.  Run in worker processes.
+
+    return : (str, dict)
+        Unit key and Stats.asdict().
+    """
+    kind, filename, key = unit
+    stats = Stats()
+    if kind == ARCHIVE:
+        seg = Segment(filename)
+        try:
+            for _, events in seg.iterConversations():
+                stats.addConversation(events)
+        finally:
+            seg.close()
+    else:
+        with open(filename, 'rb') as f:
+            stats.addChatLog(line.decode('utf-8', 'replace') for line in f)
+    return key, stats.asdict()
@@ -1,44 +1,545 @@
 #!/usr/bin/env python
 from urllib import urlencode
+from urlparse import urlparse
 import json
+from collections import deque
 from random import choice
+from time import time
 try:
     from cStringIO import StringIO
 except:
     from StringIO import StringIO
 
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import CancelledError, Deferred, DeferredSemaphore, fail
 from twisted.internet.protocol import Protocol
 from twisted.internet.error import TimeoutError
-from twisted.web.client import Agent, FileBodyProducer
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool
 from twisted.web.http_headers import Headers
 
-from tromegle.event import OmegleEvent, ID_SET, TIMEOUT_EVENT
+from tromegle import metrics
+from tromegle.event import OmegleEvent, ID_SET, TIMEOUT_EVENT, DISCONNECTED
+
+
+class BodyTooLarge(Exception):
+    """Raised when a response body exceeds the maximum allowed size.
+    """
 
 
 class HTTP(Protocol):
-    def __init__(self, response):
+    """Body protocol collecting a response body into a string.
+
+    Chunks are accumulated in a list and joined once, when the body is
+    complete.  Bodies larger than `maxSize` bytes are aborted and the
+    response Deferred fails with BodyTooLarge.
+    """
+    maxSize = 1 << 20
+
+    def __init__(self, response, maxSize=None):
         self.response = response
-        self.data = ''
+        if maxSize is not None:
+            self.maxSize = maxSize
+
+        self._chunks = []
+        self._size = 0
+        self._aborted = False
+
+    @property
+    def data(self):
+        return ''.join(self._chunks)
 
     def dataReceived(self, bytes):
-        self.data += bytes
+        if self._aborted:
+            return
+
+        self._size += len(bytes)
+        if self.maxSize and self._size > self.maxSize:
+            self._aborted = True
+            self.transport.stopProducing()
+            self.response.errback(BodyTooLarge('Response body exceeds {0} bytes'.format(self.maxSize)))
+            return
+
+        self.chunkReceived(bytes)
+
+    def chunkReceived(self, bytes):
+        self._chunks.append(bytes)
 
     def connectionLost(self, reason):
-        self.response.callback(self.data)
+        if not self._aborted:
+            self.response.callback(self.finish())
+
+    def finish(self):
+        """Return the value with which the response Deferred is fired.
+        """
+        return self.data
+
+
+class EventDecoder(object):
+    """Incremental decoder for the JSON array returned by the `events` API call.
+
+    Raw events are returned by `feed` as soon as the closing bracket of each
+    one has been received, without waiting for the rest of the body.
+    """
+    _START, _FIRST, _ELEMENT, _SEPARATOR, _DONE = range(5)
+    _whitespace = ' \t\n\r'
+
+    def __init__(self):
+        self._json = json.JSONDecoder()
+        self._pending = []
+        self._state = self._START
+
+    def feed(self, chunk):
+        """Consume a chunk of the body.
+
+        chunk : str
+            Next chunk of the response body.
+
+        return : list
+            Raw events (lists) completed by this chunk.
+        """
+        self._pending.append(chunk)
+        # Every event is a JSON list, so none can be complete without a ']'
+        if self._state != self._START and ']' not in chunk:
+            return []
+        return self._parse()
+
+    def close(self):
+        """Signal the end of the body.
+
+        return : list
+            Any remaining raw events.
+        """
+        events = self._parse()
+        if self._state not in (self._START, self._DONE) or ''.join(self._pending).strip(self._whitespace):
+            raise ValueError('Truncated or malformed events body.')
+        return events
+
+    def _parse(self):
+        buf = ''.join(self._pending)
+        end = len(buf)
+        pos = 0
+        events = []
+        while True:
+            while pos < end and buf[pos] in self._whitespace:
+                pos += 1
+            if pos == end or self._state == self._DONE:
+                break
+
+            if self._state == self._START:
+                if buf[pos] == '[':
+                    self._state = self._FIRST
+                    pos += 1
+                elif buf.startswith('null', pos):
+                    self._state = self._DONE
+                    pos += 4
+                elif 'null'.startswith(buf[pos:]):
+                    break  # wait for the rest of 'null'
+                else:
+                    raise ValueError('Malformed events body.')
+
+            elif self._state == self._SEPARATOR or (self._state == self._FIRST and buf[pos] == ']'):
+                if buf[pos] == ']':
+                    self._state = self._DONE
+                elif buf[pos] == ',':
+                    self._state = self._ELEMENT
+                else:
+                    raise ValueError('Malformed events body.')
+                pos += 1
+
+            else:
+                try:
+                    ev, pos = self._json.raw_decode(buf, pos)
+                except ValueError:
+                    break  # incomplete event; wait for more data
+                if not isinstance(ev, list):
+                    raise ValueError('Malformed event: {0!r}'.format(ev))
+                events.append(ev)
+                self._state = self._SEPARATOR
+
+        self._pending = [buf[pos:]] if pos < end else []
+        return events
+
+
+class EventStream(HTTP):
+    """Body protocol decoding `events` responses incrementally.
+
+    Each raw event is passed to `onEvent` as soon as it has been decoded.
+    The response Deferred fires with the number of events received.  If
+    decoding or `onEvent` raises, the body is aborted and the response
+    Deferred fails with that error.  If `tap` is a list, the raw chunks of
+    the body are appended to it.
+    """
+    def __init__(self, response, onEvent, maxSize=None):
+        HTTP.__init__(self, response, maxSize)
+        self.onEvent = onEvent
+        self.decoder = EventDecoder()
+        self.count = 0
+        self.tap = None
+
+    def chunkReceived(self, bytes):
+        if self.tap is not None:
+            self.tap.append(bytes)
+        try:
+            self._dispatch(bytes)
+        except Exception:
+            # don't let the error reach the HTTP parser, which would drop
+            # the connection and fail the response with a parser error
+            self._aborted = True
+            self.transport.stopProducing()
+            self.response.errback()
+
+    def _dispatch(self, bytes):
+        if metrics.enabled:
+            t0 = time()
+            events = self.decoder.feed(bytes)
+            metrics.histogram('tromegle_decode_seconds', 'Event JSON decoding time').since(t0)
+        else:
+            events = self.decoder.feed(bytes)
+
+        for ev in events:
+            self.count += 1
+            self.onEvent(ev)
+
+    def connectionLost(self, reason):
+        if self._aborted:
+            return
+        try:
+            for ev in self.decoder.close():
+                self.count += 1
+                self.onEvent(ev)
+        except Exception:
+            self.response.errback()
+        else:
+            self.response.callback(self.count)
+
+
+class StrangerConnectionPool(HTTPConnectionPool):
+    """Keep-alive HTTP connection pool shared by Stranger instances.
+
+    At most `maxPersistentPerHost` connections are kept open per host once
+    idle; they are evicted after `idleTimeout` seconds.  Requests other than
+    `events` long-polls can be capped with `maxPerHost`; requests above the
+    cap wait for a free slot.  Long-polls are not counted, as each of them
+    holds its connection until the server answers: a busy host would
+    otherwise starve `send` and `disconnect` requests.
+    """
+    def __init__(self, reactor, maxPerHost=None, maxPersistentPerHost=64, idleTimeout=30., persistent=True):
+        """
+        reactor : twisted reactor instance
+
+        maxPerHost : int or None
+            Maximum number of requests in flight per host, not counting
+            long-polls.  None = unlimited.
+
+        maxPersistentPerHost : int
+            Maximum number of idle connections kept open per host.
+
+        idleTimeout : float
+            Seconds after which an idle connection is closed.
+
+        persistent : bool
+            If False, connections are never reused.
+        """
+        HTTPConnectionPool.__init__(self, reactor, persistent=persistent)
+        self.maxPersistentPerHost = maxPersistentPerHost
+        self.cachedConnectionTimeout = idleTimeout
+        self.maxPerHost = maxPerHost
+
+        self._hostLocks = {}
+        self.stats = {'new': 0, 'reused': 0}
+
+    def getConnection(self, key, endpoint):
+        # cached connections may be stale, in which case a new one is opened
+        new = self.stats['new']
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        if self.stats['new'] == new:
+            self.stats['reused'] += 1
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self.stats['new'] += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def acquire(self, host, longPoll=False):
+        """Wait for a request slot for `host`.
+
+        longPoll : bool
+            If True, the request is an `events` long-poll, which needs no slot.
+
+        return : Deferred or None
+            Fires with the host lock once a slot is available.  The caller
+            must call `release` on the result when done.  None if no slot is
+            needed.
+        """
+        if self.maxPerHost is None or longPoll:
+            return None
+        lock = self._hostLocks.get(host)
+        if lock is None:
+            lock = self._hostLocks[host] = DeferredSemaphore(self.maxPerHost)
+        return lock.acquire()
+
+    def idleConnections(self):
+        """Return the number of cached idle connections across all hosts.
+        """
+        return sum(len(c) for c in self._connections.itervalues())
+
+
+_sharedPool = None
+
+
+def getSharedPool(reactor):
+    """Return the process-wide connection pool, creating it if needed.
+    """
+    global _sharedPool
+    if _sharedPool is None:
+        _sharedPool = StrangerConnectionPool(reactor)
+    return _sharedPool
+
+
+def setSharedPool(pool):
+    """Replace the process-wide connection pool.
+
+    pool : StrangerConnectionPool or None
+        New pool.  If None, a default pool is created on next use.
+    """
+    global _sharedPool
+    _sharedPool = pool
+
+
+_DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class _Outbound(object):
+    __slots__ = ('action', 'data', 'batchKey', 'waiters', 'attempts')
+
+    def __init__(self, action, data, batchKey, waiter):
+        self.action = action
+        self.data = data
+        self.batchKey = batchKey
+        self.waiters = [waiter]  # [(Deferred, time queued)]
+        self.attempts = 0
+
+
+class Outbox(object):
+    """Ordered queue of the requests sent to a stranger.
+
+    Requests are sent in the order they were queued, with at most
+    `maxInFlight` of them awaiting a response.  With the default of one,
+    the server receives them in order; higher values trade ordering for
+    throughput.  Requests failing with TimeoutError are sent again after
+    `retryDelay`, doubled on every attempt, up to `maxRetries` times; the
+    retried request keeps its slot, so later requests wait for it.
+
+    When `batchLength` is non-zero, consecutive queued requests of the same
+    action that allow it (see put) are merged into one, joining their
+    `batchKey` fields with newlines, as long as the result is at most
+    `batchLength` characters long.  Only requests waiting behind another one
+    are merged, so batching adds no latency.
+    """
+    maxInFlight = 1
+    maxRetries = 3
+    retryDelay = .5
+    batchLength = 0
+
+    def __init__(self, stranger, maxInFlight=None, maxRetries=None, retryDelay=None, batchLength=None):
+        """
+        stranger : Stranger
+            Stranger whose `request` method is used.
+
+        Other arguments default to the class attributes of the same name.
+        """
+        self.stranger = stranger
+        self.reactor = stranger.reactor
+        if maxInFlight is not None:
+            self.maxInFlight = maxInFlight
+        if maxRetries is not None:
+            self.maxRetries = maxRetries
+        if retryDelay is not None:
+            self.retryDelay = retryDelay
+        if batchLength is not None:
+            self.batchLength = batchLength
+
+        self.closed = False
+        self.inFlight = 0
+        self._pending = deque()
+        self._retries = {}  # {_Outbound: DelayedCall}
+
+        self.queued = 0
+        self.sent = 0  # HTTP requests, retries included
+        self.acknowledged = 0
+        self.retried = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.batched = 0  # requests saved by batching
+        self.maxDepth = 0
+        self.latency = 0.  # total seconds from put to acknowledgement
+        self.maxLatency = 0.
+
+    def __len__(self):
+        return len(self._pending)
+
+    def depth(self):
+        """Return the number of requests queued or awaiting a response.
+        """
+        return len(self._pending) + self.inFlight
+
+    def put(self, action, data, batchKey=None):
+        """Queue a request.
+
+        action : str
+            API call (see Stranger._ACTIONS).
+
+        data : dict
+            POST parameters.
+
+        batchKey : str or None
+            Parameter whose values may be joined when batching.  None = never
+            batch this request.
+
+        return : Deferred
+            Fires with the HTTP response, or fails with the error of the last
+            attempt, or with CancelledError if the request is dropped by
+            cancel.
+        """
+        if self.closed:
+            self.cancelled += 1
+            return fail(CancelledError())
+
+        d = Deferred()
+        self._pending.append(_Outbound(action, data, batchKey, (d, time())))
+        self.queued += 1
+        self.maxDepth = max(self.maxDepth, self.depth())
+        if metrics.enabled:
+            metrics.histogram('tromegle_outbox_depth', 'Outbound requests queued or in flight',
+                              bounds=_DEPTH_BUCKETS).observe(self.depth())
+        self._dispatch()
+        return d
+
+    def cancel(self):
+        """Drop every queued request, as well as those waiting to be retried.
+        Requests in flight are left to complete.
+        """
+        dropped = list(self._pending)
+        self._pending.clear()
+        for item, call in self._retries.items():
+            if call.active():
+                call.cancel()
+            self.inFlight -= 1
+            dropped.append(item)
+        self._retries.clear()
+
+        for item in dropped:
+            for d, _ in item.waiters:
+                self.cancelled += 1
+                d.errback(CancelledError())
+
+    def close(self):
+        """Cancel pending requests and refuse new ones.
+        """
+        self.closed = True
+        self.cancel()
+
+    def stats(self):
+        n = self.acknowledged
+        return {'queued': self.queued,
+                'sent': self.sent,
+                'acknowledged': n,
+                'retried': self.retried,
+                'failed': self.failed,
+                'cancelled': self.cancelled,
+                'batched': self.batched,
+                'depth': self.depth(),
+                'maxDepth': self.maxDepth,
+                'meanLatency': self.latency / n if n else float('nan'),
+                'maxLatency': self.maxLatency}
+
+    def _dispatch(self):
+        while self._pending and self.inFlight < self.maxInFlight:
+            item = self._pending.popleft()
+            if self.batchLength and item.batchKey is not None:
+                self._coalesce(item)
+            self.inFlight += 1
+            self._send(item)
+
+    def _coalesce(self, item):
+        key = item.batchKey
+        text = item.data[key]
+        while self._pending:
+            nxt = self._pending[0]
+            if nxt.action != item.action or nxt.batchKey != key:
+                break
+            joined = text + '\n' + nxt.data[key]
+            if len(joined) > self.batchLength:
+                break
+            text = joined
+            item.waiters.extend(nxt.waiters)
+            self._pending.popleft()
+            self.batched += 1
+
+        if len(item.waiters) > 1:
+            item.data = dict(item.data)
+            item.data[key] = text
+
+    def _send(self, item):
+        item.attempts += 1
+        self.sent += 1
+        d = self.stranger.request(item.action, item.data)
+        d.addCallback(self.stranger.checkForOkStatus)
+        d.addCallbacks(self._acknowledged, self._failed, callbackArgs=(item,), errbackArgs=(item,))
+
+    def _retry(self, item):
+        del self._retries[item]
+        self._send(item)
+
+    def _acknowledged(self, response, item):
+        self.inFlight -= 1
+        now = time()
+        for d, queued in item.waiters:
+            latency = now - queued
+            self.acknowledged += 1
+            self.latency += latency
+            self.maxLatency = max(self.maxLatency, latency)
+            if metrics.enabled:
+                metrics.histogram('tromegle_send_seconds', 'Time from queueing to acknowledgement',
+                                  action=item.action).observe(latency)
+            d.callback(response)
+        self._dispatch()
+
+    def _failed(self, err, item):
+        if err.check(TimeoutError) and item.attempts <= self.maxRetries and not self.closed:
+            self.retried += 1
+            delay = self.retryDelay * 2 ** (item.attempts - 1)
+            self._retries[item] = self.reactor.callLater(delay, self._retry, item)
+            return
+
+        self.inFlight -= 1
+        for d, _ in item.waiters:
+            self.failed += 1
+            d.errback(err)
+        self._dispatch()
+
+
+class _Detached(object):
+    """Stand-in troll of detached strangers; drops their events.
+    """
+    def feed(self, events):
+        pass
 
 
 class Stranger(object):
     """Class to encapsulate I/O to an Omegle user.
     """
     _RESPONSE_OK = 200
-    _ACTIONS = ('start', 'events', 'send', 'typing', 'disconnect')
-    _api = dict(((a, 'http://omegle.com/' + a) for a in _ACTIONS))
+    _ACTIONS = ('start', 'events', 'send', 'typing', 'stoppedtyping', 'disconnect')
+    DEFAULT_API = 'http://omegle.com/'
+    recorder = None  # replay.Recorder capturing the traffic of every Stranger
+    _api = dict([(a, DEFAULT_API + a) for a in _ACTIONS])
     uagents = ["Mozilla/5.0 (Windows NT 6.1; WOW64; rv:14.0) Gecko/20100101 Firefox/14.0.1",
               "Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 5.1; Trident/4.0; FDM; .NET CLR 2.0.50727; InfoPath.2; .NET CLR 1.1.4322)",
               "Mozilla/5.0 (Windows; U; Windows NT 6.1; es-AR; rv:1.9) Gecko/2008051206 Firefox/3.0"]
 
-    def __init__(self, reactor, troll, protocol, debug=0):
+    def __init__(self, reactor, troll, protocol, debug=0, pool=None, api=None):
         """
         reactor : twisted reactor instance
 
@@ -50,28 +551,104 @@ class Stranger(object):
 
         debug : int
             Debugging level.  0 = no debugging.
+
+        pool : StrangerConnectionPool or None
+            Connection pool to use.  Defaults to the process-wide pool.
+
+        api : str or None
+            Base URL of the Omegle API.  Defaults to the class-wide base URL
+            (see setAPIBase).
         """
         self.typing = False
         self.connected = False
         self.id = None
+        self.received = None  # time of the latest event (with metrics enabled)
+
+        # typing state machine (see setTyping)
+        self.typingDebounce = .25
+        self.typingMaxRetries = 3  # consecutive failed typing requests before giving up
+        self.typingRequested = 0
+        self.typingSent = 0
+        self._wantTyping = False
+        self._typingCall = None
+        self._typingInFlight = False
+        self._typingFailures = 0
+        self._typingEpoch = 0  # bumped whenever a message resets the typing state
 
         self.reactor = reactor
         self.troll = troll  # exposes troll.notify
         self.protocol = protocol
         self.agent = choice(self.uagents)
+        self.debug = debug
+
+        self.pool = pool or getSharedPool(reactor)
+        self._http = Agent(reactor, pool=self.pool)
+        if api is not None:
+            self._api = self.mkAPI(api)
+
+        self.outbox = Outbox(self)
+        self.started = self._getStrangerID()  # fires once the id is set
+
+    @classmethod
+    def mkAPI(cls, base):
+        """Return the {action: url} mapping for an API base URL.
+        """
+        if not base.endswith('/'):
+            base += '/'
+        return dict((a, base + a) for a in cls._ACTIONS)
 
-        self._getStrangerID()
+    @classmethod
+    def setAPIBase(cls, base=None):
+        """Set the API base URL for all Strangers created without an
+        explicit `api` argument.
+
+        base : str or None
+            Base URL, e.g. 'http://localhost:8080/'.  None = omegle.com.
+        """
+        cls._api = cls.mkAPI(base or cls.DEFAULT_API)
 
     def request(self, api_call, data):
-        agent = Agent(self.reactor)
+        if self.recorder is not None:
+            self.recorder.request(self, api_call, data)
+        url = self._api[api_call]
+        lock = self.pool.acquire(urlparse(url).netloc, longPoll=api_call == 'events')
+        if lock is None:
+            d = self._request(url, data)
+        else:
+            d = self._requestWithSlot(lock, url, data)
+
+        if metrics.enabled:
+            d.addBoth(self._observeRequest, api_call, time())
+        return d
+
+    def _requestWithSlot(self, lock, url, data):
+        def send(sem):
+            d = self._request(url, data)
+            d.addBoth(release, sem)
+            return d
+
+        def release(result, sem):
+            sem.release()  # slot is freed once response headers arrive
+            return result
+
+        return lock.addCallback(send)
+
+    @staticmethod
+    def _observeRequest(result, api_call, t0):
+        metrics.histogram('tromegle_request_seconds', 'HTTP round trip time', action=api_call).since(t0)
+        if isinstance(result, Failure):
+            metrics.counter('tromegle_request_errors_total', 'Failed HTTP requests', action=api_call).inc()
+        return result
+
+    def _request(self, url, data):
         header = {'User-Agent': [self.agent],
                   'content-type': ['application/x-www-form-urlencoded; charset=utf-8']}
 
         data = urlencode(data)
-        request = agent.request('POST',
-                                self._api[api_call],
-                                Headers(header),
-                                FileBodyProducer(StringIO(data)))
+        request = self._http.request('POST',
+                                     url,
+                                     Headers(header),
+                                     FileBodyProducer(StringIO(data)))
 
         return request  # .addErrback(log.err, 'Error sending %r to %s' % (data, api_call))
 
@@ -88,12 +665,12 @@ class Stranger(object):
         If self.debug > 1, trapTimeout will feed a connectionTimeout
         event, otherwise it will not.
 
-        err : Exception
-            Exception passed by Deferred instance.
+        err : Failure
+            Failure passed by Deferred instance.
 
-        return : Exception or None
+        return : Failure or None
         """
-        if isinstance(err, TimeoutError):
+        if err.check(TimeoutError):
             if self.debug:
                 self.troll.feed(OmegleEvent(self.id, TIMEOUT_EVENT, ''))
             return None
@@ -108,6 +685,7 @@ class Stranger(object):
         d.addCallback(self.getBody)
         # lvl 3
         d.addCallbacks(self._assignID, self.trapTimeout)
+        return d
 
     def checkForOkStatus(self, response):
         assert response.code == self._RESPONSE_OK, "Bad response to HTTP request."
@@ -118,6 +696,8 @@ class Stranger(object):
         from _getStrangerID
         """
         self.id = body.replace('"', '')
+        if self.recorder is not None:
+            self.recorder.started(self)
         ev = OmegleEvent(self.id, ID_SET, '')
         self.troll.feed(ev)  # ready to go!
 
@@ -130,31 +710,165 @@ class Stranger(object):
         return : generator or NoneType
             Return generator with events or None if there are no events.
         """
-        events = json.loads(events) or None
+        if metrics.enabled:
+            t0 = time()
+            events = json.loads(events) or None
+            metrics.histogram('tromegle_decode_seconds', 'Event JSON decoding time').since(t0)
+        else:
+            events = json.loads(events) or None
         if events:
-            events = (OmegleEvent(self.id,
-                                  ev[0],
-                                  None if len(ev) == 1 else ev[1])
-                      for ev in events)
+            events = (self.mkEvent(ev) for ev in events)
 
         return events
 
+    def mkEvent(self, raw):
+        """Produce an OmegleEvent from a single decoded raw event.
+        """
+        return OmegleEvent(self.id, raw[0], None if len(raw) == 1 else raw[1])
+
     def getEventsPage(self):
+        """Poll for new events, feeding each one to self.troll as soon as
+        it has been decoded.
+
+        return : Deferred
+            Fires with the number of events received.
+        """
         d = self.request('events', {'id': self.id})
-        d.addCallback(self.getBody)
-        d.addCallback(self.parse_raw_events)
-        d.addCallbacks(self.troll.feed, self.trapTimeout)
+        d.addCallback(self.streamEvents)
+        d.addErrback(self.trapTimeout)
+        return d
+
+    def streamEvents(self, response):
+        body = Deferred()
+        stream = EventStream(body, self._feedRawEvent)
+        if self.recorder is not None:
+            stream.tap = []
+            body.addCallback(self._recordEvents, stream.tap)
+        response.deliverBody(stream)
+        body.addCallback(self._eventsDone)
+        return body
+
+    def _recordEvents(self, count, chunks):
+        self.recorder.events(self, ''.join(chunks))
+        return count
+
+    def _feedRawEvent(self, raw):
+        self.feedEvent(self.mkEvent(raw))
+
+    def feedEvent(self, ev):
+        """Pass an event received from the server to self.troll.
+        """
+        if metrics.enabled:
+            self.received = time()
+        if ev.type == DISCONNECTED:  # nothing more can be sent
+            self._cancelTyping()
+            self.outbox.close()
+        self.troll.feed(ev)
+
+    def _eventsDone(self, count):
+        if not count:
+            self.troll.feed(None)  # no events; let the troll check for idleness
+        return count
 
     def toggle_typing(self):
-        d = self.request('typing', {'id': self.id})
-        d.addCallback(self.checkForOkStatus)
-        d.addCallbacks(self._toggle_typing, self.trapTimeout)
+        self.setTyping(not self._wantTyping)
+
+    def setTyping(self, typing):
+        """Show or hide the typing indicator to the stranger.
+
+        Changes are debounced for `typingDebounce` seconds and at most one
+        request is in flight at a time, so that bursts of changes are merged
+        and only the net state change is sent.  self.typing holds the state
+        last acknowledged by the server.  After a failed request the state is
+        reconciled again, up to `typingMaxRetries` times in a row.
+
+        typing : bool
+        """
+        self.typingRequested += 1
+        self._wantTyping = typing
+        self._scheduleTyping()
+
+    def typingStats(self):
+        """Return the number of typing changes requested and sent, and of
+        requests saved by coalescing.
+
+        return : dict
+        """
+        return {'requested': self.typingRequested,
+                'sent': self.typingSent,
+                'saved': self.typingRequested - self.typingSent}
+
+    def _scheduleTyping(self):
+        if self._typingCall is None and not self._typingInFlight:
+            self._typingCall = self.reactor.callLater(self.typingDebounce, self._flushTyping)
+
+    def _cancelTyping(self):
+        if self._typingCall is not None and self._typingCall.active():
+            self._typingCall.cancel()
+        self._typingCall = None
+
+    def _flushTyping(self):
+        self._typingCall = None
+        typing = self._wantTyping
+        if typing == self.typing:
+            return
+
+        self._typingInFlight = True
+        self.typingSent += 1
+        action = 'typing' if typing else 'stoppedtyping'
+        d = self.outbox.put(action, {'id': self.id})
+        d.addCallbacks(self._typingAcknowledged, self._typingFailed,
+                       callbackArgs=(typing, self._typingEpoch), errbackArgs=(action,))
+
+    def _typingAcknowledged(self, resp, typing, epoch):
+        self._typingInFlight = False
+        self._typingFailures = 0
+        if epoch == self._typingEpoch:
+            self.typing = typing
+        if self._wantTyping != self.typing:
+            self._scheduleTyping()
+
+    def _typingFailed(self, err, action):
+        self._typingInFlight = False
+        if not err.check(CancelledError):
+            # changes requested meanwhile were held back by this request
+            self._typingFailures += 1
+            if self._typingFailures <= self.typingMaxRetries and self._wantTyping != self.typing:
+                self._scheduleTyping()
+        return self._outboundFailed(err, action)
+
+    def _outboundFailed(self, err, action):
+        """Errback for requests nobody waits on: cancellations are expected,
+        timeouts are handled by trapTimeout and other errors are logged.
+        """
+        if err.check(CancelledError):
+            return None
+        if self.trapTimeout(err) is not None:
+            log.err(err, 'Error sending {0} to stranger {1}'.format(action, self.id))
 
-    def _toggle_typing(self, resp):
-        self.typing = not self.typing
+    def detach(self):
+        """Stop feeding events to self.troll, e.g. once the conversation
+        this stranger belongs to is over.
+        """
+        self.troll = _Detached()
 
     def announceDisconnect(self):
-        self.request('disconnect', {'id': self.id})
+        """Drop queued requests and tell the server we are leaving.
+
+        return : Deferred
+        """
+        self._cancelTyping()
+        self.outbox.close()
+        d = self.request('disconnect', {'id': self.id})
+        d.addCallback(self.checkForOkStatus)
+        d.addErrback(self._outboundFailed, 'disconnect')
+        return d
 
     def sendMessage(self, msg):
-        self.request('send', {'msg': msg.encode('utf-8'), 'id': self.id})
+        # sending a message hides the typing indicator
+        self._cancelTyping()
+        self._wantTyping = self.typing = False
+        self._typingEpoch += 1
+        d = self.outbox.put('send', {'msg': msg.encode('utf-8'), 'id': self.id}, batchKey='msg')
+        d.addErrback(self._outboundFailed, 'send')
+        return d
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+from twisted.python import log
+
+
+class RateLimiter(object):
+    """Token bucket limiting the number of requests per second.
+
+    A single limiter can be shared by many PollSchedulers in order to cap the
+    request rate of a whole process.
+    """
+    def __init__(self, clock, rate=None, burst=None):
+        """
+        clock : IReactorTime provider (usually the reactor)
+
+        rate : float or None
+            Maximum sustained requests per second.  None = unlimited.
+
+        burst : int or None
+            Bucket size.  Defaults to `rate` (one second worth of requests).
+        """
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst or max(1., rate or 1.)
+
+        self._tokens = self.burst
+        self._last = clock.seconds()
+
+    def reserve(self):
+        """Reserve a request slot.
+
+        The slot is taken even if the request must wait: the caller must issue
+        the request after the returned delay without reserving again, or give
+        the slot back with `release`.
+
+        return : float
+            Seconds to wait before issuing the request.
+        """
+        if not self.rate:
+            return 0.
+
+        now = self.clock.seconds()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0.
+        return -self._tokens / self.rate
+
+    def release(self):
+        """Give back a slot reserved but not used.
+        """
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+
+_sharedLimiter = None
+
+
+def getSharedLimiter(clock):
+    """Return the process-wide poll rate limiter, creating it if needed.
+
+    The default limiter is unlimited; use setSharedLimiter to install a cap.
+    """
+    global _sharedLimiter
+    if _sharedLimiter is None:
+        _sharedLimiter = RateLimiter(clock)
+    return _sharedLimiter
+
+
+def setSharedLimiter(limiter):
+    """Replace the process-wide poll rate limiter.
+
+    limiter : RateLimiter or None
+        New limiter.  If None, an unlimited limiter is created on next use.
+    """
+    global _sharedLimiter
+    _sharedLimiter = limiter
+
+
+class PollStats(object):
+    """Poll statistics for a single stranger.
+    """
+    __slots__ = ('polls', 'eventful', 'empty', 'errors', 'events', 'latency', 'maxLatency', 'delay')
+
+    def __init__(self):
+        self.polls = 0
+        self.eventful = 0
+        self.empty = 0
+        self.errors = 0
+        self.events = 0
+        self.latency = 0.  # cumulative
+        self.maxLatency = 0.
+        self.delay = 0.  # current backoff
+
+    def asdict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+
+class _PollState(object):
+    __slots__ = ('stranger', 'call', 'inFlight', 'reserved', 'delay', 'stats')
+
+    def __init__(self, stranger):
+        self.stranger = stranger
+        self.call = None
+        self.inFlight = False
+        self.reserved = False  # a rate limiter slot is held for the next poll
+        self.delay = 0.
+        self.stats = PollStats()
+
+
+class PollScheduler(object):
+    """Adaptive long-poll scheduler for the `events` API call.
+
+    Each stranger has at most one poll in flight.  A response carrying events
+    triggers an immediate re-poll, whereas silence (or errors) backs off
+    exponentially from `minBackoff` up to `maxDelay` seconds.  All polls go
+    through a RateLimiter, which is shared process-wide by default.
+    """
+    def __init__(self, clock, minBackoff=.25, maxDelay=2., backoff=2., limiter=None):
+        """
+        clock : IReactorTime provider (usually the reactor)
+
+        minBackoff : float
+            Delay (seconds) after the first empty response.
+
+        maxDelay : float
+            Upper bound for the delay between polls.
+
+        backoff : float
+            Factor by which the delay grows after each empty response.
+
+        limiter : RateLimiter or None
+            Global rate limiter.  Defaults to the process-wide limiter.
+        """
+        self.clock = clock
+        self.minBackoff = minBackoff
+        self.maxDelay = maxDelay
+        self.backoff = backoff
+        self.limiter = limiter or getSharedLimiter(clock)
+
+        self._states = {}
+
+    def add(self, stranger):
+        """Start polling a stranger.  Adding a stranger twice has no effect.
+        """
+        if stranger not in self._states:
+            self._states[stranger] = _PollState(stranger)
+            self._schedule(self._states[stranger], 0.)
+
+    def remove(self, stranger):
+        """Stop polling a stranger.
+        """
+        state = self._states.pop(stranger, None)
+        if state is not None and state.call is not None and state.call.active():
+            state.call.cancel()
+            if state.reserved:
+                self.limiter.release()
+
+    def clear(self):
+        for stranger in list(self._states):
+            self.remove(stranger)
+
+    def stats(self):
+        """Return poll statistics.
+
+        return : dict
+            {stranger id: dict of PollStats fields}
+        """
+        return dict((s.id, state.stats.asdict()) for s, state in self._states.iteritems())
+
+    def _schedule(self, state, delay):
+        state.call = self.clock.callLater(delay, self._poll, state)
+
+    def _poll(self, state):
+        state.call = None
+        if state.inFlight or self._states.get(state.stranger) is not state:
+            return
+
+        if not state.reserved:
+            wait = self.limiter.reserve()
+            if wait > 0:
+                state.reserved = True  # the slot is ours once the wait is over
+                self._schedule(state, wait)
+                return
+
+        state.reserved = False
+        state.inFlight = True
+        state.stats.polls += 1
+        d = state.stranger.getEventsPage()
+        d.addBoth(self._done, state, self.clock.seconds())
+
+    def _done(self, result, state, started):
+        state.inFlight = False
+        stats = state.stats
+        polling = self._states.get(state.stranger) is state
+
+        latency = self.clock.seconds() - started
+        stats.latency += latency
+        stats.maxLatency = max(stats.maxLatency, latency)
+
+        if isinstance(result, (int, long)) and result > 0:
+            stats.eventful += 1
+            stats.events += result
+            state.delay = 0.
+        else:
+            if result is None or isinstance(result, (int, long)):
+                stats.empty += 1
+            else:
+                stats.errors += 1
+                if polling:  # polls of removed strangers are aborted on shutdown
+                    log.err(result, 'Error polling events for stranger {0}'.format(state.stranger.id))
+            state.delay = min(self.maxDelay, max(self.minBackoff, state.delay * self.backoff))
+
+        stats.delay = state.delay
+        if polling:
+            self._schedule(state, state.delay)
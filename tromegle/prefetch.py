@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+from collections import deque
+
+from twisted.internet.defer import DeferredList
+from twisted.python import log
+
+from tromegle.omegle import Stranger, HTTP
+
+
+class StrangerPool(object):
+    """Warm pool of Strangers whose ids have already been set.
+
+    Starting a stranger costs a full `start` round trip.  The pool keeps up to
+    `size` strangers started ahead of time, so that a TrollReactor can adopt
+    them as soon as it (re)starts a conversation.  Strangers left unused for
+    `expiry` seconds are disconnected and replaced.
+
+    A single pool can be shared by many TrollReactors.
+    """
+    def __init__(self, reactor, size=2, expiry=60., retryDelay=1., protocol=HTTP, **kwargs):
+        """
+        reactor : twisted reactor instance
+
+        size : int
+            Target number of strangers (ready or being started).
+
+        expiry : float or None
+            Seconds after which an unused stranger is discarded.  None = never.
+
+        retryDelay : float
+            Seconds to wait before replacing a stranger that failed to start.
+
+        protocol : class object
+            Protocol passed to every Stranger.
+
+        Additional kwargs are passed to Stranger.
+        """
+        self.reactor = reactor
+        self.size = size
+        self.expiry = expiry
+        self.retryDelay = retryDelay
+        self.protocol = protocol
+        self.kwargs = kwargs
+
+        self._ready = deque()  # [(stranger, time ready)], oldest first
+        self._starting = set()
+        self._refill = None
+        self._sweep = None
+        self.running = False
+
+        self.stats = {'started': 0, 'taken': 0, 'expired': 0, 'failed': 0, 'misses': 0}
+
+    def __len__(self):
+        return len(self._ready)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.fill()
+
+    def stop(self):
+        """Stop refilling and disconnect every unused stranger.
+
+        return : Deferred
+            Fires once the disconnect requests have completed.
+        """
+        self.running = False
+        for call in (self._refill, self._sweep):
+            if call is not None and call.active():
+                call.cancel()
+        self._refill = self._sweep = None
+
+        disconnects = []
+        while self._ready:
+            disconnects.append(self._ready.popleft()[0].announceDisconnect())
+        return DeferredList(disconnects, consumeErrors=True)
+
+    def feed(self, events):
+        """Strangers in the pool are not polled, so the only event they
+        produce is their idSet, which is tracked through Stranger.started.
+        """
+        pass
+
+    def fill(self):
+        """Start strangers until the pool reaches its target size.
+        """
+        self._refill = None
+        if not self.running:
+            return
+
+        for _ in xrange(self.size - len(self._ready) - len(self._starting)):
+            s = Stranger(self.reactor, self, self.protocol, **self.kwargs)
+            self._starting.add(s)
+            self.stats['started'] += 1
+            s.started.addCallbacks(self._started, self._failed, callbackArgs=(s,), errbackArgs=(s,))
+
+    def take(self, n=1):
+        """Remove up to `n` ready strangers from the pool.
+
+        The caller becomes responsible for the strangers and must point their
+        `troll` attribute at itself.
+
+        return : list of Stranger
+        """
+        if not self.running:
+            self.start()
+        self.expire()
+
+        taken = [self._ready.popleft()[0] for _ in xrange(min(n, len(self._ready)))]
+        self.stats['taken'] += len(taken)
+        self.stats['misses'] += n - len(taken)
+        if taken:
+            self.fill()
+        return taken
+
+    def expire(self):
+        """Disconnect strangers that have been waiting for longer than
+        `expiry` seconds.
+        """
+        if self.expiry is None:
+            return
+
+        now = self.reactor.seconds()
+        expired = 0
+        while self._ready and now - self._ready[0][1] >= self.expiry:
+            self._ready.popleft()[0].announceDisconnect()
+            expired += 1
+
+        if expired:
+            self.stats['expired'] += expired
+            self.fill()
+
+    def _started(self, _, stranger):
+        self._starting.discard(stranger)
+        if stranger.id is None:  # start request timed out
+            return self._failed(None, stranger)
+
+        if not self.running:
+            stranger.announceDisconnect()
+            return
+
+        self._ready.append((stranger, self.reactor.seconds()))
+        self._scheduleSweep()
+
+    def _failed(self, err, stranger):
+        self._starting.discard(stranger)
+        self.stats['failed'] += 1
+        if err is not None:
+            log.err(err, 'Error prefetching a stranger')
+
+        if self.running and self._refill is None:
+            self._refill = self.reactor.callLater(self.retryDelay, self.fill)
+
+    def _scheduleSweep(self):
+        if self.expiry is None or (self._sweep is not None and self._sweep.active()):
+            return
+        if self._ready:
+            delay = max(0., self._ready[0][1] + self.expiry - self.reactor.seconds())
+            self._sweep = self.reactor.callLater(delay, self._doSweep)
+
+    def _doSweep(self):
+        self._sweep = None
+        self.expire()
+        self._scheduleSweep()
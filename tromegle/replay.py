@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+"""Record live Omegle traffic and replay it through a TrollReactor offline.
+
+A Recorder captures, for every Stranger, the identifiers assigned by the
+server, the raw bodies of `events` responses and the outbound requests,
+each with the time at which it happened.  Recordings are JSON lines files
+holding one [time, kind, stranger id, payload] record per line:
+
+    [1350000000.1, "start", "central1:abc", null]
+    [1350000000.4, "events", "central1:abc", "[[\\"connected\\"]]"]
+    [1350000001.2, "request", "central1:abc", ["send", {"msg": "hi", "id": "central1:abc"}]]
+
+A Replayer pushes a recording through Stranger.parse_raw_events, the
+Transmogrifier and the listeners of a TrollReactor, without any network
+I/O and without polling.  Outbound requests are captured instead of sent.
+Recordings are replayed either in real time on the global reactor, or as
+fast as possible on a fake clock, in which case timers (typing debounce,
+idle timeouts, ...) fire at the recorded times and the run is
+deterministic.  Every event reaching the listeners and every outbound
+request is hashed into a digest, so that two runs can be compared.
+
+    recorder = Recorder('traffic.jsonl')
+    recorder.install()
+    ...
+    recorder.close()
+
+    print Replayer(load('traffic.jsonl'), spells=[...]).run(repeat=2)
+"""
+import hashlib
+import json
+from argparse import ArgumentParser
+from collections import Counter
+from time import time
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.web.client import HTTPConnectionPool
+
+from tromegle.core import CBDictInterface
+from tromegle.event import OmegleEvent, Transmogrifier, ID_SET, IDLE_TIMEOUT, MESSAGE_MODIFIED, NULL_EVENT
+from tromegle.omegle import Stranger, HTTP
+from tromegle.troll import MiddleMan
+
+START = 'start'
+EVENTS = 'events'
+REQUEST = 'request'
+
+
+class Recorder(object):
+    """Write the traffic of every Stranger to a recording file.
+    """
+    def __init__(self, path):
+        """
+        path : str
+            Recording file.  Overwritten if it exists.
+        """
+        self.path = path
+        self._f = open(path, 'wb')
+        self.records = 0
+
+    def install(self):
+        """Start recording the traffic of all Strangers.
+        """
+        Stranger.recorder = self
+
+    def uninstall(self):
+        if Stranger.recorder is self:
+            Stranger.recorder = None
+
+    def close(self):
+        self.uninstall()
+        if not self._f.closed:
+            self._f.close()
+
+    def write(self, kind, sid, payload):
+        self._f.write(json.dumps([time(), kind, sid, payload]) + '\n')
+        self.records += 1
+
+    def started(self, stranger):
+        self.write(START, stranger.id, None)
+
+    def events(self, stranger, body):
+        self.write(EVENTS, stranger.id, body)
+
+    def request(self, stranger, action, data):
+        if action in (START, EVENTS):
+            return  # implied by the other records
+        self.write(REQUEST, stranger.id, [action, data])
+
+
+def load(path):
+    """Read a recording.
+
+    return : list
+        [time, kind, stranger id, payload] records, in time order.
+    """
+    with open(path, 'rb') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda r: r[0])
+    return records
+
+
+class _Response(object):
+    code = 200
+
+
+class ReplayStranger(Stranger):
+    """Offline Stranger whose requests are handed to a Replayer rather than
+    sent.
+    """
+    def __init__(self, clock, troll, sid, replayer):
+        self._sid = sid
+        self.replayer = replayer
+        Stranger.__init__(self, clock, troll, HTTP, pool=replayer.pool)
+
+    def _getStrangerID(self):
+        self.id = self._sid
+        return succeed(self.id)
+
+    def request(self, api_call, data):
+        self.replayer.sent(self, api_call, data)
+        return succeed(_Response())
+
+
+class Digest(CBDictInterface):
+    """Listener hashing every event it is notified of.
+    """
+    def __init__(self, sha):
+        super(Digest, self).__init__()
+        self.sha = sha
+        self.events = 0
+
+    def notify(self, ev):
+        self.events += 1
+        if ev.type == MESSAGE_MODIFIED:
+            key = (ev.type, ev.old.id, ev.old.data, ev.data)
+        elif ev.type == IDLE_TIMEOUT:
+            key = (ev.type,)  # data is the measured idle time
+        else:
+            key = (ev.type, getattr(ev, 'id', None), getattr(ev, 'data', None))
+        self.sha.update(repr(key))
+
+
+def replaying(cls, clock):
+    """Return a subclass of the TrollReactor class `cls` driven by a
+    Replayer: strangers are added by the replayer instead of being started
+    and polled, and idleness is measured on `clock`.
+    """
+    class Replaying(cls):
+        def initializeStrangers(self):
+            self._reconnect = None
+            self._volatile = {}
+            self._waiting = self._n
+            self.strangers = {}
+            self._allConnected = False
+            self._lastActive = clock.seconds()
+
+        def restart(self):
+            # the recording holds the strangers of the next conversation
+            if not self.active:
+                return
+            self.poller.clear()
+            self.retireStrangers()
+            self.eventQueue.clear()
+            self.initializeStrangers()
+
+        def pumpEvents(self):
+            pass
+
+        def feed(self, events):
+            if events and events is not NULL_EVENT:
+                self._lastActive = clock.seconds()
+            super(Replaying, self).feed(events)
+
+        def deltaIdleTime(self):
+            return clock.seconds() - self._lastActive
+
+    Replaying.__name__ = 'Replaying' + cls.__name__
+    return Replaying
+
+
+class Replayer(object):
+    """Replay a recording through a TrollReactor.
+    """
+    def __init__(self, records, factory=MiddleMan, spells=(), listen=None, **kwargs):
+        """
+        records : list
+            Records, as returned by load.
+
+        factory : TrollReactor subclass
+            Class of the troll being replayed.  Prefetch pools are not
+            supported.
+
+        spells : iterable
+            Spells of the Transmogrifier.  A new Transmogrifier, using the
+            replay clock, is created for every run.
+
+        listen : callable or None
+            Called without arguments for every run; returns the listeners to
+            add to the troll.  None = no listeners besides the digest.
+
+        Other keyword arguments are passed to `factory`.
+        """
+        self.records = records
+        self.factory = factory
+        self.spells = list(spells)
+        self.listen = listen
+        self.kwargs = kwargs
+
+    def run(self, realtime=False, repeat=1):
+        """Replay the recording `repeat` times.
+
+        realtime : bool
+            If True, replay at the recorded pace on the global reactor, which
+            is run and stopped.  Otherwise replay as fast as possible on a fake
+            clock.
+
+        repeat : int
+            Number of runs.  With more than one, the report tells whether
+            all runs produced the same digest.
+
+        return : dict
+            Report of the last run, with the throughput of the fastest one.
+        """
+        if realtime and repeat > 1:
+            raise ValueError('The global reactor can only be run once.')
+        reports = [self._run(realtime) for _ in xrange(repeat)]
+        report = dict(reports[-1])
+        report['runs'] = repeat
+        report['eventsPerSecond'] = max(r['eventsPerSecond'] for r in reports)
+        if repeat > 1:
+            report['deterministic'] = len(set(r['digest'] for r in reports)) == 1
+        return report
+
+    def _run(self, realtime):
+        if realtime:
+            from twisted.internet import reactor as clock
+        else:
+            clock = Clock()
+        self.clock = clock
+        self.pool = HTTPConnectionPool(clock, persistent=False)
+        self._strangers = {}
+        self._requests = Counter()
+        self._sha = hashlib.sha1()
+        self._skipped = 0
+        self._resyncs = 0
+        self._fed = 0
+
+        digest = Digest(self._sha)
+        listeners = list(self.listen()) if self.listen is not None else []
+        troll = replaying(self.factory, clock)(transmog=Transmogrifier(self.spells, clock=clock),
+                                                listen=listeners + [digest], **self.kwargs)
+
+        t0 = self.records[0][0] if self.records else 0.
+        base = clock.seconds()
+        start = time()
+        if realtime:
+            for t, kind, sid, payload in self.records:
+                clock.callLater(t - t0, self._apply, troll, kind, sid, payload)
+            clock.callLater((self.records[-1][0] - t0 if self.records else 0.) + 1., clock.stop)
+            clock.run()
+        else:
+            for t, kind, sid, payload in self.records:
+                clock.advance(max(0., t - t0 - clock.seconds()))
+                self._apply(troll, kind, sid, payload)
+            self._drain(clock)
+        elapsed = time() - start
+        troll.shutdown()
+
+        recorded = Counter(r[3][0] for r in self.records if r[1] == REQUEST)
+        return {'records': len(self.records),
+                'events': self._fed,
+                'notified': digest.events,
+                'seconds': elapsed,
+                'replayedSeconds': clock.seconds() - base,
+                'eventsPerSecond': self._fed / elapsed if elapsed else float('inf'),
+                'requests': dict(self._requests),
+                'recordedRequests': dict(recorded),
+                'skipped': self._skipped,
+                'resyncs': self._resyncs,
+                'digest': self._sha.hexdigest()}
+
+    @staticmethod
+    def _drain(clock, limit=10000):
+        """Fire the pending timers, including those they schedule.
+        """
+        for _ in xrange(limit):
+            calls = clock.getDelayedCalls()
+            if not calls:
+                return
+            clock.advance(max(0., min(c.getTime() for c in calls) - clock.seconds()))
+
+    def _apply(self, troll, kind, sid, payload):
+        if kind == START:
+            if troll._waiting == 0:
+                # the recorded troll started a conversation this one did not
+                self._resyncs += 1
+                troll.restart()
+            stranger = ReplayStranger(self.clock, troll, sid, self)
+            self._strangers[sid] = stranger
+            troll._volatile[stranger] = None
+            troll.feed(OmegleEvent(sid, ID_SET, ''))
+
+        elif kind == EVENTS:
+            stranger = self._strangers.get(sid)
+            if stranger is None:  # recording started mid-conversation
+                self._skipped += 1
+                return
+            events = stranger.parse_raw_events(payload.encode('utf-8'))
+            if not events:
+                troll.feed(None)
+                return
+            for ev in events:
+                self._fed += 1
+                stranger.feedEvent(ev)
+
+    def sent(self, stranger, action, data):
+        self._requests[action] += 1
+        self._sha.update(repr((action, stranger.id, sorted(data.iteritems()))))
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Replay a recording through a MiddleMan.')
+    parser.add_argument('recording')
+    parser.add_argument('--realtime', action='store_true', help='replay at the recorded pace')
+    parser.add_argument('--repeat', type=int, default=2,
+                        help='number of runs compared for determinism (fast replay only)')
+    args = parser.parse_args(argv)
+
+    report = Replayer(load(args.recording)).run(args.realtime, 1 if args.realtime else args.repeat)
+    for key in sorted(report):
+        print '{0:>20}: {1}'.format(key, report[key])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,596 @@
+#!/usr/bin/env python
+"""Inverted full-text index over recorded conversations.
+
+Every conversation is a document whose words are indexed with their
+positions.  Documents are buffered in memory and written to immutable
+segment files; queries are evaluated segment by segment.
+
+Query syntax:
+    hello world         both words (AND is implied)
+    hello OR hi         either word
+    -spam, NOT spam     exclusion
+    "how are you"       phrase
+    ~helo               fuzzy term (edit distance as in SubstitutionMap)
+    (a OR b) c          grouping
+
+Usage:
+    python -m tromegle.search INDEX [--archive DIR] [--chatlog FILE] [query ...]
+"""
+import os
+import re
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from glob import glob
+
+import Levenshtein as strndist
+
+from tromegle.archive import ArchiveReader
+from tromegle.cache import LRUCache
+from tromegle.event import GOT_MESSAGE, MESSAGE_MODIFIED
+from tromegle.language import Tokenizer, FuzzyIndex
+
+MAGIC = 'TRGI'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sH')
+_TRAILER = struct.Struct('<QQ4s')
+_SEGMENT_NAME = 'index-{0:08d}.seg'
+_SEGMENT_RE = re.compile(r'^index-(\d{8})\.seg$')
+
+_WORD = re.compile(r'\w', re.UNICODE)
+_QUERY = re.compile(r'"[^"]*"?|\(|\)|[^\s()"]+')
+
+_U32 = 'I' if array('I').itemsize == 4 else 'L'
+
+
+def _u32(data=()):
+    return array(_U32, data)
+
+
+class _Buffer(object):
+    """In-memory segment holding documents not yet written to disk.
+    """
+    def __init__(self):
+        self.postings = {}  # {term: {docid: [positions]}}
+        self.labels = {}  # {docid: label}
+        self.docs = set()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, docid, terms, label=None):
+        self.docs.add(docid)
+        if label is not None:
+            self.labels[docid] = label
+        for pos, term in terms:
+            self.postings.setdefault(term, {}).setdefault(docid, []).append(pos)
+
+    def vocabulary(self):
+        return self.postings.iterkeys()
+
+    def universe(self):
+        return set(self.docs)
+
+    def documents(self, term):
+        return set(self.postings.get(term, ()))
+
+    def positions(self, term, docid):
+        return self.postings[term][docid]
+
+    def write(self, filename):
+        """Write the buffer as a segment file.
+        """
+        tmp = filename + '.tmp'
+        terms = {}
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION))
+            offset = _HEADER.size
+            for term in sorted(self.postings):
+                docs = sorted(self.postings[term])
+                starts = _u32([0])
+                positions = _u32()
+                for d in docs:
+                    positions.extend(self.postings[term][d])
+                    starts.append(len(positions))
+                blob = _u32(docs).tostring() + starts.tostring() + positions.tostring()
+                terms[term] = (offset, len(docs), len(positions))
+                f.write(blob)
+                offset += len(blob)
+
+            termsBlob = json.dumps(terms, separators=(',', ':'))
+            docsBlob = json.dumps({'docs': sorted(self.docs), 'labels': self.labels.items()},
+                                  separators=(',', ':'))
+            f.write(termsBlob)
+            f.write(docsBlob)
+            f.write(_TRAILER.pack(offset, offset + len(termsBlob), MAGIC))
+        os.rename(tmp, filename)
+
+
+class IndexSegment(object):
+    """Memory-mapped, read-only segment file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        m = self._map
+        termsOffset, docsOffset, magic = _TRAILER.unpack_from(m, len(m) - _TRAILER.size)
+        if _HEADER.unpack_from(m, 0)[0] != MAGIC or magic != MAGIC:
+            raise ValueError('not an index segment: ' + filename)
+
+        self.terms = json.loads(m[termsOffset:docsOffset])  # {term: (offset, ndocs, npositions)}
+        docs = json.loads(m[docsOffset:len(m) - _TRAILER.size])
+        self.docs = frozenset(docs['docs'])
+        self.labels = dict((int(k), v) for k, v in docs['labels'])
+        self._postings = LRUCache(4096)  # decoded (docs, starts) arrays, by term
+
+    def __len__(self):
+        return len(self.docs)
+
+    def vocabulary(self):
+        return self.terms.iterkeys()
+
+    def universe(self):
+        return set(self.docs)
+
+    def _decode(self, term):
+        cached = self._postings.get(term)
+        if cached is None:
+            offset, ndocs, _ = self.terms[term]
+            docs, starts = _u32(), _u32()
+            docs.fromstring(self._map[offset:offset + 4 * ndocs])
+            starts.fromstring(self._map[offset + 4 * ndocs:offset + 8 * ndocs + 4])
+            cached = (docs, starts)
+            self._postings.put(term, cached)
+        return cached
+
+    def documents(self, term):
+        if term not in self.terms:
+            return set()
+        return set(self._decode(term)[0])
+
+    def positions(self, term, docid):
+        docs, starts = self._decode(term)
+        i = bisect_left(docs, docid)
+        offset, ndocs, _ = self.terms[term]
+        base = offset + 8 * ndocs + 4
+        positions = _u32()
+        positions.fromstring(self._map[base + 4 * starts[i]:base + 4 * starts[i + 1]])
+        return positions
+
+    def close(self):
+        self._postings.clear()
+        self._map.close()
+        self._file.close()
+
+
+class SearchIndex(object):
+    """On-disk inverted index of conversations: term -> (conversation,
+    positions).
+
+    Messages are tokenized with language.Tokenizer; only tokens containing
+    word characters are indexed, case-insensitively.  Positions are counted
+    across the whole conversation, with a gap between messages so that
+    phrases never span two messages.
+    """
+    def __init__(self, path, tokenizer=None, dist=1, edit_fn=None, flushEvery=10000):
+        """
+        path : str
+            Index directory.  Created if needed.
+
+        tokenizer : Tokenizer or None
+
+        dist : int
+            Maximum edit distance of fuzzy (~) query terms.
+
+        edit_fn : function or None
+            Edit distance function.  Defaults to Levenshtein distance, as in
+            SubstitutionMap.
+
+        flushEvery : int
+            Number of buffered conversations after which a segment is written.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.tokenizer = tokenizer or Tokenizer()
+        self.dist = dist
+        self.edit_fn = edit_fn or strndist.distance
+        self.flushEvery = flushEvery
+
+        found = sorted((int(m.group(1)), f) for m, f in
+                       ((_SEGMENT_RE.match(f), f) for f in os.listdir(path)) if m)
+        self.segments = [IndexSegment(os.path.join(path, f)) for _, f in found]
+        self._next = found[-1][0] + 1 if found else 1
+        self._buffer = _Buffer()
+        self._fuzzy = None  # FuzzyIndex of the vocabulary, built on first use
+
+        state = self._loadState()
+        self.nextDoc = state.get('nextDoc', 0)
+        self.sources = state.get('sources', {})  # {source: last conversation id indexed}
+        self.labels = set(state.get('labels', ()))
+        # {source: {conversation id: docid}}; json keys are strings
+        self.archived = dict((source, dict((int(cid), d) for cid, d in docids.iteritems()))
+                             for source, docids in state.get('archived', {}).iteritems())
+        self._archivedBy = None  # {docid: (source, conversation id)}, built on first use
+
+    # State
+
+    def _statePath(self):
+        return os.path.join(self.path, 'state.json')
+
+    def _loadState(self):
+        if not os.path.exists(self._statePath()):
+            return {}
+        with open(self._statePath()) as f:
+            return json.load(f)
+
+    def _saveState(self):
+        tmp = self._statePath() + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'nextDoc': self.nextDoc, 'sources': self.sources, 'labels': sorted(self.labels),
+                       'archived': self.archived}, f)
+        os.rename(tmp, self._statePath())
+
+    # Indexing
+
+    def terms(self, messages):
+        """Return the (position, term) pairs of a sequence of messages.
+        """
+        pos = 0
+        for msg in messages:
+            for token in self.tokenizer(msg):
+                if _WORD.search(token):
+                    yield pos, token.lower()
+                    pos += 1
+            pos += 1  # no phrase spans two messages
+
+    def add(self, messages, docid=None, label=None):
+        """Index a conversation.
+
+        messages : iterable of unicode
+
+        docid : int or None
+            Document id.  Defaults to the next free id.  Ids must be unique.
+
+        label : str or None
+            Source of the document (e.g. a log file key).
+
+        return : int
+            Document id.
+        """
+        if docid is None:
+            docid = self.nextDoc
+        self.nextDoc = max(self.nextDoc, docid + 1)
+
+        terms = list(self.terms(messages))
+        self._buffer.add(docid, terms, label)
+        if label is not None:
+            self.labels.add(label)
+        if self._fuzzy is not None:
+            for _, term in terms:
+                self._fuzzy.add(term)
+
+        if len(self._buffer) >= self.flushEvery:
+            self.flush()
+        return docid
+
+    def addConversation(self, cid, events, source):
+        """Index an archived conversation (see archive.ArchiveRecorder).
+
+        Archived conversations get fresh document ids like any other
+        document; `archived` maps their conversation ids to document ids.
+
+        events : sequence of (float, event)
+
+        source : str
+            Absolute path of the archive.
+
+        return : int
+            Document id.
+        """
+        docid = self.add(messagesFromEvents(ev for _, ev in events))
+        self.archived.setdefault(source, {})[cid] = docid
+        self.sources[source] = max(self.sources.get(source, -1), cid)
+        if self._archivedBy is not None:
+            self._archivedBy[docid] = (source, cid)
+        return docid
+
+    def flush(self):
+        """Write buffered conversations to a new segment.
+        """
+        if len(self._buffer):
+            filename = os.path.join(self.path, _SEGMENT_NAME.format(self._next))
+            self._buffer.write(filename)
+            self._next += 1
+            self.segments.append(IndexSegment(filename))
+            self._buffer = _Buffer()
+        self._saveState()
+
+    def watch(self, archive):
+        """Index conversations as they are appended to an Archive.
+
+        Conversations indexed this way are not indexed again by
+        updateFromArchive.
+        """
+        key = os.path.abspath(archive.path)
+        archive.observers.append(lambda cid, events: self.addConversation(cid, events, key))
+
+    def updateFromArchive(self, path):
+        """Index archived conversations not indexed yet.
+
+        return : int
+            Number of conversations indexed.
+        """
+        key = os.path.abspath(path)
+        last = self.sources.get(key, -1)
+        reader = ArchiveReader(path)
+        n = 0
+        try:
+            for cid in reader.conversations():
+                if cid > last:
+                    self.addConversation(cid, reader.conversation(cid), key)
+                    n += 1
+        finally:
+            reader.close()
+        self.flush()
+        return n
+
+    def updateFromChatLogs(self, base):
+        """Index the rotated MessageLogger files of `base` (e.g. 'chat.log')
+        not indexed yet.
+
+        return : int
+            Number of conversations indexed.
+        """
+        from tromegle.mining import unitKey, CHATLOG
+
+        n = 0
+        for filename in sorted(glob(base + '.[0-9]*')):
+            key = unitKey(CHATLOG, filename)
+            if key not in self.labels:
+                with open(filename, 'rb') as f:
+                    self.add(messagesFromChatLog(line.decode('utf-8', 'replace') for line in f), label=key)
+                n += 1
+        self.flush()
+        return n
+
+    # Queries
+
+    def _all(self):
+        return self.segments + [self._buffer]
+
+    def vocabulary(self):
+        vocab = set()
+        for seg in self._all():
+            vocab.update(seg.vocabulary())
+        return vocab
+
+    def expand(self, term):
+        """Return the indexed terms within `dist` of term.
+        """
+        if self._fuzzy is None:
+            self._fuzzy = FuzzyIndex(self.dist, self.vocabulary())
+        if len(term) == 1:
+            return set([term])
+        return set(c for c in self._fuzzy.candidates(term)
+                   if len(c) > 1 and self.edit_fn(term, c) <= self.dist)
+
+    def parse(self, query):
+        """Parse a query string into a tree of (operator, operand) nodes.
+        """
+        tokens = _QUERY.findall(query)
+        node, rest = self._parseOr(tokens)
+        if rest:
+            raise ValueError('unexpected {0!r} in query'.format(rest[0]))
+        return node
+
+    def _parseOr(self, tokens):
+        nodes = []
+        node, tokens = self._parseAnd(tokens)
+        nodes.append(node)
+        while tokens and tokens[0] == 'OR':
+            node, tokens = self._parseAnd(tokens[1:])
+            nodes.append(node)
+        return (nodes[0] if len(nodes) == 1 else ('or', nodes)), tokens
+
+    def _parseAnd(self, tokens):
+        nodes = []
+        while tokens and tokens[0] not in ('OR', ')'):
+            if tokens[0] == 'AND':
+                tokens = tokens[1:]
+                continue
+            node, tokens = self._parseUnary(tokens)
+            nodes.append(node)
+        if not nodes:
+            raise ValueError('empty query')
+        return (nodes[0] if len(nodes) == 1 else ('and', nodes)), tokens
+
+    def _parseUnary(self, tokens):
+        tok, tokens = tokens[0], tokens[1:]
+        if tok == 'NOT':
+            node, tokens = self._parseUnary(tokens)
+            return ('not', node), tokens
+        if tok == '(':
+            node, tokens = self._parseOr(tokens)
+            if not tokens or tokens[0] != ')':
+                raise ValueError('unbalanced parentheses in query')
+            return node, tokens[1:]
+        if tok.startswith('-') and len(tok) > 1:
+            node, _ = self._parseUnary([tok[1:]])
+            return ('not', node), tokens
+        if tok.startswith('~') and len(tok) > 1:
+            return ('fuzzy', [t for _, t in self.terms([tok[1:]])]), tokens
+
+        terms = [t for _, t in self.terms([tok.strip('"')])]
+        return ('phrase', terms) if len(terms) > 1 or tok.startswith('"') else ('term', terms[0] if terms else u''), tokens
+
+    def _expandFuzzy(self, node):
+        op, arg = node
+        if op == 'fuzzy':
+            return ('or', [('term', t) for term in arg for t in sorted(self.expand(term))])
+        if op in ('and', 'or'):
+            return op, [self._expandFuzzy(n) for n in arg]
+        if op == 'not':
+            return op, self._expandFuzzy(arg)
+        return node
+
+    @staticmethod
+    def _documents(seg, term, postings):
+        """Return the documents of seg holding term, decoding the postings
+        once per query.  Callers must not modify the result.
+
+        postings : dict
+            {term: set of docids} of seg for the current query.
+        """
+        docs = postings.get(term)
+        if docs is None:
+            docs = postings[term] = seg.documents(term)
+        return docs
+
+    def _evaluate(self, node, seg, postings):
+        op, arg = node
+        if op == 'term':
+            return set(self._documents(seg, arg, postings))
+        if op == 'phrase':
+            return self._phrase(arg, seg, postings)
+        if op == 'or':
+            docs = set()
+            for n in arg:
+                docs |= self._evaluate(n, seg, postings)
+            return docs
+        if op == 'not':
+            return seg.universe() - self._evaluate(arg, seg, postings)
+
+        # and: evaluate positive operands smallest first, then subtract negations
+        positive = [n for n in arg if n[0] != 'not']
+        negative = [n[1] for n in arg if n[0] == 'not']
+        if positive:
+            sets = sorted((self._evaluate(n, seg, postings) for n in positive), key=len)
+            docs = sets[0]
+            for s in sets[1:]:
+                if not docs:
+                    break
+                docs &= s
+        else:
+            docs = seg.universe()
+        for n in negative:
+            if not docs:
+                break
+            docs -= self._evaluate(n, seg, postings)
+        return docs
+
+    def _phrase(self, terms, seg, postings):
+        if not terms:
+            return set()
+        sets = sorted((self._documents(seg, t, postings) for t in set(terms)), key=len)
+        docs = set(sets[0])
+        for found in sets[1:]:
+            if not docs:
+                return docs
+            docs &= found
+        if len(terms) == 1 or not docs:
+            return docs
+
+        matched = set()
+        for d in docs:
+            starts = set(seg.positions(terms[0], d))
+            for i, t in enumerate(terms[1:], 1):
+                starts &= set(p - i for p in seg.positions(t, d))
+                if not starts:
+                    break
+            if starts:
+                matched.add(d)
+        return matched
+
+    def search(self, query):
+        """Return the ids of the conversations matching a query.
+
+        return : list of int
+            Sorted document ids.
+        """
+        node = self._expandFuzzy(self.parse(query))
+        docs = set()
+        for seg in self._all():
+            docs |= self._evaluate(node, seg, {})
+        return sorted(docs)
+
+    def label(self, docid):
+        """Return the label (source) of a document, or None.
+
+        Archived conversations are labelled `archive path#conversation id`.
+        """
+        for seg in self._all():
+            if docid in seg.labels:
+                return seg.labels[docid]
+
+        if self._archivedBy is None:
+            self._archivedBy = dict((d, (source, cid)) for source, docids in self.archived.iteritems()
+                                    for cid, d in docids.iteritems())
+        if docid in self._archivedBy:
+            return '{0}#{1}'.format(*self._archivedBy[docid])
+
+    def close(self):
+        self.flush()
+        for seg in self.segments:
+            seg.close()
+
+
+def messagesFromEvents(events):
+    """Yield the text of every message among Tromegle events.  Modified
+    messages yield both the sent and the original text.
+    """
+    for ev in events:
+        if ev.type == GOT_MESSAGE:
+            yield ev.data
+        elif ev.type == MESSAGE_MODIFIED:
+            yield ev.data
+            yield ev.old.data
+
+
+def messagesFromChatLog(lines):
+    """Yield the text of every message in a MessageLogger file.
+    """
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.startswith('  '):  # original text of a modified message
+            yield line[2:]
+        else:
+            head, sep, msg = line.partition(': ')
+            if sep and head.startswith('Stranger '):
+                yield msg
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+    from time import time
+
+    parser = ArgumentParser(description='Index and search recorded conversations.')
+    parser.add_argument('index', help='index directory')
+    parser.add_argument('--archive', action='append', default=[], help='archive directory to index')
+    parser.add_argument('--chatlog', action='append', default=[], help='MessageLogger file to index')
+    parser.add_argument('--dist', type=int, default=1, help='edit distance of fuzzy terms')
+    parser.add_argument('query', nargs='*')
+    args = parser.parse_args(argv)
+
+    index = SearchIndex(args.index, dist=args.dist)
+    for path in args.archive:
+        print 'indexed {0} conversations from {1}'.format(index.updateFromArchive(path), path)
+    for base in args.chatlog:
+        print 'indexed {0} conversations from {1}'.format(index.updateFromChatLogs(base), base)
+
+    if args.query:
+        t0 = time()
+        docs = index.search(u' '.join(a.decode('utf-8') for a in args.query))
+        print '{0} conversations ({1:.1f} ms)'.format(len(docs), (time() - t0) * 1e3)
+        for d in docs:
+            print d, index.label(d) or ''
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
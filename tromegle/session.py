@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+import os
+import resource
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList
+
+from tromegle.core import CBDictInterface
+from tromegle.event import Transmogrifier, mkIterableSequence
+from tromegle.troll import MiddleMan
+
+
+def currentRSS():
+    """Return the resident set size of the current process, in bytes.
+
+    Falls back to the peak RSS where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return peakRSS()
+
+
+def peakRSS():
+    """Return the peak resident set size of the current process, in bytes.
+    """
+    # ru_maxrss is in kilobytes on Linux and bytes on OSX
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if os.uname()[0] == 'Darwin' else rss * 1024
+
+
+class _RouteTracker(CBDictInterface):
+    """Listener recording which session each stranger id belongs to.
+    """
+    def __init__(self, manager, session):
+        super(_RouteTracker, self).__init__()
+        self.manager = manager
+        self.session = session
+        self.ids = set()
+
+    def on_idSet(self, ev):
+        self.ids.add(ev.id)
+        self.manager.routes[ev.id] = self.session
+
+    def on_strangerDisconnected(self, ev):
+        self.forget()
+
+    def on_timeout(self, ev):
+        self.forget()
+
+    def forget(self):
+        for i in self.ids:
+            self.manager.routes.pop(i, None)
+        self.ids.clear()
+
+
+class SessionManager(object):
+    """Host many independent MiddleMan or Client sessions in a single reactor.
+
+    All sessions share the process-wide connection pool and poll rate limiter,
+    the listeners passed as `listen` and the spells of `transmog` (each session
+    casts them through its own Transmogrifier).  Listeners that keep
+    per-conversation state should be created per session through
+    `perSession` instead.
+
+    The manager keeps `n` sessions alive and knows which session owns each
+    stranger id.
+    """
+    def __init__(self, factory=MiddleMan, n=1, transmog=None, listen=(), perSession=None,
+                 checkInterval=5., **kwargs):
+        """
+        factory : callable
+            Session class (or factory) accepting `transmog` and `listen` kwargs.
+
+        n : int
+            Target number of live sessions.
+
+        transmog : Transmogrifier or None
+            Transmogrifier whose spells are cast in every session.
+
+        listen : single listener instance or iterable
+            Listeners shared by all sessions.
+
+        perSession : callable or None
+            Called with no arguments for every new session; returns a listener
+            or iterable of listeners private to that session.
+
+        checkInterval : float
+            Seconds between checks of the number of live sessions.
+
+        Additional kwargs are passed to `factory`.  A `prefetch` StrangerPool
+        passed this way is shared by all sessions and stopped with them.
+        """
+        self.factory = factory
+        self.target = n
+        self.spells = transmog.getSpells() if transmog is not None else ()
+        self.announceSpells = transmog is not None and transmog.announceSpells
+        self.listeners = tuple(mkIterableSequence(listen))
+        self.perSession = perSession
+        self.checkInterval = checkInterval
+        self.kwargs = kwargs
+
+        self.sessions = []
+        self.routes = {}  # {stranger id: session}
+        self._trackers = {}  # {session: (tracker, private listeners)}
+        self._call = None
+        self._rss0 = None  # RSS before the first session was spawned
+
+    def start(self):
+        """Spawn sessions up to the target number and keep them alive.
+        """
+        if self._rss0 is None:
+            self._rss0 = currentRSS()
+        self._maintain()
+
+    def stop(self):
+        """Shut down every session and stop maintaining the target number.
+
+        return : Deferred
+            Fires once every session has sent its disconnect requests (see
+            TrollReactor.shutdown).
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+        stopped = []
+        while self.sessions:
+            stopped.append(self.stopSession(self.sessions[-1]))
+
+        prefetch = self.kwargs.get('prefetch')
+        if prefetch is not None:
+            stopped.append(prefetch.stop())
+        return DeferredList(stopped, consumeErrors=True)
+
+    def setTarget(self, n):
+        """Change the number of sessions to keep alive.
+        """
+        self.target = n
+        self._rebalance()
+
+    def spawn(self):
+        """Start a new session.
+
+        return : TrollReactor
+        """
+        private = ()
+        if self.perSession is not None:
+            private = tuple(mkIterableSequence(self.perSession()))
+
+        session = self.factory(transmog=Transmogrifier(self.spells, announceSpells=self.announceSpells),
+                               listen=self.listeners + private,
+                               **self.kwargs)
+        tracker = _RouteTracker(self, session)
+        session.addListeners(tracker)
+
+        # sessions only hold weak references to their listeners
+        self._trackers[session] = (tracker, private)
+        self.sessions.append(session)
+        return session
+
+    def stopSession(self, session):
+        self.sessions.remove(session)
+        tracker, _ = self._trackers.pop(session)
+        tracker.forget()
+        return session.shutdown()
+
+    def stats(self):
+        """Return process-level session metrics.
+
+        `rssPerSession` is the growth of the current RSS since start, divided
+        by the current number of sessions.  `peakRSS` is the peak RSS of the
+        whole process.
+
+        return : dict
+        """
+        rss = currentRSS()
+        n = len(self.sessions)
+        grown = rss - (rss if self._rss0 is None else self._rss0)
+        return {'pid': os.getpid(),
+                'sessions': n,
+                'target': self.target,
+                'strangers': len(self.routes),
+                'rss': rss,
+                'rssPerSession': grown / n if n else 0,
+                'peakRSS': peakRSS()}
+
+    def _rebalance(self):
+        for session in [s for s in self.sessions if not s.active]:
+            self.stopSession(session)
+
+        while len(self.sessions) < self.target:
+            self.spawn()
+        while len(self.sessions) > self.target:
+            self.stopSession(self.sessions[-1])
+
+    def _maintain(self):
+        self._rebalance()
+        self._call = reactor.callLater(self.checkInterval, self._maintain)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+"""Run sessions across several worker processes.
+
+The supervisor spawns `workers` child processes, each running its own reactor
+and SessionManager, and splits the total number of sessions between them.
+Events and log messages are relayed to the supervisor as JSON lines over a
+dedicated pipe (file descriptor PIPE_FD of the worker, leaving stdout free for
+printing), where they are fed to the supervisor's listeners.  Dead
+workers are restarted and sessions are rebalanced across live workers.
+
+Usage:
+    python -m tromegle.shard supervise package.module:factory [--workers K] [--sessions N]
+
+`factory` is called without arguments in every worker and must return a
+SessionManager.
+"""
+import os
+import sys
+import json
+import signal
+from argparse import ArgumentParser
+from importlib import import_module
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+from tromegle.event import OmegleEvent, _ReactorEvent, MessageModifiedEvent, MESSAGE_MODIFIED, mkIterableSequence
+
+_EOL = '\n'
+PIPE_FD = 3  # worker-side descriptor of the worker -> supervisor pipe
+
+
+def encodeEvent(ev):
+    """Return a JSON-serializable representation of a Tromegle event.
+    """
+    if ev.type == MESSAGE_MODIFIED:
+        return ['m', ev.data, list(ev.old)]
+    if hasattr(ev, 'id'):
+        return ['o'] + list(ev)
+    return ['r'] + list(ev)
+
+
+def decodeEvent(obj):
+    """Rebuild a Tromegle event from the output of encodeEvent.
+    """
+    kind, args = obj[0], obj[1:]
+    if kind == 'm':
+        return MessageModifiedEvent(args[0], OmegleEvent(*args[1]))
+    if kind == 'o':
+        return OmegleEvent(*args)
+    return _ReactorEvent(*args)
+
+
+def loadFactory(path):
+    """Import `package.module:callable` and return the callable.
+    """
+    module, _, name = path.partition(':')
+    return getattr(import_module(module), name)
+
+
+def split(total, k):
+    """Split `total` sessions as evenly as possible between `k` workers.
+    """
+    return [total // k + (1 if i < total % k else 0) for i in xrange(k)]
+
+
+class _Relay(object):
+    """Listener writing every event to the supervisor pipe.
+    """
+    def __init__(self, control):
+        self.control = control
+
+    def notify(self, ev):
+        if ev.type is not None:  # skip NULL_EVENT
+            self.control.send('event', ev=encodeEvent(ev))
+
+
+class WorkerControl(LineReceiver):
+    """Worker side of the supervisor pipe.
+
+    Reads `target N` commands from stdin and writes events, log messages and
+    periodic stats to PIPE_FD.
+    """
+    delimiter = _EOL
+
+    def __init__(self, manager, statsInterval=5.):
+        self.manager = manager
+        self.statsInterval = statsInterval
+        self.relay = _Relay(self)
+        manager.listeners += (self.relay,)
+        self.stopping = False
+        self._stats = LoopingCall(self.sendStats)
+
+    def connectionMade(self):
+        log.addObserver(self.emitLog)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stopSessions)
+        self.manager.setTarget(0)
+        self.manager.start()
+        self._stats.start(self.statsInterval)
+
+    def lineReceived(self, line):
+        cmd, _, arg = line.partition(' ')
+        if cmd == 'target':
+            self.manager.setTarget(int(arg))
+
+    def connectionLost(self, reason):
+        # supervisor went away
+        self.shutdown()
+
+    def shutdown(self, *args):
+        """Stop the reactor, once.
+
+        Used both when the pipe closes and as the SIGTERM/SIGINT handler, as
+        the supervisor may do both at the same time.
+        """
+        if not self.stopping:
+            self.stopping = True
+            reactor.stop()
+
+    def stopSessions(self):
+        """Stop the sessions.  Run before the reactor shuts down.
+
+        return : Deferred
+            Fires once the sessions have disconnected.
+        """
+        self.stopping = True
+        log.removeObserver(self.emitLog)
+        if self._stats.running:
+            self._stats.stop()
+        return self.manager.stop()
+
+    def send(self, kind, **kwargs):
+        kwargs['kind'] = kind
+        self.transport.write(json.dumps(kwargs) + _EOL)
+
+    def emitLog(self, eventDict):
+        text = log.textFromEventDict(eventDict)
+        if text is not None:
+            self.send('log', msg=text, isError=bool(eventDict.get('isError')))
+
+    def sendStats(self):
+        self.send('stats', stats=self.manager.stats())
+
+
+class WorkerProcess(ProcessProtocol):
+    """Supervisor side of a single worker pipe.
+    """
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.stats = {}
+        self.alive = False
+        self.ended = Deferred()
+        self._buf = ''
+
+    def connectionMade(self):
+        self.alive = True
+        self.supervisor.rebalance()
+
+    def childDataReceived(self, childFD, data):
+        if childFD != PIPE_FD:
+            return
+        lines = (self._buf + data).split(_EOL)
+        self._buf = lines.pop()
+        for line in lines:
+            if line:
+                self.lineReceived(line)
+
+    def lineReceived(self, line):
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            log.msg('[worker {0}] {1}'.format(self.index, line))
+            return
+
+        kind = msg.get('kind')
+        if kind == 'event':
+            self.supervisor.dispatch(decodeEvent(msg['ev']))
+        elif kind == 'log':
+            log.msg('[worker {0}] {1}'.format(self.index, msg['msg']))
+        elif kind == 'stats':
+            self.stats = msg['stats']
+
+    def setTarget(self, n):
+        self.transport.write('target {0}{1}'.format(n, _EOL))
+
+    def processEnded(self, reason):
+        self.alive = False
+        self.stats = {}
+        self.supervisor.workerDied(self, reason)
+        self.ended.callback(None)
+
+
+class Supervisor(object):
+    """Spawn, restart and rebalance worker processes.
+    """
+    def __init__(self, factory, workers=None, sessions=1, listen=(), restartDelay=1., stopTimeout=10.):
+        """
+        factory : str
+            `package.module:callable` returning a SessionManager.  Imported
+            in every worker.
+
+        workers : int or None
+            Number of worker processes.  Defaults to the number of CPUs.
+
+        sessions : int
+            Total number of sessions across all workers.
+
+        listen : single listener instance or iterable
+            Listeners notified of events from every worker.
+
+        restartDelay : float
+            Seconds to wait before restarting a dead worker.
+
+        stopTimeout : float
+            Seconds to wait for workers to exit on stop before killing them.
+        """
+        if workers is None:
+            from multiprocessing import cpu_count
+            workers = cpu_count()
+
+        self.factory = factory
+        self.sessions = sessions
+        self.listeners = tuple(mkIterableSequence(listen))
+        self.restartDelay = restartDelay
+        self.stopTimeout = stopTimeout
+        self.workers = [None] * workers
+        self.restarts = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for i in xrange(len(self.workers)):
+            self.spawn(i)
+
+    def stop(self):
+        """Ask every worker to exit.
+
+        return : Deferred
+            Fires once all workers have exited, killing those still alive
+            after `stopTimeout` seconds.
+        """
+        self.running = False
+        live = [w for w in self.workers if w is not None and w.alive]
+        for w in live:
+            w.transport.signalProcess('TERM')
+
+        kill = reactor.callLater(self.stopTimeout, self._kill, live)
+        d = DeferredList([w.ended for w in live])
+        d.addCallback(lambda _: kill.active() and kill.cancel())
+        return d
+
+    def _kill(self, workers):
+        for w in workers:
+            if w.alive:
+                log.msg('[worker {0}] did not exit, killing it'.format(w.index))
+                w.transport.signalProcess('KILL')
+
+    def spawn(self, index):
+        proto = WorkerProcess(self, index)
+        self.workers[index] = proto
+        args = [sys.executable, '-m', 'tromegle.shard', 'worker', self.factory]
+        reactor.spawnProcess(proto, sys.executable, args, env=os.environ,
+                             childFDs={0: 'w', 1: 1, 2: 2, PIPE_FD: 'r'})
+
+    def workerDied(self, worker, reason):
+        log.msg('[worker {0}] exited: {1}'.format(worker.index, reason.getErrorMessage()))
+        if not self.running:
+            return
+        self.restarts += 1
+        self.rebalance()
+        reactor.callLater(self.restartDelay, self.spawn, worker.index)
+
+    def setSessions(self, n):
+        self.sessions = n
+        self.rebalance()
+
+    def rebalance(self):
+        """Split the total number of sessions between live workers.
+        """
+        live = [w for w in self.workers if w is not None and w.alive]
+        for w, n in zip(live, split(self.sessions, len(live) or 1)):
+            w.setTarget(n)
+
+    def dispatch(self, ev):
+        for listener in self.listeners:
+            listener.notify(ev)
+
+    def stats(self):
+        """Return the latest stats reported by every worker.
+
+        return : dict
+        """
+        live = [w for w in self.workers if w is not None and w.alive]
+        return {'workers': len(live),
+                'restarts': self.restarts,
+                'sessions': sum(w.stats.get('sessions', 0) for w in live),
+                'rss': sum(w.stats.get('rss', 0) for w in live),
+                'peakRSS': sum(w.stats.get('peakRSS', 0) for w in live),
+                'perWorker': dict((w.index, w.stats) for w in live)}
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Run Tromegle sessions across worker processes.')
+    parser.add_argument('mode', choices=('supervise', 'worker'))
+    parser.add_argument('factory', help='package.module:callable returning a SessionManager')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--sessions', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if args.mode == 'worker':
+        from twisted.internet.stdio import StandardIO
+        control = WorkerControl(loadFactory(args.factory)())
+        StandardIO(control, stdout=PIPE_FD)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: reactor.callFromThread(control.shutdown))
+        reactor.run(installSignalHandlers=False)
+    else:
+        log.startLogging(sys.stdout)
+        supervisor = Supervisor(args.factory, workers=args.workers, sessions=args.sessions)
+        reactor.callWhenRunning(supervisor.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+        reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,26 @@
 #!/usr/bin/env python
 import tromegle.language as language
-from tromegle.event import spell_
+from tromegle.cache import LRUCache, memoize_
+from tromegle.event import spell_, handles_, MESSAGE_TYPES
 
 
 ts_dict = {'m': 'f', 'male': 'female', 'guy': 'girl'}
-ts_map = language.SubstitutionMap(ts_dict, dist=1)
+ts_map = language.SubstitutionMap(ts_dict, dist=1, cache=4096)
 ts_stop = set(["I'm"])
 ts_tokenizer = language.Tokenizer(stop_words=ts_stop)
+ts_cache = LRUCache(4096)
+
+
+@memoize_(ts_cache, version=lambda: ts_map.version)
+def ts_translate(msg):
+    return ts_map(ts_tokenizer(msg))
 
 
 @spell_
+@handles_(*MESSAGE_TYPES)
 def sex_change(t, ev):
     if t.isMessage(ev):
-        new_msg = ts_map(ts_tokenizer(ev.data))
+        new_msg = ts_translate(ev.data)
         if t.msg_contents_modified(new_msg, ev.data):
             ev = t.modifyMessage(ev, new_msg)
 
@@ -0,0 +1,31 @@
+from collections import deque
+
+from twisted.trial import unittest
+
+from tromegle.event import Transmogrifier, OmegleEvent, onlyMessages_, spellName, GOT_MESSAGE, MESSAGE_TYPES
+
+
+@onlyMessages_
+def upper(t, ev):
+    return t.modifyMessage(ev, ev.data.upper())
+
+
+@onlyMessages_
+def lower(t, ev):
+    return t.modifyMessage(ev, ev.data.lower())
+
+
+class OnlyMessagesTest(unittest.TestCase):
+    def test_name(self):
+        self.assertEqual(spellName(upper), 'upper')
+        self.assertEqual(upper.eventTypes, MESSAGE_TYPES)
+
+    def test_separateProfileEntries(self):
+        transmog = Transmogrifier([upper, lower])
+        transmog.connect(deque())
+        transmog.profile()
+        transmog(OmegleEvent('a', GOT_MESSAGE, 'Hi'))
+
+        stats = transmog.getSpellStats()
+        self.assertEqual([s['name'] for s in stats], ['upper', 'lower'])
+        self.assertEqual([s['calls'] for s in stats], [1, 1])
@@ -0,0 +1,119 @@
+import os
+from collections import deque
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from tromegle.archive import Archive
+from tromegle.event import (Transmogrifier, OmegleEvent, SpellFiredEvent, deferred_, spell_, handles_, onlyMessages_,
+                            ID_SET, GOT_MESSAGE, DISCONNECTED, SPELL_FIRED)
+from tromegle.mining import Stats
+from tromegle.troll import OMiner
+
+
+@spell_
+@handles_(GOT_MESSAGE)
+def shout(t, ev):
+    return t.modifyMessage(ev, ev.data.upper())
+
+
+@spell_
+def silence(t, ev):
+    return None if ev.type == GOT_MESSAGE and ev.data == 'shh' else ev
+
+
+@onlyMessages_
+def whisper(t, ev):
+    return t.modifyMessage(ev, ev.data.lower())
+
+
+class Censor(object):
+    """Callable spell object, named after its class.
+    """
+    def __call__(self, t, ev):
+        return None if t.isMessage(ev) and 'spam' in ev.data.lower() else ev
+
+
+def transmogrify(transmog, *events):
+    queue = deque()
+    transmog.connect(queue)
+    transmog(events)
+    return list(queue)
+
+
+class SpellFiredTest(unittest.TestCase):
+    def test_announcements(self):
+        hi, shh, spam = [OmegleEvent('a', GOT_MESSAGE, m) for m in ('hi', 'shh', 'spam')]
+        out = transmogrify(Transmogrifier([silence, shout, Censor()], announceSpells=True), hi, shh, spam)
+
+        self.assertEqual(out, [SpellFiredEvent('shout'), Transmogrifier.modifyMessage(hi, 'HI'),
+                               SpellFiredEvent('silence'),
+                               SpellFiredEvent('shout'), SpellFiredEvent('Censor')])
+
+    def test_untouchedEventsAreNotAnnounced(self):
+        ev = OmegleEvent('a', DISCONNECTED, None)
+        self.assertEqual(transmogrify(Transmogrifier([shout, silence], announceSpells=True), ev), [ev])
+
+    def test_decoratedSpellName(self):
+        out = transmogrify(Transmogrifier([whisper], announceSpells=True), OmegleEvent('a', GOT_MESSAGE, 'Hi'))
+        self.assertEqual(out[0], SpellFiredEvent('whisper'))
+
+    def test_offByDefault(self):
+        hi, shh = [OmegleEvent('a', GOT_MESSAGE, m) for m in ('hi', 'shh')]
+        out = transmogrify(Transmogrifier([silence, shout]), hi, shh)
+        self.assertEqual(out, [Transmogrifier.modifyMessage(hi, 'HI')])
+
+    def test_deferredSpell(self):
+        waiting = Deferred()
+
+        @deferred_
+        def later(t, ev):
+            return waiting
+
+        transmog = Transmogrifier([later, shout], clock=Clock(), announceSpells=True)
+        ev = OmegleEvent('a', GOT_MESSAGE, 'hi')
+        queue = deque()
+        transmog.connect(queue)
+        transmog(ev)
+        self.assertEqual(list(queue), [])
+
+        waiting.callback(ev._replace(data='hey'))
+        self.assertEqual([e.type for e in queue], [SPELL_FIRED, SPELL_FIRED, 'messageModified'])
+        self.assertEqual([e.data for e in queue][:2], ['later', 'shout'])
+
+
+class OMinerTest(unittest.TestCase):
+    def test_spellCounts(self):
+        path = self.mktemp()
+        archive = Archive(path)
+        events = [OmegleEvent('a', ID_SET, ''), OmegleEvent('a', GOT_MESSAGE, 'hi'),
+                  OmegleEvent('a', GOT_MESSAGE, 'shh'), OmegleEvent('a', DISCONNECTED, None)]
+        out = transmogrify(Transmogrifier([silence, shout], announceSpells=True), *events)
+        archive.append([(float(i), ev) for i, ev in enumerate(out)])
+        archive.close()
+
+        stats = OMiner(archives=path, processes=0).run()
+        self.assertEqual(dict(stats.spells), {'shout': 1, 'silence': 1})
+        self.assertEqual(stats.counts['events'], 3)
+        self.assertEqual(dict(stats.disconnects), {'stranger 1': 1})
+        self.assertEqual(Stats.fromdict(stats.asdict()).spells, stats.spells)
+
+    def test_identicalChatLogs(self):
+        base = os.path.join(self.mktemp(), 'chat.log')
+        os.makedirs(os.path.dirname(base))
+
+        def rollover():
+            for i in (2, 1):
+                if os.path.exists('{0}.{1}'.format(base, i)):
+                    os.rename('{0}.{1}'.format(base, i), '{0}.{1}'.format(base, i + 1))
+            with open(base + '.1', 'wb') as f:
+                f.write('Stranger 1 disconnected\n')
+
+        miner = OMiner(chatlogs=base, processes=0)
+        rollover()
+        miner.run()
+        rollover()  # same conversation again, in a new file
+        self.assertEqual(miner.run().counts['conversations'], 2)
+        self.assertEqual(dict(miner.stats.disconnects), {'stranger 1': 2})
+        self.assertEqual(miner.pending(), [])
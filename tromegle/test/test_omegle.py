@@ -0,0 +1,296 @@
+from twisted.internet.defer import CancelledError, Deferred, succeed
+from twisted.internet.error import TimeoutError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.client import ResponseDone
+
+from tromegle.omegle import EventStream, Stranger, StrangerConnectionPool, Outbox, _Detached
+
+
+class FakeConnection(object):
+    def __init__(self, state):
+        self.state = state
+
+
+class FakeEndpoint(object):
+    def connect(self, factory):
+        return succeed(FakeConnection('QUIESCENT'))
+
+
+class StrangerConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = StrangerConnectionPool(self.clock)
+
+    def cache(self, key, connection):
+        self.pool._connections.setdefault(key, []).append(connection)
+        self.pool._timeouts[connection] = self.clock.callLater(1., lambda: None)
+
+    def test_reuseCounting(self):
+        self.pool.getConnection('k', FakeEndpoint())
+        self.assertEqual(self.pool.stats, {'new': 1, 'reused': 0})
+
+        self.cache('k', FakeConnection('QUIESCENT'))
+        self.pool.getConnection('k', FakeEndpoint())
+        self.assertEqual(self.pool.stats, {'new': 1, 'reused': 1})
+
+    def test_staleConnectionIsNotReused(self):
+        self.cache('k', FakeConnection('CONNECTION_LOST'))
+        self.pool.getConnection('k', FakeEndpoint())
+        self.assertEqual(self.pool.stats, {'new': 1, 'reused': 0})
+
+    def test_longPollsNeedNoSlot(self):
+        self.pool.maxPerHost = 1
+        first, second = self.pool.acquire('h'), self.pool.acquire('h')
+        self.assertTrue(first.called)
+        self.assertFalse(second.called)
+        self.assertIdentical(self.pool.acquire('h', longPoll=True), None)
+
+        first.result.release()
+        self.assertTrue(second.called)
+
+
+class FakeBodyTransport(object):
+    stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class EventStreamTest(unittest.TestCase):
+    def stream(self, onEvent):
+        d = Deferred()
+        stream = EventStream(d, onEvent)
+        stream.makeConnection(FakeBodyTransport())
+        return stream, d
+
+    def test_events(self):
+        received = []
+        stream, d = self.stream(received.append)
+        stream.dataReceived('[["typing"], ["gotMes')
+        self.assertEqual(received, [['typing']])
+        stream.dataReceived('sage", "hi"]]')
+        stream.connectionLost(Failure(ResponseDone()))
+        self.assertEqual(self.successResultOf(d), 2)
+        self.assertEqual(received, [['typing'], ['gotMessage', 'hi']])
+
+    def test_handlerError(self):
+        received = []
+
+        def onEvent(ev):
+            received.append(ev)
+            raise RuntimeError('listener failed')
+
+        stream, d = self.stream(onEvent)
+        stream.dataReceived('[["typing"], ["gotMessage", "hi"]]')
+        self.failureResultOf(d, RuntimeError)
+        self.assertTrue(stream.transport.stopped)
+        self.assertEqual(received, [['typing']])  # no more events are fed
+
+        stream.dataReceived('ignored')
+        stream.connectionLost(Failure(ResponseDone()))
+        self.assertEqual(received, [['typing']])
+
+    def test_malformedBody(self):
+        stream, d = self.stream(lambda ev: None)
+        stream.dataReceived('{"no": "list"}')
+        self.failureResultOf(d, ValueError)
+        self.assertTrue(stream.transport.stopped)
+
+
+class FakeResponse(object):
+    code = 200
+
+
+class FakeStranger(Stranger):
+    """Stranger answering no request by itself: every request is recorded
+    along with a Deferred for the test to fire.
+    """
+    def __init__(self, clock):
+        self.requests = []  # [(action, data, Deferred)]
+        Stranger.__init__(self, clock, _Detached(), None, pool=StrangerConnectionPool(clock))
+        self.id = 'a'
+
+    def _getStrangerID(self):
+        return succeed(None)
+
+    def request(self, api_call, data):
+        d = Deferred()
+        self.requests.append((api_call, data, d))
+        return d
+
+    def sent(self):
+        return [(action, data.get('msg')) for action, data, _ in self.requests]
+
+    def answer(self, i=-1):
+        self.requests[i][2].callback(FakeResponse())
+
+    def timeout(self, i=-1):
+        self.requests[i][2].errback(TimeoutError())
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.stranger = FakeStranger(self.clock)
+
+    def outbox(self, **kwargs):
+        return Outbox(self.stranger, **kwargs)
+
+    def put(self, outbox, *messages):
+        return [outbox.put('send', {'msg': m}, batchKey='msg') for m in messages]
+
+    def test_orderUnderRetry(self):
+        outbox = self.outbox(retryDelay=1.)
+        waiters = self.put(outbox, 'a', 'b', 'c')
+
+        self.stranger.timeout()
+        self.clock.advance(1.)
+        self.stranger.timeout()
+        self.clock.advance(2.)
+        self.assertEqual(self.stranger.sent(), [('send', 'a')] * 3)
+
+        for _ in xrange(3):
+            self.stranger.answer()
+        self.assertEqual(self.stranger.sent(), [('send', 'a')] * 3 + [('send', 'b'), ('send', 'c')])
+        for d in waiters:
+            self.successResultOf(d)
+        self.assertEqual(outbox.stats()['retried'], 2)
+        self.assertEqual(outbox.depth(), 0)
+
+    def test_retriesAreCapped(self):
+        outbox = self.outbox(maxRetries=1, retryDelay=1.)
+        first, second = self.put(outbox, 'a', 'b')
+
+        self.stranger.timeout()
+        self.clock.advance(1.)
+        self.stranger.timeout()
+        self.failureResultOf(first, TimeoutError)
+        self.assertEqual(self.stranger.sent()[-1], ('send', 'b'))
+
+    def test_failureDoesNotBlockLaterRequests(self):
+        outbox = self.outbox()
+        first, second = self.put(outbox, 'a', 'b')
+
+        self.stranger.requests[0][2].errback(ValueError())
+        self.failureResultOf(first, ValueError)
+        self.stranger.answer()
+        self.assertEqual(self.successResultOf(second).code, 200)
+        self.assertEqual(outbox.stats()['failed'], 1)
+
+    def test_batching(self):
+        outbox = self.outbox(batchLength=10)
+        waiters = self.put(outbox, 'a', 'b', 'c', 'too long to fit')
+
+        self.stranger.answer()
+        self.assertEqual(self.stranger.sent(), [('send', 'a'), ('send', 'b\nc')])
+        self.stranger.answer()
+        self.assertEqual(self.stranger.sent()[-1], ('send', 'too long to fit'))
+        self.stranger.answer()
+
+        for d in waiters:
+            self.successResultOf(d)
+        self.assertEqual(outbox.stats()['batched'], 1)
+
+    def test_closeDrainsQueue(self):
+        outbox = self.outbox(maxInFlight=2, retryDelay=1.)
+        retried, inFlight, queued = self.put(outbox, 'a', 'b', 'c')
+        self.stranger.timeout(0)  # 'a' waits to be sent again
+
+        outbox.close()
+        self.failureResultOf(retried, CancelledError)
+        self.failureResultOf(queued, CancelledError)
+        self.failureResultOf(outbox.put('send', {'msg': 'late'}), CancelledError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        # requests in flight complete normally
+        self.stranger.answer(1)
+        self.successResultOf(inFlight)
+        self.assertEqual(outbox.depth(), 0)
+        self.assertEqual(self.stranger.sent(), [('send', 'a'), ('send', 'b')])
+
+
+class StrangerOutboundTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.stranger = FakeStranger(self.clock)
+
+    def actions(self):
+        return [action for action, _ in self.stranger.sent()]
+
+    def test_typingCoalescing(self):
+        s = self.stranger
+        for typing in (True, False, True):
+            s.setTyping(typing)
+        self.clock.advance(s.typingDebounce)
+        self.assertEqual(self.actions(), ['typing'])
+        self.assertEqual(s.typingStats(), {'requested': 3, 'sent': 1, 'saved': 2})
+
+    def test_typingRevertedBeforeFlush(self):
+        s = self.stranger
+        s.setTyping(True)
+        s.setTyping(False)
+        self.clock.advance(s.typingDebounce)
+        self.assertEqual(self.actions(), [])
+
+    def test_typingChangedInFlight(self):
+        s = self.stranger
+        s.setTyping(True)
+        self.clock.advance(s.typingDebounce)
+        s.setTyping(False)
+        self.clock.advance(s.typingDebounce)
+        self.assertEqual(self.actions(), ['typing'])  # one typing request at a time
+
+        s.answer()
+        self.assertTrue(s.typing)
+        self.clock.advance(s.typingDebounce)
+        self.assertEqual(self.actions(), ['typing', 'stoppedtyping'])
+
+    def test_typingFailureReconciles(self):
+        s = self.stranger
+        s.setTyping(True)
+        self.clock.advance(s.typingDebounce)
+        s.setTyping(False)
+        s.setTyping(True)  # pending behind the request in flight
+
+        s.requests[-1][2].errback(ValueError())
+        self.clock.advance(s.typingDebounce)
+        self.assertEqual(self.actions(), ['typing', 'typing'])
+        s.answer()
+        self.assertTrue(s.typing)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_typingRetriesAreCapped(self):
+        s = self.stranger
+        s.setTyping(True)
+        for _ in xrange(s.typingMaxRetries + 2):
+            self.clock.advance(s.typingDebounce)
+            if s._typingInFlight:
+                s.requests[-1][2].errback(ValueError())
+        self.assertEqual(self.actions(), ['typing'] * (s.typingMaxRetries + 1))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), s.typingMaxRetries + 1)
+
+    def test_messageSupersedesTyping(self):
+        s = self.stranger
+        s.setTyping(True)
+        s.sendMessage(u'hi')
+        self.clock.advance(s.typingDebounce)
+        self.assertEqual(self.actions(), ['send'])
+        self.assertFalse(s.typing)
+
+    def test_disconnectDrainsOutbox(self):
+        s = self.stranger
+        inFlight = s.sendMessage(u'a')
+        queued = s.sendMessage(u'b')
+        s.setTyping(True)
+
+        s.announceDisconnect()
+        self.clock.advance(s.typingDebounce)
+        self.assertEqual(self.actions(), ['send', 'disconnect'])
+        self.assertEqual(self.successResultOf(queued), None)  # CancelledError is swallowed
+        self.assertEqual(s.outbox.stats()['cancelled'], 1)
+
+        s.answer(0)
+        self.successResultOf(inFlight)
+        self.assertEqual(s.outbox.depth(), 0)
@@ -0,0 +1,67 @@
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from tromegle.poll import PollScheduler, RateLimiter
+
+
+class ChattyStranger(object):
+    """Stranger whose every poll returns an event, so that it re-polls at
+    once and is only held back by the rate limiter.
+    """
+    def __init__(self, id):
+        self.id = id
+        self.polls = 0
+
+    def getEventsPage(self):
+        self.polls += 1
+        return succeed(1)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_unlimited(self):
+        limiter = RateLimiter(Clock())
+        self.assertEqual([limiter.reserve() for _ in xrange(100)], [0.] * 100)
+
+    def test_reservationsQueueUp(self):
+        limiter = RateLimiter(Clock(), rate=2., burst=1)
+        self.assertEqual([limiter.reserve() for _ in xrange(3)], [0., .5, 1.])
+
+    def test_release(self):
+        limiter = RateLimiter(Clock(), rate=1., burst=1)
+        limiter.reserve()
+        self.assertEqual(limiter.reserve(), 1.)
+        limiter.release()
+        self.assertEqual(limiter.reserve(), 1.)
+
+
+class PollSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.limiter = RateLimiter(self.clock, rate=1.)
+        self.scheduler = PollScheduler(self.clock, limiter=self.limiter)
+        self.strangers = [ChattyStranger('s{0}'.format(i)) for i in xrange(3)]
+        for s in self.strangers:
+            self.scheduler.add(s)
+
+    def advance(self, seconds):
+        for _ in xrange(int(seconds * 10)):
+            self.clock.advance(.1)
+
+    def test_throughputAndFairness(self):
+        self.advance(20)
+        polls = [s.polls for s in self.strangers]
+        # one token in the bucket, then one per second
+        self.assertIn(sum(polls), (20, 21))
+        self.assertTrue(max(polls) - min(polls) <= 1, polls)
+
+    def test_removeReleasesReservation(self):
+        self.advance(5)
+        reserved = sum(state.reserved for state in self.scheduler._states.itervalues())
+        self.assertTrue(reserved)
+        wait = self.limiter.reserve()
+        self.limiter.release()
+
+        self.scheduler.clear()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertAlmostEqual(wait - self.limiter.reserve(), reserved / self.limiter.rate)
@@ -0,0 +1,85 @@
+import json
+
+from twisted.trial import unittest
+
+from tromegle.event import spell_, handles_, GOT_MESSAGE
+from tromegle.replay import Recorder, Replayer, load, START, EVENTS, REQUEST
+
+
+@spell_
+@handles_(GOT_MESSAGE)
+def shout(t, ev):
+    return t.modifyMessage(ev, ev.data.upper())
+
+
+def events(*raw):
+    return json.dumps(list(raw))
+
+
+RECORDS = [
+    [0., START, 'a', None],
+    [.01, START, 'b', None],
+    [.1, EVENTS, 'a', events(['waiting'], ['connected'])],
+    [.1, EVENTS, 'b', events(['waiting'], ['connected'])],
+    [.5, EVENTS, 'a', events(['typing'], ['gotMessage', 'hi there'])],
+    [.6, REQUEST, 'b', ['send', {'msg': 'hi there', 'id': 'b'}]],
+    [1., EVENTS, 'b', 'null'],
+    [1.5, EVENTS, 'b', events(['gotMessage', 'hello'])],
+    [1.6, REQUEST, 'a', ['send', {'msg': 'hello', 'id': 'a'}]],
+    [3., EVENTS, 'a', events(['strangerDisconnected'])],
+    [3.1, REQUEST, 'b', ['disconnect', {'id': 'b'}]],
+]
+
+
+class ReplayerTest(unittest.TestCase):
+    def replay(self, **kwargs):
+        return Replayer(RECORDS, idle=(0, 0), **kwargs).run(repeat=2)
+
+    def test_replay(self):
+        report = self.replay()
+        self.assertTrue(report['deterministic'])
+        self.assertEqual(report['events'], 8)
+        self.assertEqual(report['skipped'], 0)
+        self.assertEqual(report['requests'], report['recordedRequests'])
+
+    def test_modifyingSpell(self):
+        plain = self.replay()
+        report = self.replay(spells=[shout])
+        self.assertTrue(report['deterministic'])
+        self.assertNotEqual(report['digest'], plain['digest'])
+
+    def test_staleEventsAreDropped(self):
+        # b's poll was in flight when a left; its late events must not end
+        # the next conversation
+        records = RECORDS[:10] + [
+            [3.2, START, 'c', None],
+            [3.2, START, 'd', None],
+            [3.3, EVENTS, 'b', events(['gotMessage', 'late'], ['strangerDisconnected'])],
+            [3.4, EVENTS, 'c', events(['connected'])],
+        ]
+        report = Replayer(records, idle=(0, 0)).run()
+        fresh = Replayer(records[:-2] + records[-1:], idle=(0, 0)).run()
+        self.assertEqual(report['notified'], fresh['notified'])
+        self.assertEqual(report['requests'], fresh['requests'])
+        self.assertEqual(report['resyncs'], 0)
+
+
+class RecorderTest(unittest.TestCase):
+    def test_roundTrip(self):
+        class Stranger(object):
+            id = 'a'
+
+        path = self.mktemp()
+        recorder = Recorder(path)
+        recorder.started(Stranger)
+        recorder.request(Stranger, 'events', {'id': 'a'})  # implied by the events record
+        recorder.events(Stranger, events(['connected']))
+        recorder.request(Stranger, 'send', {'msg': 'hi', 'id': 'a'})
+        recorder.close()
+
+        records = load(path)
+        self.assertEqual([r[1:] for r in records],
+                         [[START, 'a', None],
+                          [EVENTS, 'a', events(['connected'])],
+                          [REQUEST, 'a', ['send', {'msg': 'hi', 'id': 'a'}]]])
+        self.assertEqual(records, sorted(records))
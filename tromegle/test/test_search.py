@@ -0,0 +1,83 @@
+import os
+
+from twisted.trial import unittest
+
+from tromegle.archive import Archive
+from tromegle.event import OmegleEvent, GOT_MESSAGE
+from tromegle.search import SearchIndex
+
+
+def conversation(*messages):
+    return [(float(i), OmegleEvent('a', GOT_MESSAGE, m)) for i, m in enumerate(messages)]
+
+
+class ArchiveIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.archive = Archive(os.path.join(self.path, 'archive'))
+        self.index = SearchIndex(os.path.join(self.path, 'index'))
+        self.addCleanup(self.archive.close)
+
+    def writeChatLog(self, *messages):
+        base = os.path.join(self.path, 'chat.log')
+        with open(base + '.1', 'wb') as f:
+            for m in messages:
+                f.write('Stranger 1: {0}\n'.format(m))
+        return base
+
+    def test_docidsDoNotCollide(self):
+        self.index.updateFromChatLogs(self.writeChatLog(u'from the log'))
+        self.archive.append(conversation(u'from the archive'))
+        self.archive.flush()
+        self.index.updateFromArchive(self.archive.path)
+
+        log, archived = self.index.search(u'log'), self.index.search(u'archive')
+        self.assertEqual(len(log), 1)
+        self.assertEqual(len(archived), 1)
+        self.assertNotEqual(log, archived)
+        self.assertEqual(self.index.label(archived[0]), os.path.abspath(self.archive.path) + '#0')
+
+    def test_watchedConversationsAreNotIndexedAgain(self):
+        self.index.watch(self.archive)
+        self.archive.append(conversation(u'hello'))
+        self.archive.flush()
+
+        self.assertEqual(self.index.updateFromArchive(self.archive.path), 0)
+        self.assertEqual(len(self.index.search(u'hello')), 1)
+
+    def test_stateIsKept(self):
+        self.archive.append(conversation(u'hello'))
+        self.archive.flush()
+        self.index.updateFromArchive(self.archive.path)
+        docid = self.index.search(u'hello')[0]
+        self.index.close()
+
+        index = SearchIndex(os.path.join(self.path, 'index'))
+        self.addCleanup(index.close)
+        self.assertEqual(index.archived, {os.path.abspath(self.archive.path): {0: docid}})
+        self.assertEqual(index.updateFromArchive(self.archive.path), 0)
+
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        self.index = SearchIndex(self.mktemp())
+        self.addCleanup(self.index.close)
+        self.docs = [self.index.add([u'how are you'], label='a'),
+                     self.index.add([u'you are how', u'how are'], label='b'),
+                     self.index.add([u'are you ok'], label='c')]
+
+    def test_phrase(self):
+        self.assertEqual(self.index.search(u'"how are you"'), self.docs[:1])
+        self.assertEqual(self.index.search(u'"how are" -ok'), self.docs[:2])
+        self.index.flush()
+        self.assertEqual(self.index.search(u'"are you" OR "how are"'), self.docs)
+
+    def test_postingsDecodedOncePerQuery(self):
+        self.index.flush()
+        seg = self.index.segments[0]
+        calls = []
+        documents = seg.documents
+        seg.documents = lambda term: calls.append(term) or documents(term)
+
+        self.index.search(u'"how are you" are')
+        self.assertEqual(sorted(calls), [u'are', u'how', u'you'])
@@ -1,13 +1,22 @@
 #!/usr/bin/env python
-from time import time, sleep
+import os
+import json
+from glob import glob
+from itertools import imap
+from multiprocessing import Pool
+from time import time
 from collections import deque
 from weakref import WeakValueDictionary
 
 from twisted.internet import reactor
+from twisted.internet.defer import DeferredList
 
+from tromegle import metrics, mining
+from tromegle.archive import Segment, segmentFiles
 from tromegle.omegle import Stranger, HTTP
-from tromegle.core import CBDictInterface
-from tromegle.event import isEvent, mkIterableSequence, Transmogrifier, IdleTimeoutEvent, NULL_EVENT
+from tromegle.poll import PollScheduler
+from tromegle.core import CBDictInterface, subscriptions
+from tromegle.event import isEvent, mkIterableSequence, Transmogrifier, IdleTimeoutEvent, OmegleEvent, NULL_EVENT, ID_SET
 from tromegle.listener import InteractiveViewport, ClientViewport
 
 
@@ -15,56 +24,142 @@ class TrollReactor(CBDictInterface):
     """Base class for Omegle API.
     """
     def __init__(self, transmog=Transmogrifier(), listen=InteractiveViewport(),
-                 n=2, refresh=2., debug=0):
+                 n=2, refresh=2., debug=0, prefetch=None):
+        """
+        prefetch : StrangerPool or None
+            Pool of strangers started ahead of time.  Strangers are taken
+            from the pool whenever it has some ready, and started on demand
+            otherwise.
+        """
         # Independent setup
         super(TrollReactor, self).__init__()
         self.debug = debug
 
         self.listeners = WeakValueDictionary()
+        self._subscribers = {}  # {event type: {id(listener): listener}} (weak values)
+        self._wildcard = WeakValueDictionary()  # listeners subscribed to every event type
         # Argument assignment
         self.eventQueue = deque()
         self.connectTransmogrifier(transmog)
         self.addListeners(listen)
         self._n = n
         self.refresh = refresh
+        self.poller = PollScheduler(reactor, maxDelay=refresh)
+        self.prefetch = prefetch
 
         self._allConnected = False
+        self.active = True
         self.reconnectWait = 2.
         self.idleTime = None
+        self._reconnect = None
         self.initializeStrangers()  # Now we wait to receive idSet events
 
     def connectTransmogrifier(self, transmog):
         self.transmogrifier = transmog
-        self.transmogrifier.connect(self.eventQueue)
+        self.transmogrifier.connect(self.eventQueue, self._processEventQueue)
 
     def initializeStrangers(self):
-        self._volatile = dict((Stranger(reactor, self, HTTP), None) for _ in xrange(self._n))
+        self._reconnect = None
+        ready = self.prefetch.take(self._n) if self.prefetch is not None else []
+        for s in ready:
+            s.troll = self
+        strangers = ready + [Stranger(reactor, self, HTTP) for _ in xrange(self._n - len(ready))]
+
+        self._volatile = dict((s, None) for s in strangers)
         self._waiting = len(self._volatile.keys())
         self.strangers = {}
         self.idleTime = time()
         self._allConnected = False
 
+        if ready:  # their idSet events went to the pool; replay them
+            reactor.callLater(0, self.feed, [OmegleEvent(s.id, ID_SET, '') for s in ready])
+
     def multicastDisconnect(self, ids):
         """Announce disconnect for a group of strangers.
 
         ids : iterable
             id strings of strangers from whom to politely disconnect.
+
+        return : list
+            Deferreds of the disconnect requests.
         """
-        for i in ids:
-            self.strangers[i].announceDisconnect()
+        return [self.strangers[i].announceDisconnect() for i in ids]
 
-    def restart(self):
+    def shutdown(self):
+        """Stop polling, disconnect from all strangers and stop restarting.
+
+        return : Deferred
+            Fires once the disconnect requests have completed.
+        """
+        self.active = False
+        if self._reconnect is not None and self._reconnect.active():
+            self._reconnect.cancel()
+        self.poller.clear()
+        disconnects = self.multicastDisconnect(list(self.strangers))
+        self.retireStrangers()
+        self.eventQueue.clear()
+        return DeferredList(disconnects, consumeErrors=True)
+
+    def retireStrangers(self):
+        """Forget the strangers of the current conversation.
+
+        They are detached (see Stranger.detach), so that responses still in
+        flight do not feed their events into the next conversation.
+        """
+        for s in self.strangers.values() + list(getattr(self, '_volatile', ())):
+            if s.troll is self:
+                s.detach()
         self.strangers.clear()
+        self._volatile = {}
+
+    def restart(self):
+        """Drop the current strangers and schedule a new conversation.
+
+        New strangers are started after `reconnectWait` seconds, in order to
+        avoid hammering the server.  If the prefetch pool already holds enough
+        started strangers, they are adopted right away.
+        """
+        if not self.active or self._reconnect is not None:
+            return
+
+        self.poller.clear()
+        self.retireStrangers()
         self.eventQueue.clear()
         self._allConnected = False
-        sleep(self.reconnectWait)  # blocking is OK here.  We are trying to *avoid* making connections.
-        self.initializeStrangers()
+
+        delay = self.reconnectWait
+        if self.prefetch is not None:
+            self.prefetch.expire()
+            if len(self.prefetch) >= self._n:
+                delay = 0
+        self._reconnect = reactor.callLater(delay, self.initializeStrangers)
 
     def pumpEvents(self):
+        """Start polling all identified strangers.
+        """
+        if not self.active:
+            return
+
         for id_ in self.strangers:
-            self.strangers[id_].getEventsPage()
+            self.poller.add(self.strangers[id_])
 
-        reactor.callLater(self.refresh, self.pumpEvents)
+    def pollStats(self):
+        """Return per-stranger poll statistics (see PollScheduler.stats).
+        """
+        return self.poller.stats()
+
+    def outboxStats(self):
+        """Return outbound queue statistics summed over the current strangers
+        (see Outbox.stats).
+        """
+        total = {}
+        for s in self.strangers.itervalues():
+            for k, v in s.outbox.stats().iteritems():
+                if k == 'maxDepth' or k == 'maxLatency':
+                    total[k] = max(total.get(k, 0), v)
+                elif k != 'meanLatency':
+                    total[k] = total.get(k, 0) + v
+        return total
 
     def on_idSet(self, ev):
         for s in self._volatile:
@@ -85,24 +180,58 @@ class TrollReactor(CBDictInterface):
     def addListeners(self, listeners):
         """Add a listener or group of listeners to the reactor.
 
+        Listeners are only notified of the event types they subscribe to
+        (see CBDictInterface.subscriptions).  Adding a listener again
+        refreshes its subscriptions.
+
         listeners : CBDictInterface instance or iterable
         """
         listeners = mkIterableSequence(listeners)
 
         for listen in listeners:
+            self._unsubscribe(listen)
             self.listeners[listen] = listen  # weak-value dict
 
+            types = subscriptions(listen)
+            if types is None:
+                self._wildcard[id(listen)] = listen
+            for t in types or ():
+                self._subscribers.setdefault(t, WeakValueDictionary())[id(listen)] = listen
+
     def removeListener(self, listener):
         self.listeners.pop(listener)
+        self._unsubscribe(listener)
+
+    def _unsubscribe(self, listener):
+        self._wildcard.pop(id(listener), None)
+        for subs in self._subscribers.itervalues():
+            subs.pop(id(listener), None)
 
     def _processEventQueue(self):
+        notify = self._notifyTimed if metrics.enabled else self._notify
         while len(self.eventQueue):
             ev = self.eventQueue.popleft()
-            for listener in self.listeners:
-                listener.notify(ev)
+            subs = self._subscribers.get(ev.type)
+            if subs:
+                for listener in subs.values():
+                    notify(listener, ev)
+            if self._wildcard:
+                for listener in self._wildcard.values():
+                    notify(listener, ev)
 
             self.notify(ev)
 
+    @staticmethod
+    def _notify(listener, ev):
+        listener.notify(ev)
+
+    @staticmethod
+    def _notifyTimed(listener, ev):
+        t0 = time()
+        listener.notify(ev)
+        metrics.histogram('tromegle_listener_seconds', 'Time spent notifying listeners',
+                          listener=type(listener).__name__).since(t0)
+
     def deltaIdleTime(self):
         return time() - self.idleTime
 
@@ -133,15 +262,14 @@ class TrollReactor(CBDictInterface):
 class Client(TrollReactor):
     """Extensible client for omegle.com.
     """
-    def __init__(self, listen=ClientViewport(), refresh=2, debug=0):
-        super(Client, self).__init__(listen=listen, n=1, debug=debug)
-        self.refresh = 2
+    def __init__(self, transmog=Transmogrifier(), listen=ClientViewport(), refresh=2, debug=0, prefetch=None):
+        super(Client, self).__init__(transmog=transmog, listen=listen, n=1, refresh=refresh, debug=debug,
+                                     prefetch=prefetch)
         self._connected = False
         self.stranger = None
 
         self.amTyping = False
         self.isTyping = False
-        self.on_stoppedTyping = self.on_typing
 
         self.reset()
 
@@ -155,32 +283,47 @@ class Client(TrollReactor):
         self.stranger = Stranger(reactor, self, HTTP)
 
     def on_idSet(self, ev):
+        self.stranger = next(s for s in self._volatile if s.id == ev.id)
         self._connected = True
         self.pumpEvents()
 
     def on_typing(self, ev):
-        self.isTyping = not self.isTyping
+        self.isTyping = True
+
+    def on_stoppedTyping(self, ev):
+        self.isTyping = False
+
+    def on_gotMessage(self, ev):
+        self.isTyping = False
 
     def on_strangerDisconnected(self, ev):
+        self.poller.clear()
         self.reset()
 
     def disconnect(self):
-        self.stranger.announceDisconnect()
+        self.poller.clear()
+        d = self.stranger.announceDisconnect()
         self.reset()
+        return d
 
     def sendMessage(self, msg):
         self.stranger.sendMessage(msg)
 
+    def shutdown(self):
+        disconnects = [self.disconnect()] if self.stranger is not None else []
+        disconnects.append(super(Client, self).shutdown())
+        return DeferredList(disconnects, consumeErrors=True)
+
     def pumpEvents(self):
-        self.strangers.getEventsPage()
-        reactor.callLater(self.refresh, self.pumpEvents)
+        if self.active:
+            self.poller.add(self.stranger)
 
 
 class MiddleMan(TrollReactor):
     """Implementation of man-in-the-middle attack on two omegle users.
     """
     def __init__(self, transmog=Transmogrifier(), listen=InteractiveViewport(),
-                 idle=(0., 0.), debug=0):
+                 idle=(0., 0.), debug=0, prefetch=None):
         """Instantiate MiddleMan class
 
         transmog : Transmogrifier instance
@@ -191,13 +334,35 @@ class MiddleMan(TrollReactor):
         idle : tuple of floats
             idle[0] =   maximum time to wait for all connections (seconds)
             idle[1] =   maximum time to wait for an idle conversation to resume (seconds)
+
+        prefetch : StrangerPool or None
+            Pool of strangers started ahead of time, from which a ready pair
+            is taken on every (re)start.
         """
-        super(MiddleMan, self).__init__(transmog=transmog, listen=listen, debug=debug)
+        super(MiddleMan, self).__init__(transmog=transmog, listen=listen, debug=debug, prefetch=prefetch)
         self.max_connect_time, self.max_idle_time = idle
-        self.on_stoppedTyping = self.on_typing
 
     def on_typing(self, ev):
-        self.strangers[ev.id].toggle_typing()
+        self.relayTyping(ev.id, True)
+
+    def on_stoppedTyping(self, ev):
+        self.relayTyping(ev.id, False)
+
+    def relayTyping(self, speaker, typing):
+        """Show the typing state of a stranger to everyone else.
+        """
+        for nonspeaker_id in (nspkr for nspkr in self.strangers if nspkr != speaker):
+            self.strangers[nonspeaker_id].setTyping(typing)
+
+    def typingStats(self):
+        """Return typing request counters summed over the current strangers
+        (see Stranger.typingStats).
+        """
+        total = {'requested': 0, 'sent': 0, 'saved': 0}
+        for s in self.strangers.itervalues():
+            for k, v in s.typingStats().iteritems():
+                total[k] += v
+        return total
 
     def on_strangerDisconnected(self, ev):
         active = (i for i in self.strangers if i != ev.id)
@@ -208,6 +373,10 @@ class MiddleMan(TrollReactor):
         for nonspeaker_id in (nspkr for nspkr in self.strangers if nspkr != ev.id):
             self.strangers[nonspeaker_id].sendMessage(ev.data)
 
+        if metrics.enabled and ev.id in self.strangers and self.strangers[ev.id].received is not None:
+            metrics.histogram('tromegle_relay_seconds', 'Time from gotMessage receipt to sendMessage').since(
+                self.strangers[ev.id].received)
+
     def idle(self):
         if not self.max_idle_time and not self.max_connect_time:
             return
@@ -226,4 +395,91 @@ class MiddleMan(TrollReactor):
 
 class OMiner(object):
     """Data minig class
+
+    Streams over recorded conversations (Archive segments and rotated
+    MessageLogger files) and computes mergeable aggregates (see
+    mining.Stats).  Units of work are mined in parallel by a process pool,
+    one conversation at a time.  When a state file is given, the aggregates
+    and the units already mined are saved, so that subsequent runs only mine
+    new units.
     """
+    def __init__(self, archives=(), chatlogs=(), state=None, processes=None):
+        """
+        archives : str or iterable of str
+            Archive directories.  Only finalized segments are mined.
+
+        chatlogs : str or iterable of str
+            MessageLogger log files (e.g. 'chat.log').  Only rotated copies
+            ('chat.log.1', ...) hold complete conversations and are mined.
+
+        state : str or None
+            Path of the JSON file holding the aggregates and processed units.
+
+        processes : int or None
+            Size of the process pool.  None = number of CPUs, 0 = mine in
+            this process.
+        """
+        self.archives = [archives] if isinstance(archives, basestring) else list(archives)
+        self.chatlogs = [chatlogs] if isinstance(chatlogs, basestring) else list(chatlogs)
+        self.state = state
+        self.processes = processes
+
+        self.stats = mining.Stats()
+        self.processed = set()
+        if state is not None and os.path.exists(state):
+            self.load()
+
+    def load(self):
+        with open(self.state) as f:
+            state = json.load(f)
+        self.stats = mining.Stats.fromdict(state['stats'])
+        self.processed = set(state['processed'])
+
+    def save(self):
+        tmp = self.state + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'stats': self.stats.asdict(), 'processed': sorted(self.processed)}, f)
+        os.rename(tmp, self.state)
+
+    def units(self):
+        """Iterate over the (kind, filename, key) of every unit of work.
+        """
+        for path in self.archives:
+            for _, filename in segmentFiles(path):
+                if Segment.isFinalized(filename):
+                    yield mining.ARCHIVE, filename, mining.unitKey(mining.ARCHIVE, filename)
+
+        for base in self.chatlogs:
+            for filename in sorted(glob(base + '.[0-9]*')):
+                yield mining.CHATLOG, filename, mining.unitKey(mining.CHATLOG, filename)
+
+    def pending(self):
+        """Return the units of work not mined yet.
+        """
+        return [u for u in self.units() if u[2] not in self.processed]
+
+    def run(self):
+        """Mine every pending unit and merge the results into self.stats.
+
+        return : mining.Stats
+        """
+        units = self.pending()
+        pool = None
+        if self.processes == 0 or len(units) < 2:
+            results = imap(mining.mineUnit, units)
+        else:
+            pool = Pool(self.processes)
+            results = pool.imap_unordered(mining.mineUnit, units)
+
+        try:
+            for key, stats in results:
+                self.stats.merge(mining.Stats.fromdict(stats))
+                self.processed.add(key)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if self.state is not None:
+                self.save()
+
+        return self.stats
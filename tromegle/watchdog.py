@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import sys
+import traceback
+from thread import get_ident
+from threading import Event, Thread
+from time import time
+
+from twisted.python import log
+
+from tromegle import metrics
+
+
+class Watchdog(object):
+    """Reactor stall detector.
+
+    A heartbeat is scheduled with callLater every `interval` seconds; the
+    delay with which it runs is the reactor loop lag.  A helper thread watches
+    the heartbeat and, as soon as it is more than `threshold` seconds late,
+    captures the stack of the reactor thread, i.e. the code blocking the
+    reactor.  The stall is logged and counted once the reactor resumes.
+
+        watchdog = Watchdog()
+        reactor.callWhenRunning(watchdog.start)
+    """
+    def __init__(self, clock=None, interval=.1, threshold=.25, report=None):
+        """
+        clock : reactor or None
+            Defaults to the global reactor.
+
+        interval : float
+            Seconds between heartbeats.
+
+        threshold : float
+            Lag (seconds) above which the reactor is considered stalled.
+
+        report : callable or None
+            Called with the text of every stall report.  Defaults to log.msg.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.interval = interval
+        self.threshold = threshold
+        self.report = report or log.msg
+
+        self.beats = 0
+        self.stalls = 0
+        self.maxLag = 0.
+        self.lastStack = None
+
+        self._expected = None
+        self._call = None
+        self._thread = None
+        self._stopped = Event()
+        self._reactorThread = None
+        self._captured = None  # (beat, stack) captured by the helper thread
+
+    def start(self):
+        """Start the heartbeat and the helper thread.  Must be called from
+        the reactor thread.
+        """
+        if self._call is not None:
+            return
+        self._reactorThread = get_ident()
+        self._stopped.clear()
+        self._schedule()
+
+        self._thread = Thread(target=self._watch, name='tromegle-watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return {'beats': self.beats,
+                'stalls': self.stalls,
+                'maxLag': self.maxLag}
+
+    def _schedule(self):
+        self._expected = time() + self.interval
+        self._call = self.clock.callLater(self.interval, self._beat)
+
+    def _beat(self):
+        lag = max(0., time() - self._expected)
+        beat = self.beats
+        self.beats += 1
+        self.maxLag = max(self.maxLag, lag)
+        if metrics.enabled:
+            metrics.histogram('tromegle_reactor_lag_seconds', 'Reactor loop lag').observe(lag)
+
+        if lag > self.threshold:
+            self.stalls += 1
+            if metrics.enabled:
+                metrics.counter('tromegle_reactor_stalls_total', 'Reactor stalls').inc()
+
+            captured = self._captured
+            stack = captured[1] if captured is not None and captured[0] == beat else None
+            self.lastStack = stack
+            self.report('Reactor stalled for {0:.3f}s{1}'.format(
+                lag, ' in:\n' + stack if stack else ' (no stack captured)'))
+        self._schedule()
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval / 2.):
+            expected, beat = self._expected, self.beats
+            if expected is None or time() - expected <= self.threshold:
+                continue
+            if self._captured is not None and self._captured[0] == beat:
+                continue  # already captured this stall
+
+            frame = sys._current_frames().get(self._reactorThread)
+            if frame is not None:
+                self._captured = (beat, ''.join(traceback.format_stack(frame)))